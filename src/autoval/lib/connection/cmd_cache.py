@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Results of read-only commands cached for the lifetime of a boot.
+
+Discovery commands such as `dmidecode`, `lspci` or `lshw -json` print the
+same output until the host reboots. ConnectionAbstract.run_get_result_cached()
+runs such a command once per (host, user, command, sudo) and boot, and hands
+the same CmdResult to every later caller, from any thread. sudo is set if
+either the call or the connection runs the command with sudo.
+
+Entries are tagged with the boot_id of the host facts (see HostFacts). They
+are dropped when a reconnect or get_last_reboot()/has_rebooted() notices a
+new boot, and an entry whose boot_id no longer matches is never returned.
+"""
+import threading
+from typing import Dict, Hashable, Optional, Tuple
+
+from autoval.lib.connection.connection_utils import CmdResult
+from autoval.lib.utils.autoval_log import AutovalLog
+
+
+class CmdResultCache:
+    _lock = threading.Lock()
+    # (hostname, user, cmd, sudo) -> (boot_id, result)
+    _cache: Dict[Hashable, Tuple[str, CmdResult]] = {}
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def get(cls, conn, cmd: str, sudo: bool, boot_id: str) -> Optional[CmdResult]:
+        with cls._lock:
+            entry = cls._cache.get(cls._key(conn, cmd, sudo))
+        if entry is None or entry[0] != boot_id:
+            return None
+        return entry[1]
+
+    @classmethod
+    def store(
+        cls,
+        # pyre-fixme[2]: Parameter must be annotated.
+        conn,
+        cmd: str,
+        sudo: bool,
+        boot_id: str,
+        result: CmdResult,
+    ) -> None:
+        with cls._lock:
+            cls._cache[cls._key(conn, cmd, sudo)] = (boot_id, result)
+
+    @classmethod
+    def invalidate(cls, hostname: str) -> None:
+        with cls._lock:
+            keys = [key for key in cls._cache if key[0] == hostname]
+            for key in keys:
+                del cls._cache[key]
+        if keys:
+            AutovalLog.log_debug(
+                f"Dropped {len(keys)} cached command results of {hostname}"
+            )
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def _key(cls, conn, cmd: str, sudo: bool) -> Tuple[str, Optional[str], str, bool]:
+        # A sudo connection runs every command with sudo, whatever the flag
+        effective_sudo = bool(sudo or getattr(conn, "sudo", False))
+        return (conn.hostname, getattr(conn, "user", None), cmd, effective_sudo)
@@ -1,20 +1,37 @@
 #!/usr/bin/env python3
 import abc
+import shlex
 import time
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
-from autoval.lib.connection.connection_utils import CmdResult
+from autoval.lib.connection.cmd_cache import CmdResultCache
+from autoval.lib.connection.connection_utils import (
+    BatchCmd,
+    BatchScript,
+    CmdResult,
+    CmdStream,
+    ConnectionUtils,
+)
+from autoval.lib.connection.host_facts import HostFacts
+from autoval.lib.connection.reboot_watcher import DOWN, FAILED, RebootWatcher
+from autoval.lib.connection.reconnect_waiter import ReconnectTimes, ReconnectWaiter
 from autoval.lib.host.component.component import COMPONENT
 from autoval.lib.utils.autoval_errors import ErrorType
-from autoval.lib.utils.autoval_exceptions import AutoValException, HostException
-from autoval.lib.utils.autoval_utils import AutovalLog
-from autoval.lib.utils.decorators import retry
+from autoval.lib.utils.autoval_exceptions import (
+    AutoValException,
+    CmdError,
+    TimeoutError,
+)
+from autoval.lib.utils.autoval_utils import AutovalLog, MAX_THREADS
 from autoval.lib.utils.folder_utils import FolderTransfer
 from autoval.lib.utils.result_handler import ResultHandler
 
 
 class ConnectionAbstract(abc.ABC):
     result_handler = ResultHandler()
+    # Whether the host facts include if the user may run sudo, see HostFacts
+    check_sudo_fact: bool = True
 
     def run(
         self,
@@ -50,6 +67,47 @@ class ConnectionAbstract(abc.ABC):
         )
         return res.output()
 
+    def _run_script(
+        self,
+        script: str,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        connection_timeout: int = 60,
+        path_env: Optional[List[str]] = None,
+    ) -> CmdResult:
+        """
+        Runs a compound or multi-line shell script as the single simple
+        command `sh -c '<script>'`. With sudo set on the connection it is
+        prefixed with plain sudo: the default `sudo sh -lc` leaves the script
+        unquoted, so the login shell would only run its first word.
+        """
+        return self.run_get_result(
+            "sh -c %s" % shlex.quote(script),
+            ignore_status=ignore_status,
+            timeout=timeout,
+            sudo_options=None,
+            connection_timeout=connection_timeout,
+            path_env=path_env,
+        )
+
+    def _exec_script(
+        self,
+        script: str,
+        timeout: int = 600,
+        connection_timeout: int = 60,
+        path_env: Optional[List[str]] = None,
+    ) -> CmdResult:
+        """
+        Runs script like _run_script(ignore_status=True), but logs nothing
+        to cmdlog or cmd_metrics, for callers that log the commands within
+        the script themselves. A timeout is returned as exit status 124,
+        with the output read until then where the transport keeps it.
+        Implemented by SSHConn and LocalConn.
+        """
+        raise NotImplementedError(
+            f"_exec_script is not supported by {type(self).__name__}"
+        )
+
     @abc.abstractmethod
     def run_get_result(
         self,
@@ -73,6 +131,218 @@ class ConnectionAbstract(abc.ABC):
         """
         pass
 
+    def run_get_result_cached(
+        self,
+        cmd: str,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        sudo: bool = False,
+        connection_timeout: int = 60,
+    ) -> CmdResult:
+        """
+        Runs a read-only command whose output cannot change until the host
+        reboots (dmidecode, lspci, lshw -json, ...) and caches its result for
+        the current boot, see CmdResultCache. Later calls return the same
+        CmdResult, which must be treated as read-only, and are recorded in
+        cmd_metrics with a zero duration.
+
+        Only successful results are cached. Without a boot_id in the host
+        facts the command is simply run every time.
+        """
+        boot_id = self.get_facts().get("boot_id", "")
+        if boot_id:
+            result = CmdResultCache.get(self, cmd, sudo, boot_id)
+            if result is not None:
+                self._log_cmd_metrics(
+                    cmd,
+                    time.time(),
+                    0,
+                    result.return_code,
+                    f"Cached result of boot {boot_id}",
+                )
+                return result
+        result = self.run_get_result(
+            cmd,
+            ignore_status=ignore_status,
+            timeout=timeout,
+            sudo=sudo,
+            connection_timeout=connection_timeout,
+        )
+        if boot_id and result.return_code == 0:
+            CmdResultCache.store(self, cmd, sudo, boot_id, result)
+        return result
+
+    def run_cached(
+        self,
+        cmd: str,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        sudo: bool = False,
+        connection_timeout: int = 60,
+    ) -> str:
+        """
+        Like run(), with the result cached per boot, see run_get_result_cached
+        """
+        return self.run_get_result_cached(
+            cmd,
+            ignore_status=ignore_status,
+            timeout=timeout,
+            sudo=sudo,
+            connection_timeout=connection_timeout,
+        ).output()
+
+    def run_many(
+        self,
+        cmds: List[str],
+        max_concurrency: int = MAX_THREADS,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        get_pty: bool = False,
+        sudo: bool = False,
+        sudo_options: Optional[List[str]] = None,
+        connection_timeout: int = 60,
+        path_env: Optional[List[str]] = None,
+    ) -> List[CmdResult]:
+        """
+        Runs independent commands concurrently and returns their CmdResults
+        in input order.
+
+        This default implementation runs run_get_result() from a thread pool of
+        max_concurrency workers. Connection types that can multiplex commands
+        over a single session (e.g. SSHConn) override it.
+        If a command fails and ignore_status is not set, the first error in
+        input order is raised after all commands have finished.
+        """
+        with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+            futures = [
+                executor.submit(
+                    self.run_get_result,
+                    cmd,
+                    ignore_status=ignore_status,
+                    timeout=timeout,
+                    working_directory=working_directory,
+                    custom_logfile=custom_logfile,
+                    get_pty=get_pty,
+                    sudo=sudo,
+                    sudo_options=sudo_options,
+                    connection_timeout=connection_timeout,
+                    path_env=path_env,
+                )
+                for cmd in cmds
+            ]
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+        return [future.result() for future in futures]
+
+    def run_batch(
+        self,
+        cmds: List[Union[str, BatchCmd]],
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        sudo: bool = False,
+        connection_timeout: int = 60,
+        path_env: Optional[List[str]] = None,
+    ) -> List[CmdResult]:
+        """
+        Runs cmds one after another as a single remote script and returns one
+        CmdResult per command, in input order.
+
+        Meant for many small independent commands, e.g. config collection,
+        which would otherwise each pay for a channel and a round trip. Every
+        command is logged to cmdlog and cmd_metrics as if it had run on its
+        own. Pass a BatchCmd to give a command its own ignore_status or
+        timeout. Errors are raised once all commands are done, the first one
+        in input order wins. If the script as a whole times out, the
+        commands that completed keep their results and only the others
+        fail with a timeout.
+        """
+        batch_cmds = []
+        for cmd in cmds:
+            if not isinstance(cmd, BatchCmd):
+                cmd = BatchCmd(cmd)
+            if working_directory:
+                cmd = cmd._replace(cmd="cd %s && %s" % (working_directory, cmd.cmd))
+            if cmd.ignore_status is None:
+                cmd = cmd._replace(ignore_status=ignore_status)
+            if cmd.timeout is None:
+                cmd = cmd._replace(timeout=timeout)
+            batch_cmds.append(cmd)
+        if not batch_cmds:
+            return []
+        batch = BatchScript(batch_cmds, sudo_prefix="sudo " if sudo else "")
+        start_time = time.time()
+        # Only the commands are logged, not the script that wraps them
+        script_result = self._exec_script(
+            batch.script(),
+            timeout=batch.timeout + connection_timeout,
+            connection_timeout=connection_timeout,
+            path_env=path_env,
+        )
+        script_timed_out = script_result.return_code == 124
+        results = []
+        error = None
+        for batch_cmd, (stdout, stderr, return_code, duration) in zip(
+            batch_cmds, batch.parse(script_result.stdout, script_result.stderr)
+        ):
+            if return_code == -1 and script_timed_out:
+                # Killed along with the script, or never started
+                return_code = 124
+            output = stdout + stderr
+            self._log_cmd_metrics(
+                batch_cmd.cmd, start_time, duration, return_code, output
+            )
+            ConnectionUtils.log_cmdlog(
+                self.hostname, batch_cmd.cmd, return_code, output, custom_logfile
+            )
+            start_time += duration
+            result = CmdResult(batch_cmd.cmd, stdout, stderr, return_code, duration)
+            results.append(result)
+            if error is not None:
+                continue
+            if return_code == 124:
+                error = TimeoutError(
+                    f"[{batch_cmd.cmd}] timed out. Failed to complete within {batch_cmd.timeout} seconds on {self.hostname}"
+                )
+            elif return_code != 0 and not batch_cmd.ignore_status:
+                msg = "Command returned non-zero exit status on %s" % (self.hostname)
+                error_type = ErrorType.CMD_ERR
+                if "command not found" in output:
+                    error_type = ErrorType.CMD_NOT_FOUND_ERR
+                error = CmdError(batch_cmd.cmd, result, msg, error_type=error_type)
+        if error is not None:
+            raise error
+        return results
+
+    def run_stream(
+        self,
+        cmd: str,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        get_pty: bool = False,
+        sudo: bool = False,
+        sudo_options: Optional[List[str]] = None,
+        connection_timeout: int = 60,
+        path_env: Optional[List[str]] = None,
+        raw: bool = False,
+        line_callback: Optional[Callable[[str, str], None]] = None,
+    ) -> CmdStream:
+        """
+        Runs cmd and returns a CmdStream that yields output lines (or raw
+        chunks with raw=True) while the command is running, calling
+        line_callback(line, stream_name) for every line.
+        Implemented by SSHConn and LocalConn.
+        """
+        raise NotImplementedError(
+            f"run_stream is not supported by {type(self).__name__}"
+        )
+
     @abc.abstractmethod
     # pyre-fixme[3]: Return type must be annotated.
     # pyre-fixme[2]: Parameter must be annotated.
@@ -170,63 +440,92 @@ class ConnectionAbstract(abc.ABC):
         xfer.transfer_to_remote(create=create, overwrite=overwrite)
 
     def reconnect(self, timeout: float = 600) -> None:
-        # Reconnects to host. Retries for 'timeout' seconds.
+        """
+        Reconnects to host. Retries for 'timeout' seconds, probing the port
+        of the host at adaptive intervals and only connecting once it
+        answers, see ReconnectWaiter. The times of the reconnect are kept in
+        last_reconnect and saved in cmd_metrics.
+        """
         AutovalLog.log_info("Reconnecting to %s..." % self.hostname)
-        end = time.time() + timeout
-        success = False
-        while time.time() < end:
-            try:
-                self._connect()
-                self.run("/bin/true", timeout=10)
-            except Exception:
-                time.sleep(10)
-                continue
-            else:
-                success = True
-                AutovalLog.log_info("reconnect successful")
-                break
-
-        if not success:
+        times = ReconnectWaiter.wait(
+            self.hostname, self._get_probe_target(), self._try_reconnect, timeout
+        )
+        if times is None:
             raise Exception(
                 "Failed to reconnect to %s after %d seconds" % (self.hostname, timeout)
             )
+        self.last_reconnect: Optional[ReconnectTimes] = times
+        # The host may have rebooted in between
+        HostFacts.invalidate(self.hostname)
+        CmdResultCache.invalidate(self.hostname)
+        self._log_cmd_metrics(
+            "reconnect", times.start, times.connected - times.start, 0, ""
+        )
+        AutovalLog.log_info(
+            "reconnect successful, port open after %.1fs, connected after %.1fs"
+            % (times.port_open - times.start, times.connected - times.start)
+        )
+
+    def _get_probe_target(self) -> Optional[Tuple[str, int]]:
+        """
+        Returns the (address, port) whose answer shows that the host is back
+        before reconnect() tries to connect, None to always try to connect
+        """
+        return None
+
+    def _try_reconnect(self, timeout: float) -> None:
+        """
+        One attempt of reconnect(), raising if the host cannot be used yet.
+        It should not take much longer than timeout seconds.
+        """
+        self._connect()
+        self.run("/bin/true", timeout=max(1, min(10, int(timeout))))
 
     def get_last_reboot(self) -> str:
-        cmd = "expr `date +%s` - `cut -f1 -d. /proc/uptime`"
-        out = self.run(cmd)
-        return out
+        # boot_id comes along for free and keeps the cached host facts honest
+        script = (
+            "cat /proc/sys/kernel/random/boot_id 2>/dev/null; "
+            "expr `date +%s` - `cut -f1 -d. /proc/uptime`"
+        )
+        lines = self._run_script(script).output().splitlines()
+        if len(lines) > 1 and HostFacts.check_boot_id(self, lines[0].strip()):
+            CmdResultCache.invalidate(self.hostname)
+        return lines[-1] if lines else ""
+
+    def get_facts(self, refresh: bool = False) -> Dict[str, str]:
+        """
+        Returns static facts about the host (uname, user, groups, sudo if
+        check_sudo_fact is set, boot_id, uptime, PATH, OS release and DMI
+        fields), collected in a single command on first use and cached per
+        host, see HostFacts.
+        """
+        return HostFacts.get(self, refresh=refresh)
 
     # pyre-fixme[2]: Parameter must be annotated.
     def has_rebooted(self, prev_reboot_time, new_reboot_time) -> bool:
         if abs(int(prev_reboot_time) - int(new_reboot_time)) > 5:
+            HostFacts.invalidate(self.hostname)
+            CmdResultCache.invalidate(self.hostname)
             return True
         else:
             return False
 
-    @retry(tries=120, sleep_seconds=10, exceptions=(HostException))
     def wait_for_reconnect(self, timeout: float = 1200) -> None:
-        self.reconnect(timeout=10)
+        self.reconnect(timeout=timeout)
 
     # pyre-fixme[2]: Parameter must be annotated.
     def _is_system_booted(self, start_time, shutdown_timeout) -> None:
-        system_down = False
-        count = 0
-        while time.time() < start_time + shutdown_timeout:
-            try:
-                self.reconnect(timeout=30)
-                # For AC and DC cycle, reconnnect wait/retries for more then
-                # 1 min and return connection once system reboot is complete.
-                if count == 0:
-                    if time.time() > start_time + shutdown_timeout:
-                        system_down = True
-                    count += 1
-            except Exception:
-                system_down = True
-                break
-        if not system_down and count != 0:
+        """
+        Waits until the host went down, or rebooted, within shutdown_timeout
+        seconds of start_time, see RebootWatcher.
+        """
+        watcher = RebootWatcher()
+        target = watcher.add(self.hostname, self)
+        watcher.wait(start_time + shutdown_timeout - time.time(), until=DOWN)
+        if target.state == FAILED:
             raise Exception(
                 "System did not start to shutdown with the power cycle command "
-                "even after 100 sec"
+                "even after %d sec" % shutdown_timeout
             )
 
     @property
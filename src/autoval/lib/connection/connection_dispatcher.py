@@ -6,6 +6,12 @@ from autoval.lib.host.credentials import Credentials
 
 
 class ConnectionDispatcher:
+    """
+    Builds the connections of a host dict on first use. Connections are
+    shared with every other dispatcher of the same DUT, BMCs and localhost
+    through ConnectionFactory.get_shared(), see ConnectionRegistry.
+    """
+
     # pyre-fixme[2]: Parameter must be annotated.
     def __init__(self, host, skip_health_check: bool = False) -> None:
         # pyre-fixme[4]: Attribute must be annotated.
@@ -43,7 +49,7 @@ class ConnectionDispatcher:
     def host_connection(self):
         if not self._host_connection:
             password = self.host_dict.get("password", None)
-            self._host_connection = ConnectionFactory.create(
+            self._host_connection = ConnectionFactory.get_shared(
                 hostname=self.hostname,
                 user=self.host_dict.get("username", None),
                 password=password,
@@ -53,6 +59,8 @@ class ConnectionDispatcher:
                 local_mode=self.host_dict.get("local_mode", False),
                 sudo=self.host_dict.get("sudo", False),
                 port=self.host_port,
+                use_async=self.host_dict.get("async_ssh", False),
+                transport_options=self.host_dict.get("ssh_transport", None),
             )
         return self._host_connection
 
@@ -83,12 +91,14 @@ class ConnectionDispatcher:
                     self.hostname, oob_addr
                 )
             bmc_connections.append(
-                ConnectionFactory.create(
+                ConnectionFactory.get_shared(
                     oob_addr,
                     force_ssh=True,
                     user=oob_username,
                     password=oob_password,
                     allow_agent=False,
+                    use_async=self.host_dict.get("async_ssh", False),
+                    transport_options=self.host_dict.get("oob_ssh_transport", None),
                 )
             )
         return bmc_connections
@@ -97,5 +107,20 @@ class ConnectionDispatcher:
     # pyre-fixme[3]: Return type must be annotated.
     def localhost(self):
         if not self._localhost:
-            self._localhost = ConnectionFactory.create("localhost", local_mode=True)
+            self._localhost = ConnectionFactory.get_shared("localhost", local_mode=True)
         return self._localhost
+
+    def release(self) -> None:
+        """
+        Drops the references this dispatcher holds on shared connections.
+        They are created again, or taken from the registry, on next use.
+        """
+        connections = [self._host_connection, self._localhost]
+        connections.extend(self._bmc_connections)
+        for connection in connections:
+            if connection is not None:
+                ConnectionFactory.release(connection)
+        self._host_connection = None
+        self._localhost = None
+        self._bmc_connections = []
+        self._oob_addr = ""
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 
 import argparse
+from typing import Optional
 
+from autoval.lib.connection.connection_registry import ConnectionRegistry
+from autoval.lib.transport.async_local import AsyncLocalConn
+from autoval.lib.transport.async_ssh import AsyncSSHConn
 from autoval.lib.transport.local import LocalConn
 from autoval.lib.transport.ssh import SSHConn
+from autoval.lib.transport.ssh_tuning import SSHTransportOptions
 from autoval.plugins.plugin_manager import PluginManager
 
 
 class ConnectionFactory:
+    # --thrift command line argument, parsed once per process
+    _thrift_arg: Optional[bool] = None
+
     @classmethod
     # pyre-fixme[3]: Return type must be annotated.
     def _parse_connection_arg(cls):
+        if cls._thrift_arg is not None:
+            return cls._thrift_arg
         parser = argparse.ArgumentParser(description="connection arg")
         parser.add_argument(
             "--thrift",
@@ -21,7 +31,8 @@ class ConnectionFactory:
             help="Thrift connection (Default: SSH)",
         )
         args = parser.parse_known_args()[0]
-        return args.thrift
+        cls._thrift_arg = args.thrift
+        return cls._thrift_arg
 
     @classmethod
     # pyre-fixme[3]: Return type must be annotated.
@@ -41,15 +52,10 @@ class ConnectionFactory:
         sudo: bool = False,
         # pyre-fixme[2]: Parameter must be annotated.
         port=None,
+        use_async: bool = False,
+        # pyre-fixme[2]: Parameter must be annotated.
+        transport_options=None,
     ):
-        if force_thrift:
-            # pyre-fixme[16]: `Type` has no attribute `thrift`.
-            cls.thrift = True
-        elif force_ssh:
-            cls.thrift = False
-        else:
-            cls.thrift = cls._parse_connection_arg()
-
         obj = cls._get_object(
             hostname,
             force_ssh,
@@ -61,9 +67,83 @@ class ConnectionFactory:
             local_mode,
             sudo,
             port,
+            use_async,
+            transport_options,
         )
         return obj
 
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    def get_shared(
+        cls,
+        # pyre-fixme[2]: Parameter must be annotated.
+        hostname,
+        force_ssh: bool = False,
+        skip_health_check: bool = False,
+        # pyre-fixme[2]: Parameter must be annotated.
+        user=None,
+        # pyre-fixme[2]: Parameter must be annotated.
+        password=None,
+        allow_agent: bool = True,
+        force_thrift: bool = False,
+        local_mode: bool = False,
+        sudo: bool = False,
+        # pyre-fixme[2]: Parameter must be annotated.
+        port=None,
+        use_async: bool = False,
+        # pyre-fixme[2]: Parameter must be annotated.
+        transport_options=None,
+    ):
+        """
+        Same as create(), but returns the connection already registered for
+        the same arguments if there is one, see ConnectionRegistry. Every
+        call takes a reference, to be dropped with release().
+        skip_health_check only applies when the connection is created.
+        """
+        key = (
+            hostname,
+            user,
+            password,
+            allow_agent,
+            cls._use_thrift(force_ssh, force_thrift) and not local_mode,
+            local_mode,
+            sudo,
+            port,
+            use_async,
+            SSHTransportOptions.freeze(transport_options or {}),
+        )
+        return ConnectionRegistry.acquire(
+            key,
+            lambda: cls.create(
+                hostname,
+                force_ssh=force_ssh,
+                skip_health_check=skip_health_check,
+                user=user,
+                password=password,
+                allow_agent=allow_agent,
+                force_thrift=force_thrift,
+                local_mode=local_mode,
+                sudo=sudo,
+                port=port,
+                use_async=use_async,
+                transport_options=transport_options,
+            ),
+        )
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def release(cls, connection) -> None:
+        """
+        Drops a reference taken with get_shared()
+        """
+        ConnectionRegistry.release(connection)
+
+    @classmethod
+    def _use_thrift(cls, force_ssh: bool, force_thrift: bool) -> bool:
+        if force_ssh:
+            return False
+        return force_thrift or cls._parse_connection_arg()
+
     @classmethod
     # pyre-fixme[3]: Return type must be annotated.
     def _get_object(
@@ -88,29 +168,28 @@ class ConnectionFactory:
         sudo,
         # pyre-fixme[2]: Parameter must be annotated.
         port,
+        use_async: bool = False,
+        # pyre-fixme[2]: Parameter must be annotated.
+        transport_options=None,
     ):
         if local_mode:
-            return LocalConn(hostname, sudo=sudo)
+            local_cls = AsyncLocalConn if use_async else LocalConn
+            return local_cls(hostname, sudo=sudo)
 
-        if force_ssh:
-            use_thrift = False
-        # pyre-fixme[16]: `ConnectionFactory` has no attribute `thrift`.
-        elif cls.thrift or force_thrift:
-            use_thrift = True
-        else:
-            use_thrift = False
-        if use_thrift:
+        if cls._use_thrift(force_ssh, force_thrift):
             return PluginManager.get_plugin_cls("thrift_conn")(
                 hostname, port, skip_health_check, sudo=sudo
             )
 
-        return SSHConn(
+        ssh_cls = AsyncSSHConn if use_async else SSHConn
+        return ssh_cls(
             hostname,
             skip_health_check,
             user=user,
             password=password,
             allow_agent=allow_agent,
             sudo=sudo,
+            transport_options=transport_options,
         )
 
     @classmethod
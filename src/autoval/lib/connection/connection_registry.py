@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Process-wide registry of connection objects.
+
+Every ConnectionDispatcher, and so every Host, used to create its own SSHConn,
+LocalConn or thrift connection, so a test, its background monitors and the
+test utils they run each kept separate connection objects, is_root lookups
+and sessions to the same DUT. ConnectionDispatcher now asks the registry
+first: connections are keyed by everything that makes them differ (hostname,
+credentials, transport, sudo, port, tuning) and handed out ref-counted.
+Each acquire() must be paired with a release(); an entry is dropped once
+nobody holds it anymore.
+"""
+import threading
+from typing import Callable, Dict, Hashable, List
+
+from autoval.lib.utils.autoval_log import AutovalLog
+
+
+class ConnectionRegistry:
+    _lock = threading.RLock()
+    # key -> [connection, reference count]
+    _entries: Dict[Hashable, List] = {}
+
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    # pyre-fixme[24]: Generic type `Callable` expects 2 type parameters.
+    def acquire(cls, key: Hashable, factory: Callable):
+        """
+        Returns the connection registered under key, creating it with
+        factory() on first use, and takes a reference on it.
+        """
+        with cls._lock:
+            entry = cls._entries.get(key)
+            if entry is None:
+                entry = [factory(), 0]
+                cls._entries[key] = entry
+                AutovalLog.log_debug(f"Registered connection {key[0]}")
+            entry[1] += 1
+            return entry[0]
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def release(cls, connection) -> None:
+        """
+        Drops a reference on connection, and the connection itself from the
+        registry once nobody holds it anymore
+        """
+        with cls._lock:
+            for key, entry in list(cls._entries.items()):
+                if entry[0] is connection:
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        del cls._entries[key]
+                    return
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def get_refcount(cls, connection) -> int:
+        with cls._lock:
+            for entry in cls._entries.values():
+                if entry[0] is connection:
+                    return entry[1]
+        return 0
+
+    @classmethod
+    def clear(cls) -> None:
+        with cls._lock:
+            cls._entries.clear()
@@ -1,11 +1,38 @@
 #!/usr/bin/env python3
 
+import re
+import shlex
 import sys
+import time
+import uuid
+from collections import deque
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
 
+from autoval.lib.utils.autoval_errors import ErrorType
+from autoval.lib.utils.autoval_exceptions import CmdError, TimeoutError
 from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.output_capture import LazyOutput
+
+# Maximum bytes read from a channel/pipe per chunk when streaming output
+STREAM_CHUNK_SIZE = 32768
+# Number of trailing output lines kept for the CmdResult of a streamed command
+STREAM_TAIL_LINES = 1000
 
 
 class CmdResult:
+    # Spilled outputs are only loaded from disk when accessed
+    stdout = LazyOutput()
+    stderr = LazyOutput()
+
     def __init__(
         self, command: str, stdout: str, stderr: str, return_code: int, duration: float
     ) -> None:
@@ -24,6 +51,106 @@ class CmdResult:
         return ConnectionUtils.str_encode(self.stdout + self.stderr).strip()
 
 
+class BatchCmd(NamedTuple):
+    """
+    A command of run_batch() with its own ignore_status and timeout.
+    None means the value passed to run_batch() applies.
+    """
+
+    cmd: str
+    ignore_status: Optional[bool] = None
+    timeout: Optional[int] = None
+
+
+class BatchScript:
+    """
+    Builds one shell script out of many commands and splits its output back
+    into one CmdResult per command.
+
+    Every command is framed by marker lines on stdout and stderr, carrying
+    its index, exit code and start/end time read from /proc/uptime. The
+    marker embeds a random token, so command output cannot fake a frame.
+    Each command runs under `timeout`, which exits with 124 like the
+    connection level timeouts do. The script finds out which syntax the
+    host's timeout takes: GNU coreutils and newer busybox take the seconds
+    as first argument, busybox before 1.30 (e.g. on BMCs) needs -t. Hosts
+    without timeout run the commands without one, bounded only by the
+    timeout of the whole script.
+    """
+
+    def __init__(self, cmds: List[BatchCmd], sudo_prefix: str = "") -> None:
+        self.cmds = cmds
+        self.sudo_prefix = sudo_prefix
+        self.marker = "__autoval_batch_%s__" % uuid.uuid4().hex
+
+    @property
+    def timeout(self) -> int:
+        # pyre-fixme[6]: timeouts are resolved before the script is built
+        return sum(cmd.timeout for cmd in self.cmds)
+
+    def script(self) -> str:
+        lines = [
+            "_now() { cut -d' ' -f1 /proc/uptime 2>/dev/null || echo 0; }",
+            "if timeout 5 true >/dev/null 2>&1; then",
+            '    _t() { timeout "$@"; }',
+            "elif timeout -t 5 true >/dev/null 2>&1; then",
+            "    # Old busybox reports a timeout as killed by SIGTERM",
+            '    _t() { timeout -t "$@"; _r=$?; [ $_r = 143 ] && _r=124; return $_r; }',
+            "else",
+            '    _t() { shift; "$@"; }',
+            "fi",
+        ]
+        for index, batch_cmd in enumerate(self.cmds):
+            # timeout wraps sudo, sudo passes the SIGTERM on to the command
+            cmd = "_t %d %ssh -c %s </dev/null" % (
+                batch_cmd.timeout,
+                self.sudo_prefix,
+                shlex.quote(batch_cmd.cmd),
+            )
+            lines += [
+                f"printf '\\n%s begin {index}\\n' {self.marker}",
+                f"printf '\\n%s begin {index}\\n' {self.marker} >&2",
+                "_s=$(_now)",
+                cmd,
+                "_rc=$?",
+                f"printf '\\n%s end {index} %s %s %s\\n' {self.marker} $_rc $_s $(_now)",
+                f"printf '\\n%s end {index}\\n' {self.marker} >&2",
+            ]
+        return "\n".join(lines)
+
+    def parse(self, stdout: str, stderr: str) -> List[Tuple[str, str, int, float]]:
+        """
+        Returns (stdout, stderr, return_code, duration) per command.
+        Commands that never ran, e.g. because the script was killed, get
+        return code -1.
+        """
+        outs = self._split(stdout, r" (-?\d+) ([\d.]+) ([\d.]+)")
+        errs = self._split(stderr, "")
+        results = []
+        for index in range(len(self.cmds)):
+            out, groups = outs.get(index, ("", None))
+            err, _ = errs.get(index, ("", None))
+            if groups is None:
+                results.append((out, err, -1, 0.0))
+            else:
+                duration = max(0.0, float(groups[2]) - float(groups[1]))
+                results.append((out, err, int(groups[0]), duration))
+        return results
+
+    def _split(
+        self, output: str, end_fields: str
+    ) -> Dict[int, Tuple[str, Optional[Tuple[str, ...]]]]:
+        pattern = re.compile(
+            r"\n%s begin (\d+)\n(.*?)\n%s end \1%s\n"
+            % (self.marker, self.marker, end_fields),
+            re.S,
+        )
+        return {
+            int(match.group(1)): (match.group(2), match.groups()[2:] or None)
+            for match in pattern.finditer(output)
+        }
+
+
 class ConnectionUtils:
     @classmethod
     def log_cmdlog(
@@ -62,3 +189,168 @@ class ConnectionUtils:
             return content.encode("ascii", "ignore")
 
         return content
+
+
+class CmdStream:
+    """
+    Iterator over the output of a running command, returned by run_stream().
+
+    Yields decoded output lines (stdout and stderr, as they arrive) or raw
+    bytes chunks when raw=True. Output is only read from the channel or pipe
+    when the next item is requested, so a slow consumer makes the command
+    block on a full window/pipe instead of output piling up in memory.
+
+    Once iteration finishes, the command is logged to cmd_metrics and cmdlog
+    like any other command and `result` holds a CmdResult with the exit code
+    and the last STREAM_TAIL_LINES lines of stdout/stderr. TimeoutError or
+    CmdError are raised at the end of the iteration, as run_get_result does.
+
+    Example:
+        with host.run_stream("stress-ng --timeout 4h", timeout=15000) as stream:
+            for line in stream:
+                AutovalLog.log_info(line)
+        rc = stream.result.return_code
+    """
+
+    def __init__(
+        self,
+        # pyre-fixme[2]: Parameter must be annotated.
+        conn,
+        command: str,
+        source: Iterator[Tuple[str, bytes]],
+        get_return_code: Callable[[], int],
+        ignore_status: bool = False,
+        timeout: int = 600,
+        custom_logfile: Optional[str] = None,
+        raw: bool = False,
+        line_callback: Optional[Callable[[str, str], None]] = None,
+        tail_lines: int = STREAM_TAIL_LINES,
+    ) -> None:
+        """
+        Params:
+            conn: connection the command runs on, used for logging
+            command: command string as it will be logged
+            source: generator yielding ("stdout"|"stderr", bytes) chunks
+            get_return_code: returns the exit code once source is exhausted
+            line_callback: called with (line, stream_name) for each line
+        """
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.conn = conn
+        self.command = command
+        self._source = source
+        self._get_return_code = get_return_code
+        self.ignore_status = ignore_status
+        self.timeout = timeout
+        self.custom_logfile = custom_logfile
+        self.raw = raw
+        self.line_callback = line_callback
+        self.tail_lines = tail_lines
+        self.result: Optional[CmdResult] = None
+        self.truncated_lines = 0
+        self._iter: Iterator[Union[str, bytes]] = self._generate()
+
+    def __iter__(self) -> "CmdStream":
+        return self
+
+    def __next__(self) -> Union[str, bytes]:
+        return next(self._iter)
+
+    def __enter__(self) -> "CmdStream":
+        return self
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def wait(self) -> CmdResult:
+        """
+        Consumes the remaining output and returns the final CmdResult.
+        """
+        for _ in self:
+            pass
+        # pyre-fixme[7]: Expected `CmdResult` but got `Optional[CmdResult]`.
+        return self.result
+
+    def close(self) -> None:
+        """
+        Stops reading. A command still running is terminated by the source.
+        """
+        # pyre-fixme[16]: `Iterator` has no attribute `close`.
+        self._iter.close()
+
+    # pyre-fixme[3]: Return type must be annotated.
+    def _generate(self):
+        start_time = time.time()
+        partial = {"stdout": b"", "stderr": b""}
+        tails = {
+            "stdout": deque(maxlen=self.tail_lines),
+            "stderr": deque(maxlen=self.tail_lines),
+        }
+        return_code = -1
+        try:
+            for stream, data in self._source:
+                lines = (partial[stream] + data).split(b"\n")
+                partial[stream] = lines.pop()
+                decoded = [self._add_line(tails, stream, line) for line in lines]
+                if self.raw:
+                    yield data
+                else:
+                    yield from decoded
+            for stream, data in partial.items():
+                if data:
+                    line = self._add_line(tails, stream, data)
+                    if not self.raw:
+                        yield line
+            return_code = self._get_return_code()
+        finally:
+            # pyre-fixme[16]: `Iterator` has no attribute `close`.
+            self._source.close()
+            self._finish(start_time, return_code, tails)
+        if return_code == 124:
+            raise TimeoutError(
+                f"[{self.command}] timed out. Failed to complete within {self.timeout} seconds on {self.conn.hostname}"
+            )
+        if return_code != 0 and not self.ignore_status:
+            msg = "Command returned non-zero exit status on %s" % self.conn.hostname
+            # pyre-fixme[16]: Optional type has no attribute `output`.
+            if "command not found" in self.result.output():
+                raise CmdError(
+                    self.command,
+                    self.result,
+                    msg,
+                    error_type=ErrorType.CMD_NOT_FOUND_ERR,
+                )
+            raise CmdError(self.command, self.result, msg)
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    def _add_line(self, tails, stream: str, line: bytes) -> str:
+        decoded = ConnectionUtils.str_encode(line)
+        if len(tails[stream]) == self.tail_lines:
+            self.truncated_lines += 1
+        tails[stream].append(decoded)
+        if self.line_callback is not None:
+            self.line_callback(decoded, stream)
+        return decoded
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    def _finish(self, start_time: float, return_code: int, tails) -> None:
+        duration = time.time() - start_time
+        stdout = "".join(line + "\n" for line in tails["stdout"])
+        stderr = "".join(line + "\n" for line in tails["stderr"])
+        self.result = CmdResult(self.command, stdout, stderr, return_code, duration)
+        output = stdout + stderr
+        if self.truncated_lines:
+            output = (
+                f"[{self.truncated_lines} earlier lines not kept by run_stream]\n"
+                + output
+            )
+        self.conn._log_cmd_metrics(
+            self.command, start_time, duration, return_code, output
+        )
+        ConnectionUtils.log_cmdlog(
+            self.conn.hostname,
+            self.command,
+            return_code,
+            output,
+            self.custom_logfile,
+        )
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Static facts about a host, collected with a single remote command.
+
+Helpers used to issue small commands such as `groups`, `date`, `uptime` or
+`hostname` again and again to learn things that do not change while the host
+is up. HostFacts runs one combined script on first use and caches its output
+process-wide per (host, user, sudo). Facts belong to the boot they were collected
+in: when a later command sees a different boot_id, or the connection had to
+reconnect, the entry is dropped and collected again on next use.
+"""
+import threading
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
+from autoval.lib.utils.autoval_log import AutovalLog
+
+DMI_FIELDS = [
+    "sys_vendor",
+    "product_name",
+    "product_version",
+    "board_vendor",
+    "board_name",
+    "bios_vendor",
+    "bios_version",
+    "bios_date",
+]
+# Every line prints "<fact>=<value>"
+FACTS_SCRIPT = "\n".join(
+    [
+        'echo "boot_id=$(cat /proc/sys/kernel/random/boot_id 2>/dev/null)"',
+        'echo "uname=$(uname -a)"',
+        'echo "kernel=$(uname -r)"',
+        'echo "arch=$(uname -m)"',
+        'echo "hostname=$(hostname 2>/dev/null || uname -n)"',
+        'echo "user=$(id -un)"',
+        'echo "uid=$(id -u)"',
+        'echo "groups=$(id -Gn)"',
+        'echo "path=$PATH"',
+        'echo "uptime=$(cut -f1 -d. /proc/uptime)"',
+        'echo "date=$(date +%s)"',
+        '(. /etc/os-release 2>/dev/null; echo "os_id=$ID"; '
+        'echo "os_version=$VERSION_ID"; echo "os_name=$PRETTY_NAME")',
+        f"for f in {' '.join(DMI_FIELDS)}; do "
+        'echo "$f=$(cat /sys/class/dmi/id/$f 2>/dev/null)"; done',
+    ]
+)
+# Only run where the connection asks for it, see check_sudo_fact of
+# ConnectionAbstract. Root does not need to ask sudo.
+SUDO_FACT_SCRIPT = (
+    'if [ "$(id -u)" = 0 ] || sudo -n true >/dev/null 2>&1; '
+    "then echo sudo=1; else echo sudo=0; fi"
+)
+
+
+class HostFacts:
+    _lock = threading.Lock()
+    # (hostname, user, sudo) -> facts
+    _cache: Dict[Hashable, Dict[str, str]] = {}
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def get(cls, conn, refresh: bool = False) -> Dict[str, str]:
+        """
+        Returns the facts of the host behind conn, collecting them with one
+        command if they are not cached yet.
+
+        Besides the raw values, "last_reboot" holds the boot time in epoch
+        seconds, like ConnectionAbstract.get_last_reboot(), and "is_root"
+        is "1" if the user is root or in the root group. "sudo" is only
+        collected if conn.check_sudo_fact is set.
+
+        Facts of a run that failed are returned but not cached, so the next
+        call tries again.
+        """
+        key = cls._key(conn)
+        if not refresh:
+            facts = cls.get_cached(conn)
+            if facts is not None:
+                return facts
+        start_time = time.time()
+        script = FACTS_SCRIPT
+        if getattr(conn, "check_sudo_fact", True):
+            script += "\n" + SUDO_FACT_SCRIPT
+        result = conn._run_script(script, ignore_status=True)
+        facts = cls.parse(result.stdout)
+        if result.return_code != 0 or not cls.is_complete(facts):
+            AutovalLog.log_debug(
+                f"Failed to collect host facts of {conn.hostname}, "
+                f"exit status {result.return_code}"
+            )
+            return facts
+        AutovalLog.log_debug(
+            f"Collected host facts of {conn.hostname} in {time.time() - start_time:.2f}s"
+        )
+        with cls._lock:
+            cls._cache[key] = facts
+        return dict(facts)
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def get_cached(cls, conn) -> Optional[Dict[str, str]]:
+        with cls._lock:
+            facts = cls._cache.get(cls._key(conn))
+        return dict(facts) if facts is not None else None
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def check_boot_id(cls, conn, boot_id: str) -> bool:
+        """
+        Drops the cached facts of conn if they were collected in another boot
+        and returns True in that case
+        """
+        with cls._lock:
+            facts = cls._cache.get(cls._key(conn))
+            if facts is not None and facts.get("boot_id") != boot_id:
+                AutovalLog.log_debug(
+                    f"{conn.hostname} rebooted, dropping cached host facts"
+                )
+                del cls._cache[cls._key(conn)]
+                return True
+        return False
+
+    @classmethod
+    def invalidate(cls, hostname: str) -> None:
+        with cls._lock:
+            for key in [key for key in cls._cache if key[0] == hostname]:
+                del cls._cache[key]
+
+    @classmethod
+    def parse(cls, output: str) -> Dict[str, str]:
+        facts = {}
+        for line in output.splitlines():
+            name, sep, value = line.partition("=")
+            if sep:
+                facts[name.strip()] = value.strip()
+        try:
+            facts["last_reboot"] = str(int(facts["date"]) - int(facts["uptime"]))
+        except (KeyError, ValueError):
+            pass
+        is_root = facts.get("uid") == "0" or "root" in facts.get("groups", "").split()
+        facts["is_root"] = "1" if is_root else "0"
+        return facts
+
+    @classmethod
+    def is_complete(cls, facts: Dict[str, str]) -> bool:
+        """
+        Returns True if facts hold the output of a complete facts script
+        """
+        return bool(facts.get("uid"))
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def _key(cls, conn) -> Tuple[str, Optional[str], bool]:
+        # Commands of a sudo connection run as root, their facts differ
+        return (
+            conn.hostname,
+            getattr(conn, "user", None),
+            bool(getattr(conn, "sudo", False)),
+        )
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""
+Reachability of many hosts at once, without ping subprocesses.
+
+Reachability.probe() resolves all hosts concurrently, then starts a
+non-blocking TCP connect to the SSH port of every address of every host, IPv6
+and IPv4 alike, and waits for all of them
+in one selector loop with a sub-second deadline. A host is reachable as soon
+as one of its addresses completes the handshake or actively refuses it: a
+refusal also proves that the host is up. With "icmp" set, an ICMP echo is
+sent along, through an unprivileged ping socket or a raw socket when
+running as root, so hosts without sshd are found as well.
+
+Defaults come from the "reachability" site setting:
+    {
+        "port": 22,
+        "timeout": 0.5,
+        "icmp": false
+    }
+"""
+import errno
+import os
+import selectors
+import socket
+import struct
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.site_utils import SiteUtils
+
+DEFAULT_REACHABILITY_SETTINGS = {
+    "port": 22,
+    "timeout": 0.5,
+    "icmp": False,
+}
+# connect() results proving that the host itself answered
+TCP_ALIVE_ERRNOS = (0, errno.ECONNREFUSED)
+# Name lookups running at the same time
+MAX_RESOLVE_THREADS = 32
+ICMP_ECHO_REQUEST = {socket.AF_INET: 8, socket.AF_INET6: 128}
+ICMP_ECHO_REPLY = {socket.AF_INET: 0, socket.AF_INET6: 129}
+ICMP_PROTO = {
+    socket.AF_INET: socket.IPPROTO_ICMP,
+    socket.AF_INET6: socket.IPPROTO_ICMPV6,
+}
+
+
+class Reachability:
+    # pyre-fixme[4]: Attribute must be annotated.
+    _settings = None
+
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    def get_settings(cls):
+        if cls._settings is None:
+            settings = dict(DEFAULT_REACHABILITY_SETTINGS)
+            try:
+                settings.update(
+                    SiteUtils.get_site_setting("reachability", raise_error=False)
+                    or {}
+                )
+            except Exception:
+                pass
+            cls._settings = settings
+        return cls._settings
+
+    @classmethod
+    def probe(
+        cls,
+        addrs: List[str],
+        port: Optional[int] = None,
+        timeout: Optional[float] = None,
+        icmp: Optional[bool] = None,
+        open_only: bool = False,
+    ) -> Dict[str, Optional[float]]:
+        """
+        Probes all addrs concurrently and returns, for each of them, the
+        round-trip latency in seconds of the first answer, or None if it did
+        not answer within timeout or could not be resolved. With open_only
+        set, only completed TCP handshakes count as an answer, not refusals.
+        """
+        alive_errnos = (0,) if open_only else TCP_ALIVE_ERRNOS
+        settings = cls.get_settings()
+        port = settings["port"] if port is None else port
+        timeout = settings["timeout"] if timeout is None else timeout
+        icmp = settings["icmp"] if icmp is None else icmp
+        latencies: Dict[str, Optional[float]] = {addr: None for addr in addrs}
+        targets = cls._resolve_all(set(addrs), port)
+        sel = selectors.DefaultSelector()
+        # Number of probes still in flight per addr
+        pending: Dict[str, int] = {}
+        icmp_targets: Dict[Tuple[int, str], str] = {}
+        start_time = time.time()
+        try:
+            for addr, sockaddrs in targets.items():
+                for family, sockaddr in sockaddrs:
+                    err, sock = cls._connect(family, sockaddr)
+                    if sock is not None:
+                        sel.register(
+                            sock, selectors.EVENT_WRITE, ("tcp", addr, time.time())
+                        )
+                        pending[addr] = pending.get(addr, 0) + 1
+                    elif err in alive_errnos and latencies[addr] is None:
+                        # Answered right away, e.g. a local address
+                        latencies[addr] = time.time() - start_time
+            if icmp:
+                icmp_targets = cls._start_icmp(sel, targets, pending, start_time)
+            deadline = start_time + timeout
+            while any(
+                count and latencies[addr] is None for addr, count in pending.items()
+            ):
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                for key, _ in sel.select(wait):
+                    if key.data[0] == "icmp":
+                        addr = cls._read_icmp(key, icmp_targets)
+                        latency = time.time() - start_time
+                    else:
+                        _, addr, started = key.data
+                        pending[addr] -= 1
+                        sel.unregister(key.fileobj)
+                        sock = key.fileobj
+                        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                        sock.close()
+                        if err not in alive_errnos:
+                            continue
+                        latency = time.time() - started
+                    if addr is not None and latencies[addr] is None:
+                        latencies[addr] = latency
+        finally:
+            for key in list(sel.get_map().values()):
+                key.fileobj.close()
+            sel.close()
+        AutovalLog.log_debug(
+            "Probed %d hosts in %.3fs, %d reachable"
+            % (
+                len(latencies),
+                time.time() - start_time,
+                len([1 for latency in latencies.values() if latency is not None]),
+            )
+        )
+        return latencies
+
+    @classmethod
+    def is_reachable(
+        cls,
+        addr: str,
+        port: Optional[int] = None,
+        timeout: Optional[float] = None,
+        open_only: bool = False,
+    ) -> bool:
+        """
+        Returns whether addr answers at all, see probe(). A refused port
+        counts as an answer unless open_only is set: the host is up even if
+        the service is not.
+        """
+        return (
+            cls.probe([addr], port=port, timeout=timeout, open_only=open_only)[addr]
+            is not None
+        )
+
+    @classmethod
+    def _resolve_all(
+        cls, addrs: Iterable[str], port: int
+    ) -> Dict[str, List[Tuple[int, Tuple]]]:
+        """
+        Resolves addrs in a thread pool, so a slow lookup of one of them
+        does not hold up the others
+        """
+        addrs = list(addrs)
+        if len(addrs) <= 1:
+            return {addr: cls._resolve(addr, port) for addr in addrs}
+        with ThreadPoolExecutor(
+            max_workers=min(len(addrs), MAX_RESOLVE_THREADS)
+        ) as executor:
+            futures = {
+                addr: executor.submit(cls._resolve, addr, port) for addr in addrs
+            }
+        return {addr: future.result() for addr, future in futures.items()}
+
+    @classmethod
+    def _resolve(cls, addr: str, port: int) -> List[Tuple[int, Tuple]]:
+        """
+        Returns the (family, sockaddr) of every address of addr, IPv6 first
+        like the ping6-then-ping order used so far
+        """
+        try:
+            infos = socket.getaddrinfo(addr, port, type=socket.SOCK_STREAM)
+        except (socket.gaierror, UnicodeError):
+            return []
+        sockaddrs = []
+        for family, _, _, _, sockaddr in infos:
+            if (family, sockaddr) not in sockaddrs:
+                sockaddrs.append((family, sockaddr))
+        return sorted(sockaddrs, key=lambda info: info[0] != socket.AF_INET6)
+
+    @classmethod
+    def _connect(
+        cls, family: int, sockaddr: Tuple
+    ) -> Tuple[int, Optional[socket.socket]]:
+        """
+        Starts a non-blocking connect to sockaddr. Returns the socket while
+        the connect is in progress, or the error it completed with at once.
+        """
+        try:
+            sock = socket.socket(family, socket.SOCK_STREAM)
+        except OSError as e:
+            return (e.errno, None)
+        sock.setblocking(False)
+        err = sock.connect_ex(sockaddr)
+        if err == errno.EINPROGRESS:
+            return (err, sock)
+        sock.close()
+        return (err, None)
+
+    @classmethod
+    def _start_icmp(
+        cls,
+        sel: selectors.BaseSelector,
+        targets: Dict[str, List[Tuple[int, Tuple]]],
+        pending: Dict[str, int],
+        start_time: float,
+    ) -> Dict[Tuple[int, str], str]:
+        """
+        Sends one ICMP echo request to the first address of each family of
+        every target. Returns the addr of each (family, ip) an echo went to.
+        """
+        icmp_targets = {}
+        socks = {}
+        for addr, sockaddrs in targets.items():
+            for family, sockaddr in sockaddrs:
+                if (family, sockaddr[0]) in icmp_targets:
+                    continue
+                if family not in socks:
+                    socks[family] = cls._icmp_socket(family)
+                    if socks[family] is not None:
+                        sel.register(socks[family], selectors.EVENT_READ, ("icmp",))
+                sock = socks[family]
+                if sock is None:
+                    continue
+                packet = cls._echo_request(family)
+                try:
+                    sock.sendto(packet, (sockaddr[0], 0) + tuple(sockaddr[2:]))
+                except OSError:
+                    continue
+                icmp_targets[(family, sockaddr[0])] = addr
+                pending[addr] = pending.get(addr, 0) + 1
+        return icmp_targets
+
+    @classmethod
+    def _icmp_socket(cls, family: int) -> Optional[socket.socket]:
+        """
+        Returns an unprivileged ping socket, or a raw socket when allowed
+        """
+        for sock_type in (socket.SOCK_DGRAM, socket.SOCK_RAW):
+            try:
+                sock = socket.socket(family, sock_type, ICMP_PROTO[family])
+            except OSError:
+                continue
+            sock.setblocking(False)
+            return sock
+        AutovalLog.log_debug("No ICMP socket available, probing with TCP only")
+        return None
+
+    @classmethod
+    def _echo_request(cls, family: int) -> bytes:
+        ident = os.getpid() & 0xFFFF
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST[family], 0, 0, ident, 1)
+        payload = b"autoval"
+        if family == socket.AF_INET6:
+            # The kernel fills in the ICMPv6 checksum
+            return header + payload
+        checksum = cls._checksum(header + payload)
+        return (
+            struct.pack("!BBHHH", ICMP_ECHO_REQUEST[family], 0, checksum, ident, 1)
+            + payload
+        )
+
+    @classmethod
+    def _checksum(cls, data: bytes) -> int:
+        if len(data) % 2:
+            data += b"\0"
+        total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+        total = (total >> 16) + (total & 0xFFFF)
+        total += total >> 16
+        return ~total & 0xFFFF
+
+    @classmethod
+    def _read_icmp(
+        cls, key: selectors.SelectorKey, icmp_targets: Dict[Tuple[int, str], str]
+    ) -> Optional[str]:
+        """
+        Reads one packet from an ICMP socket and returns the addr it is an
+        echo reply from, if any
+        """
+        sock = key.fileobj
+        try:
+            data, sender = sock.recvfrom(2048)
+        except OSError:
+            return None
+        family = sock.family
+        if family == socket.AF_INET and sock.type == socket.SOCK_RAW:
+            # Raw IPv4 sockets also return the IP header
+            data = data[(data[0] & 0x0F) * 4 :]
+        if not data or data[0] != ICMP_ECHO_REPLY[family]:
+            return None
+        return icmp_targets.get((family, sender[0]))
@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+"""
+Watches many hosts and BMCs through a power cycle at once.
+
+Every target walks through the states
+    up -> down -> back -> healthy
+(or ends as failed). One loop probes the ports of all targets that are up or
+down together, see Reachability, and only targets whose state can change get
+an SSH round trip: checking the boot time of a host that still answers, or
+reconnecting to a host whose port came back. Those, and the health checks of
+hosts that are back, run in a thread pool, so cycling a rack takes about as
+long as its slowest host.
+
+A target with a known previous boot time is also recognized as back when it
+rebooted too fast for the probes to ever see it down. Targets without a port
+to probe, e.g. thrift or local connections, are checked with a short
+reconnect instead, like the reconnect loops did before.
+
+Example:
+    watcher = RebootWatcher()
+    for host in hosts:
+        watcher.add(host.hostname, host.connection, host.get_last_reboot(),
+                    health_check=host.check_health)
+    ... power cycle the rack ...
+    watcher.wait(timeout=1200)
+    watcher.raise_on_failure()
+"""
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from autoval.lib.connection.reachability import Reachability
+from autoval.lib.utils.autoval_exceptions import AutoValException
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.autoval_utils import MAX_THREADS
+
+UP = "up"
+DOWN = "down"
+BACK = "back"
+HEALTHY = "healthy"
+FAILED = "failed"
+STATE_ORDER = [UP, DOWN, BACK, HEALTHY]
+
+POLL_INTERVAL = 1
+PROBE_TIMEOUT = 0.5
+# Seconds between boot time checks of a target that still answers
+REBOOT_CHECK_INTERVAL = 10
+RECONNECT_TIMEOUT = 30
+
+
+class WatchedTarget:
+    def __init__(
+        self,
+        name: str,
+        # pyre-fixme[2]: Parameter must be annotated.
+        connection,
+        last_reboot: Optional[str] = None,
+        health_check: Optional[Callable[[], None]] = None,
+        timeout: Optional[float] = None,
+    ) -> None:
+        self.name = name
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.connection = connection
+        self.last_reboot = last_reboot
+        self.health_check = health_check
+        self.timeout = timeout
+        self.state: str = UP
+        # state -> epoch time it was entered
+        self.transitions: Dict[str, float] = {UP: time.time()}
+        self.error: Optional[Exception] = None
+        self.last_check: float = 0
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.probe_target = connection._get_probe_target()
+        self.future: Optional[Future] = None
+
+    def mark(self, state: str) -> None:
+        if state != self.state:
+            self.state = state
+            self.transitions[state] = time.time()
+            AutovalLog.log_info(f"{self.name} is {state}")
+
+    def reached(self, state: str) -> bool:
+        return self.state == FAILED or (
+            STATE_ORDER.index(self.state) >= STATE_ORDER.index(state)
+        )
+
+
+class RebootWatcher:
+    def __init__(self, max_workers: int = MAX_THREADS) -> None:
+        self.targets: Dict[str, WatchedTarget] = {}
+        self.max_workers = max_workers
+
+    def add(
+        self,
+        name: str,
+        # pyre-fixme[2]: Parameter must be annotated.
+        connection,
+        last_reboot: Optional[str] = None,
+        health_check: Optional[Callable[[], None]] = None,
+        timeout: Optional[float] = None,
+    ) -> WatchedTarget:
+        """
+        Watches the host behind connection. last_reboot, if known, is its
+        boot time before the cycle, see ConnectionAbstract.get_last_reboot().
+        health_check is run once the host is back; without one it counts as
+        healthy as soon as it is back. timeout, if set, is the deadline of
+        this target, shorter than the one given to wait().
+        """
+        target = WatchedTarget(name, connection, last_reboot, health_check, timeout)
+        self.targets[name] = target
+        return target
+
+    def wait(self, timeout: float, until: str = HEALTHY) -> Dict[str, WatchedTarget]:
+        """
+        Tracks all targets until each of them reached the state until (or
+        failed) or timeout seconds have passed, and returns them. Targets
+        that did not get there in time are marked failed, without waiting
+        for SSH round trips or health checks still running for them.
+        """
+        start_time = time.time()
+        deadline = start_time + timeout
+        executor = ThreadPoolExecutor(max_workers=max(1, self.max_workers))
+        try:
+            while True:
+                self._collect()
+                active = [t for t in self.targets.values() if not t.reached(until)]
+                now = time.time()
+                for target in active:
+                    target_deadline = deadline
+                    if target.timeout is not None:
+                        target_deadline = min(deadline, start_time + target.timeout)
+                    if now >= target_deadline:
+                        target.error = AutoValException(
+                            f"{target.name} did not get {until} within "
+                            f"{int(target_deadline - start_time)} seconds, "
+                            f"last state: {target.state}"
+                        )
+                        target.mark(FAILED)
+                active = [t for t in active if t.state != FAILED]
+                if not active:
+                    break
+                self._step(executor, active, until)
+                time.sleep(max(0, min(POLL_INTERVAL, deadline - time.time())))
+        finally:
+            # Checks still in flight cannot be interrupted, leave them to
+            # finish in the background
+            for target in self.targets.values():
+                if target.future is not None:
+                    target.future.cancel()
+                    target.future = None
+            executor.shutdown(wait=False)
+        return self.targets
+
+    def get_transitions(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns, for every target, the epoch time each state was entered
+        """
+        return {
+            name: dict(target.transitions) for name, target in self.targets.items()
+        }
+
+    def raise_on_failure(self) -> None:
+        failed = [t for t in self.targets.values() if t.state == FAILED]
+        if failed:
+            raise AutoValException(
+                "Hosts not healthy after the cycle: "
+                + ", ".join(f"{t.name} ({t.error})" for t in failed)
+            )
+
+    def _step(
+        self, executor: ThreadPoolExecutor, active: List[WatchedTarget], until: str
+    ) -> None:
+        idle = [t for t in active if t.future is None]
+        answered = self._probe([t for t in idle if t.state in (UP, DOWN)])
+        now = time.time()
+        for target in idle:
+            if target.state == UP and target.probe_target is None:
+                target.future = executor.submit(self._check_down, target)
+            elif target.state == UP:
+                if not answered.get(target.name, True):
+                    target.mark(DOWN)
+                elif (
+                    target.last_reboot is not None
+                    and now - target.last_check >= REBOOT_CHECK_INTERVAL
+                ):
+                    target.last_check = now
+                    target.future = executor.submit(self._check_rebooted, target)
+            elif target.state == DOWN and until != DOWN:
+                if answered.get(target.name, True):
+                    target.future = executor.submit(self._reconnect, target)
+            elif target.state == BACK:
+                if target.health_check is None:
+                    target.mark(HEALTHY)
+                else:
+                    target.future = executor.submit(target.health_check)
+
+    def _collect(self) -> None:
+        """
+        Applies the results of finished SSH round trips and health checks
+        """
+        for target in self.targets.values():
+            future = target.future
+            if future is None or not future.done():
+                continue
+            target.future = None
+            if target.state == FAILED:
+                continue
+            error = future.exception()
+            if target.state == BACK:
+                if error is None:
+                    target.mark(HEALTHY)
+                else:
+                    target.error = error
+                    target.mark(FAILED)
+            elif error is None and future.result():
+                target.mark(future.result())
+            elif error is not None:
+                AutovalLog.log_debug(f"{target.name} not back yet: {error}")
+
+    def _probe(self, targets: List[WatchedTarget]) -> Dict[str, bool]:
+        """
+        Probes all targets at once, grouped by port. Targets without a probe
+        target are left out and count as answering.
+        """
+        by_port: Dict[int, List[WatchedTarget]] = {}
+        for target in targets:
+            if target.probe_target is not None:
+                by_port.setdefault(target.probe_target[1], []).append(target)
+        answered = {}
+        for port, port_targets in by_port.items():
+            latencies = Reachability.probe(
+                [t.probe_target[0] for t in port_targets],
+                port=port,
+                timeout=PROBE_TIMEOUT,
+                icmp=False,
+            )
+            for target in port_targets:
+                answered[target.name] = latencies[target.probe_target[0]] is not None
+        return answered
+
+    # The checks below run in the thread pool and return the state the
+    # target moved to, or None if it did not move
+
+    def _check_rebooted(self, target: WatchedTarget) -> Optional[str]:
+        return BACK if self._has_rebooted(target) else None
+
+    def _check_down(self, target: WatchedTarget) -> Optional[str]:
+        """
+        Stands in for the port probe of a target without a probe target: it
+        is down once it cannot be reconnected to, and back if it rebooted
+        in between
+        """
+        try:
+            target.connection.reconnect(timeout=RECONNECT_TIMEOUT)
+        except Exception:
+            return DOWN
+        if target.last_reboot is not None and self._has_rebooted(target):
+            return BACK
+        return None
+
+    def _reconnect(self, target: WatchedTarget) -> Optional[str]:
+        """
+        Reconnects to a target whose port came back. It counts as back if it
+        rebooted, or if its boot time is not known.
+        """
+        target.connection.reconnect(timeout=RECONNECT_TIMEOUT)
+        if target.last_reboot is None or self._has_rebooted(target):
+            return BACK
+        raise AutoValException(f"{target.name} answers but did not reboot")
+
+    def _has_rebooted(self, target: WatchedTarget) -> bool:
+        connection = target.connection
+        return connection.has_rebooted(
+            target.last_reboot, connection.get_last_reboot()
+        )
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Waiting for a host to come back, with cheap probes and adaptive intervals.
+
+ConnectionAbstract.reconnect() used to attempt a full SSH handshake followed
+by /bin/true every 10 seconds. ReconnectWaiter probes the SSH port instead
+(see Reachability), which costs one SYN, and only lets the connection try to
+authenticate once the port answers. Intervals between probes start short,
+grow exponentially up to "max_interval" while the host stays down, and drop
+back to "min_interval" once the host has been down for most of the time it
+needed on its previous come-back, so a host is usually noticed within a
+second of its sshd starting. All of it runs within a single deadline.
+
+Intervals can be tuned through the "reconnect" site setting:
+    {
+        "min_interval": 0.5,
+        "max_interval": 10,
+        "probe_timeout": 1,
+        "expected_ratio": 0.8
+    }
+"""
+import threading
+import time
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+
+from autoval.lib.connection.reachability import Reachability
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.site_utils import SiteUtils
+
+DEFAULT_RECONNECT_SETTINGS = {
+    "min_interval": 0.5,
+    "max_interval": 10,
+    "probe_timeout": 1,
+    # Poll at min_interval once this share of the last downtime has passed
+    "expected_ratio": 0.8,
+}
+
+
+class ReconnectTimes(NamedTuple):
+    """
+    Epoch times of a successful reconnect: when waiting started, when the
+    host first answered on its port and when the connection was usable again
+    """
+
+    start: float
+    port_open: float
+    connected: float
+
+
+class ReconnectWaiter:
+    # pyre-fixme[4]: Attribute must be annotated.
+    _settings = None
+    _lock = threading.Lock()
+    # hostname -> seconds the host needed to come back last time
+    _downtimes: Dict[str, float] = {}
+
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    def get_settings(cls):
+        if cls._settings is None:
+            settings = dict(DEFAULT_RECONNECT_SETTINGS)
+            try:
+                settings.update(
+                    SiteUtils.get_site_setting("reconnect", raise_error=False) or {}
+                )
+            except Exception:
+                pass
+            cls._settings = settings
+        return cls._settings
+
+    @classmethod
+    def wait(
+        cls,
+        hostname: str,
+        probe_target: Optional[Tuple[str, int]],
+        connect: Callable[[float], None],
+        timeout: float,
+    ) -> Optional[ReconnectTimes]:
+        """
+        Waits until connect() succeeds and returns the times of the
+        reconnect, or None if it did not succeed within timeout seconds.
+
+        connect() is passed the seconds left until the deadline, which it
+        must not overrun, and is only called while probe_target, an
+        (address, port), accepts connections. Without a probe_target it is
+        called on every attempt.
+        """
+        settings = cls.get_settings()
+        start = time.time()
+        deadline = start + timeout
+        with cls._lock:
+            expected = cls._downtimes.get(hostname)
+        interval = settings["min_interval"]
+        attempt = 0
+        while True:
+            attempt += 1
+            port_open = probe_target is None or cls._probe(probe_target, deadline)
+            if port_open and time.time() < deadline:
+                port_open_time = time.time()
+                try:
+                    connect(deadline - port_open_time)
+                except Exception as e:
+                    AutovalLog.log_debug(
+                        f"Reconnect attempt {attempt} to {hostname} failed: {e}"
+                    )
+                else:
+                    times = ReconnectTimes(start, port_open_time, time.time())
+                    if attempt > 1:
+                        with cls._lock:
+                            cls._downtimes[hostname] = times.port_open - start
+                    return times
+            now = time.time()
+            if now >= deadline:
+                return None
+            if port_open or (
+                expected is not None
+                and now - start >= expected * settings["expected_ratio"]
+            ):
+                # Booting or expected back any moment, keep polling closely
+                interval = settings["min_interval"]
+            else:
+                interval = min(settings["max_interval"], interval * 2)
+            time.sleep(min(interval, deadline - now))
+
+    @classmethod
+    def _probe(cls, probe_target: Tuple[str, int], deadline: float) -> bool:
+        """
+        Returns whether the port accepts connections. ICMP replies and
+        refused connects do not count: a booting host answers both long
+        before its sshd is up.
+        """
+        addr, port = probe_target
+        timeout = min(cls.get_settings()["probe_timeout"], deadline - time.time())
+        latencies = Reachability.probe(
+            [addr], port=port, timeout=max(0.01, timeout), icmp=False, open_only=True
+        )
+        return latencies[addr] is not None
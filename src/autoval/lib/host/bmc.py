@@ -445,13 +445,11 @@ class BMC:
         while time.time() < end_time:
             # Sleep for some time to let shutdown complete
             time.sleep(10)
-            try:
-                self.host.ping()
-            except Exception:
+            # Off once the host stops answering at all, as with ping: an
+            # sshd that already stopped does not mean the power is off
+            if not self.host.is_reachable():
                 success = 1
                 break
-            else:
-                continue
         time1 = time.time()
         self.result_handler.add_cmd_metric(
             "disconnect after %s" % cmd, time0, time1 - time0, 0, ""
@@ -524,13 +522,11 @@ class BMC:
         while time.time() < end_time:
             # Sleep for some time to let shutdown complete
             time.sleep(40)
-            try:
-                self.host.ping()
-            except Exception:
+            # Off once the host stops answering at all, as with ping: an
+            # sshd that already stopped does not mean the power is off
+            if not self.host.is_reachable():
                 success = 1
                 break
-            else:
-                continue
         if not success:
             raise Exception("Failed to power down system")
         AutovalLog.log_info("Power Down complete")
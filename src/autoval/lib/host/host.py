@@ -1,7 +1,9 @@
 # (c) Meta Platforms, Inc. and affiliates. Confidential and proprietary.
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
 from autoval.lib.connection.connection_dispatcher import ConnectionDispatcher
+from autoval.lib.connection.reachability import Reachability
+from autoval.lib.host.host_warmup import HostWarmup
 from autoval.lib.host.system import System
 from autoval.lib.test_args import TEST_HOSTS
 from autoval.lib.utils.decorators import retry
@@ -30,26 +32,80 @@ class Host:
     @classmethod
     # pyre-fixme[24]: Generic type `list` expects 1 type parameter, use
     #  `typing.List[<element type>]` to avoid runtime subscripting errors.
-    def get_hosts_objs(cls, skip_health_check: bool = False) -> List:
+    def get_hosts_objs(
+        cls, skip_health_check: bool = False, connect: bool = False
+    ) -> List:
+        """
+        Returns a Host for every test host.
+
+        With connect set, every host must answer to ping. Hosts are built,
+        probed and get their first SSH sessions concurrently, see HostWarmup.
+        Hosts that did not answer during the warm-up are pinged again with
+        the usual retries.
+        """
+        if not HostWarmup.is_enabled():
+            hosts = [Host(_h) for _h in TEST_HOSTS]
+            if connect:
+                latencies = cls.probe_hosts(hosts)
+                for host in hosts:
+                    if latencies.get(host.hostname) is None:
+                        host.ping()
+            return hosts
+        reports = HostWarmup.run(TEST_HOSTS, Host, connect=connect)
         hosts = []
-        for _h in TEST_HOSTS:
-            hosts.append(Host(_h))
+        for report, _h in zip(reports, TEST_HOSTS):
+            host = report.host if report.host is not None else Host(_h)
+            if connect and not report.reachable:
+                host.ping()
+            hosts.append(host)
         return hosts
 
     @retry(tries=6, sleep_seconds=10)
     # pyre-fixme[3]: Return type must be annotated.
     def ping(self):
-        try:
-            out = self.localhost.run("ping6 -c 3 -i 0.2 %s" % self.hostname)
-        except Exception:
-            out = self.localhost.run("ping -c 3 -i 0.2 %s" % self.hostname)
-        return out
+        return self.ping_once(self.hostname)
 
     @retry(tries=6, sleep_seconds=10)
     # pyre-fixme[3]: Return type must be annotated.
     def ping_bmc(self):
+        return self.ping_once(self.oob_addr)
+
+    # pyre-fixme[3]: Return type must be annotated.
+    # pyre-fixme[2]: Parameter must be annotated.
+    def ping_once(self, addr):
+        """
+        Checks that addr answers, with a TCP probe of its SSH port first,
+        see Reachability. Hosts that do not answer there are pinged.
+        """
+        latency = Reachability.probe([addr])[addr]
+        if latency is not None:
+            return "%s is reachable, answered in %.2f ms" % (addr, latency * 1000)
         try:
-            out = self.localhost.run("ping6 -c 3 -i 0.2 %s" % self.oob_addr)
+            out = self.localhost.run("ping6 -c 3 -i 0.2 %s" % addr)
         except Exception:
-            out = self.localhost.run("ping -c 3 -i 0.2 %s" % self.oob_addr)
+            out = self.localhost.run("ping -c 3 -i 0.2 %s" % addr)
         return out
+
+    def is_reachable(self, addr: Optional[str] = None) -> bool:
+        """
+        Returns whether addr, the host by default, answers right now. Unlike
+        ping(), a host that does not answer is not retried.
+
+        Like ping(), which it replaces in the power-off loops, this checks
+        whether the host is up, not whether sshd runs: a refused SSH port
+        counts as an answer, and a host without sshd is still pinged.
+        """
+        try:
+            self.ping_once(addr or self.hostname)
+        except Exception:
+            return False
+        return True
+
+    @classmethod
+    # pyre-fixme[24]: Generic type `list` expects 1 type parameter.
+    def probe_hosts(cls, hosts: List) -> Dict[str, Optional[float]]:
+        """
+        Probes all hosts at once and returns the latency in seconds of each
+        hostname, None for hosts that did not answer, see Reachability.
+        """
+        return Reachability.probe([host.hostname for host in hosts])
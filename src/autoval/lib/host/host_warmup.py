@@ -0,0 +1,213 @@
+# (c) Meta Platforms, Inc. and affiliates. Confidential and proprietary.
+"""
+Concurrent start-up of the test hosts.
+
+Building the Host objects, checking that every DUT answers and opening the
+first SSH session used to happen one host at a time, lazily on first use.
+HostWarmup does all of it for every DUT and every oob*_addr BMC in parallel,
+bounded by a global deadline. The sessions opened here are returned to
+SSHConnectionPool, so the first command of the test skips the handshake.
+
+Tuned through the "host_warmup" site setting:
+    {
+        "enabled": true,     # false restores the sequential ping of each host
+        "deadline": 300,     # seconds for the whole warm-up
+        "max_workers": 32    # hosts warmed up at the same time
+    }
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.site_utils import SiteUtils
+
+DEFAULT_WARMUP_SETTINGS = {
+    "enabled": True,
+    "deadline": 300,
+    "max_workers": 32,
+}
+
+
+class HostReadiness:
+    """
+    Outcome of the warm-up of a single host: which phases passed and how long
+    each of them took.
+    """
+
+    def __init__(self, hostname: str) -> None:
+        self.hostname = hostname
+        # pyre-fixme[4]: Attribute annotation cannot contain `Any`.
+        self.host: Optional[Any] = None
+        # phase -> start time and duration in seconds
+        self.start_times: Dict[str, float] = {}
+        self.timings: Dict[str, float] = {}
+        # phase -> error message, for the phases that failed
+        self.errors: Dict[str, str] = {}
+        self.done = False
+
+    @property
+    def reachable(self) -> bool:
+        return "ping" in self.timings and "ping" not in self.errors
+
+    @property
+    def ready(self) -> bool:
+        return self.done and not self.errors
+
+    # pyre-fixme[2]: Parameter annotation cannot contain `Any`.
+    def measure(self, phase: str, func: Callable[[], Any]) -> bool:
+        start_time = time.time()
+        self.start_times[phase] = start_time
+        try:
+            func()
+            return True
+        except Exception as e:
+            self.errors[phase] = str(e)
+            return False
+        finally:
+            self.timings[phase] = time.time() - start_time
+
+    def summary(self) -> str:
+        status = "ready" if self.ready else "not ready"
+        if not self.done:
+            status = "deadline expired"
+        timings = ", ".join(
+            f"{phase} {duration:.2f}s" for phase, duration in self.timings.items()
+        )
+        msg = f"{self.hostname}: {status} ({timings})"
+        for phase, error in self.errors.items():
+            msg += f"\n    {phase}: {error}"
+        return msg
+
+
+class HostWarmup:
+    # pyre-fixme[4]: Attribute must be annotated.
+    _settings = None
+    _last_reports: List[HostReadiness] = []
+
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    def get_settings(cls):
+        if cls._settings is None:
+            settings = dict(DEFAULT_WARMUP_SETTINGS)
+            try:
+                settings.update(
+                    SiteUtils.get_site_setting("host_warmup", raise_error=False) or {}
+                )
+            except Exception:
+                pass
+            cls._settings = settings
+        return cls._settings
+
+    @classmethod
+    def is_enabled(cls) -> bool:
+        return bool(cls.get_settings()["enabled"])
+
+    @classmethod
+    def run(
+        cls,
+        # pyre-fixme[24]: Generic type `list` expects 1 type parameter.
+        host_infos: List,
+        # pyre-fixme[24]: Generic type `Callable` expects 2 type parameters.
+        host_cls: Callable,
+        connect: bool = True,
+        deadline: Optional[float] = None,
+    ) -> List[HostReadiness]:
+        """
+        Builds host_cls(host_info) for every host_info concurrently and, if
+        connect is set, probes and opens SSH sessions to each DUT and BMC.
+
+        Returns one HostReadiness per host_info, in input order. Hosts still
+        busy when the deadline expires are reported with done=False; their
+        worker keeps running in the background and the result is discarded.
+        """
+        settings = cls.get_settings()
+        if deadline is None:
+            deadline = settings["deadline"]
+        reports = [
+            HostReadiness(host_info.get("hostname") or "") for host_info in host_infos
+        ]
+        if not reports:
+            return reports
+        executor = ThreadPoolExecutor(
+            max_workers=max(1, min(settings["max_workers"], len(reports)))
+        )
+        try:
+            futures = [
+                executor.submit(cls._warm_up, report, host_info, host_cls, connect)
+                for report, host_info in zip(reports, host_infos)
+            ]
+            wait(futures, timeout=deadline)
+        finally:
+            executor.shutdown(wait=False)
+        for report in reports:
+            AutovalLog.log_info(f"Host warm-up {report.summary()}")
+        cls._last_reports = reports
+        return reports
+
+    @classmethod
+    def get_last_reports(cls) -> List[HostReadiness]:
+        """
+        Returns the readiness reports of the most recent warm-up
+        """
+        return list(cls._last_reports)
+
+    @classmethod
+    def _warm_up(
+        cls,
+        report: HostReadiness,
+        # pyre-fixme[2]: Parameter annotation cannot contain `Any`.
+        host_info: Dict[Any, Any],
+        # pyre-fixme[24]: Generic type `Callable` expects 2 type parameters.
+        host_cls: Callable,
+        connect: bool,
+    ) -> None:
+        def build() -> None:
+            report.host = host_cls(host_info)
+
+        if report.measure("build", build) and connect:
+            host = report.host
+            if host.hostname and report.measure(
+                "ping", lambda: host.ping_once(host.hostname)
+            ):
+                connection = host.connection_obj.host_connection
+                report.measure("ssh", lambda: cls._open_session(connection))
+            for index, bmc in enumerate(host.connection_obj.bmc_connections):
+                if bmc is not None:
+                    report.measure(f"bmc{index}_ssh", lambda: cls._open_session(bmc))
+            cls._log_timings(report)
+        report.done = True
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def _open_session(cls, connection) -> None:
+        """
+        Opens a pooled SSH session and hands it back to the pool idle.
+        Connections without a session pool (local, thrift) are left alone.
+        """
+        pooled_ssh = getattr(connection, "_pooled_ssh", None)
+        if pooled_ssh is None:
+            return
+        with pooled_ssh():
+            pass
+
+    @classmethod
+    def _log_timings(cls, report: HostReadiness) -> None:
+        """
+        Records every phase in cmd_metrics of the host connection as the
+        start-up latency breakdown of the test.
+        """
+        # pyre-fixme[16]: `Optional` has no attribute `connection_obj`.
+        connection = report.host.connection_obj.host_connection
+        for phase, duration in report.timings.items():
+            try:
+                connection._log_cmd_metrics(
+                    f"host warm-up {phase}",
+                    report.start_times[phase],
+                    duration,
+                    1 if phase in report.errors else 0,
+                    report.errors.get(phase, ""),
+                )
+            except Exception as e:
+                AutovalLog.log_debug(f"Failed to record warm-up metrics: {e}")
+                return
@@ -1,12 +1,13 @@
 # (c) Meta Platforms, Inc. and affiliates. Confidential and proprietary.
 import time
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
+from autoval.lib.connection.reboot_watcher import RebootWatcher
 from autoval.lib.host.bmc import BMC
 
 from autoval.lib.utils.autoval_exceptions import AutoValException, ConnectionError
 from autoval.lib.utils.autoval_log import AutovalLog
-from autoval.lib.utils.autoval_utils import AutovalUtils
+from autoval.lib.utils.autoval_utils import AutovalUtils, MAX_THREADS
 
 from autoval.lib.utils.decorators import retry
 from autoval.lib.utils.result_handler import ResultHandler
@@ -188,17 +189,79 @@ class System:
 
     # TODO - Not 100% sure if we need it
     def check_connection(self, tries: int, interval: int) -> None:
+        """
+        Runs a command on the host, up to tries times. interval seconds are
+        only waited between failed tries, a host that is up passes at once.
+        """
         for itr in range(tries):
             try:
-                time.sleep(interval)
-                if itr != tries - 1:
-                    self.run("ipmitool mc info")
-                    break
+                self.run("ipmitool mc info")
+                return
             except Exception as exc:
-                raise ConnectionError(
-                    identifier=self.hostname,
-                    message="Could not establish the connection",
-                ) from exc
+                if itr == tries - 1:
+                    raise ConnectionError(
+                        identifier=self.hostname,
+                        message="Could not establish the connection",
+                    ) from exc
+                time.sleep(interval)
+
+    def system_health_check(
+        self,
+        last_reboot: Optional[str] = None,
+        timeout: float = 1200,
+        bmc_last_reboot: Optional[str] = None,
+        bmc_reconnect_timeout: Optional[float] = None,
+    ) -> None:
+        """
+        Waits until the host is back from a cycle and healthy, see
+        check_health(). With bmc_last_reboot, the BMC is expected to reboot
+        as well and is watched alongside, within bmc_reconnect_timeout.
+        Raises AutoValException if either is not healthy within timeout.
+        """
+        watcher = RebootWatcher()
+        watcher.add(
+            self.hostname, self.connection, last_reboot, health_check=self.check_health
+        )
+        if bmc_last_reboot is not None:
+            bmc_host = self.oob.bmc_host
+            watcher.add(
+                bmc_host.hostname,
+                bmc_host,
+                bmc_last_reboot,
+                health_check=self.oob.check_health,
+                timeout=bmc_reconnect_timeout,
+            )
+        watcher.wait(timeout)
+        watcher.raise_on_failure()
+
+    @classmethod
+    def watch_cycle(
+        cls,
+        # pyre-fixme[2]: Parameter must be annotated.
+        hosts,
+        last_reboots: Optional[Dict[str, str]] = None,
+        timeout: float = 1200,
+        health_check: bool = True,
+    ) -> RebootWatcher:
+        """
+        Waits until all hosts are back from a cycle, and healthy with
+        health_check set, concurrently. last_reboots maps hostnames to their
+        boot time before the cycle. Returns the watcher, whose
+        get_transitions() holds the down/back/healthy times of every host.
+        Raises AutoValException if any host is not healthy within timeout.
+        """
+        last_reboots = last_reboots or {}
+        watcher = RebootWatcher(max_workers=max(MAX_THREADS, len(hosts)))
+        for host in hosts:
+            watcher.add(
+                host.hostname,
+                host.connection_obj.host_connection,
+                last_reboots.get(host.hostname),
+                health_check=host.check_health if health_check else None,
+            )
+        watcher.wait(timeout)
+        watcher.raise_on_failure()
+        return watcher
 
     def check_health(self) -> None:
         """
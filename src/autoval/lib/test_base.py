@@ -16,6 +16,7 @@ import six
 from autoval.lib.host.host import Host
 from autoval.lib.test_args import TEST_CONFIG, TEST_CONTROL, TEST_HOSTS, TestArgs
 from autoval.lib.test_utils.bg_runner import BgMonitor
+from autoval.lib.transport.ssh_pool import SSHConnectionPool
 from autoval.lib.utils.autoval_errors import ErrorType, TEST_SCRIPT_ERRORS
 from autoval.lib.utils.autoval_exceptions import AutoValException, TestStepError
 from autoval.lib.utils.autoval_log import AutovalLog
@@ -205,10 +206,7 @@ class TestBase:
         )
 
     def _initialize_host(self, skip_health_check: bool = False) -> None:
-        self.host_objs = Host.get_hosts_objs()
-        if self.connect_to_host:
-            for host in self.host_objs:
-                host.ping()
+        self.host_objs = Host.get_hosts_objs(connect=self.connect_to_host)
         self.host = self.host_objs[0]
         self.localhost = self.host.localhost
 
@@ -300,6 +298,9 @@ class TestBase:
             )
             self._handle_exception(ex, False)
 
+        pool_stats = SSHConnectionPool.get_stats()
+        AutovalLog.log_debug(f"SSH connection pool stats: {pool_stats}")
+        self.result_handler.add_test_results({"ssh_connection_pool": pool_stats})
         self._process_test_result()
         self.result_handler.print_test_summary()
         
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+"""
+asyncio flavour of the local transport.
+
+AsyncLocalConn starts local commands with asyncio.create_subprocess_exec, so a
+single thread can drive hundreds of child processes (pinging many hosts,
+hashing files, packing log directories) instead of blocking one thread per
+command in AutovalUtils._run_local. Commands go through the same shell-free
+fast path as AutovalUtils._popen and are logged to cmdlog and cmd_metrics like
+LocalConn commands.
+
+The number of children running at once is capped per event loop and can be
+tuned through the "async_local" site setting:
+    {
+        "max_concurrency": 64
+    }
+"""
+import asyncio
+import os
+import pathlib
+import time
+import weakref
+from typing import Callable, Dict, List, Optional
+
+from autoval.lib.connection.connection_utils import CmdResult, ConnectionUtils
+from autoval.lib.transport.local import DEFAULT_SUDO_OPTIONS, LocalConn
+from autoval.lib.utils.async_utils import AsyncJob, AsyncUtils
+from autoval.lib.utils.autoval_errors import ErrorType
+from autoval.lib.utils.autoval_exceptions import CmdError, TimeoutError
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.autoval_utils import AutovalUtils, PIPE_READ_SIZE
+from autoval.lib.utils.output_capture import OutputCapture
+from autoval.lib.utils.site_utils import SiteUtils
+
+DEFAULT_MAX_CONCURRENCY = 64
+
+
+class AsyncLocalConn(LocalConn):
+    """
+    LocalConn with a coroutine version of run_get_result. The blocking
+    methods inherited from LocalConn remain available, and run_many() drives
+    all its commands from one event loop.
+
+    Coroutines can be awaited directly or scheduled with
+    AsyncUtils.run_async_jobs, e.g.
+        AsyncUtils.run_async_jobs(
+            [AsyncJob(func=conn.async_run_get_result, args=[cmd]) for cmd in cmds]
+        )
+    """
+
+    # Event loop -> asyncio.Semaphore
+    # pyre-fixme[4]: Attribute must be annotated.
+    _loop_semaphores = weakref.WeakKeyDictionary()
+
+    def __init__(
+        self,
+        # pyre-fixme[2]: Parameter must be annotated.
+        host,
+        sudo: bool = False,
+        max_concurrency: Optional[int] = None,
+    ) -> None:
+        super().__init__(host, sudo=sudo)
+        if max_concurrency is None:
+            settings = (
+                SiteUtils.get_site_setting("async_local", raise_error=False) or {}
+            )
+            max_concurrency = settings.get("max_concurrency", DEFAULT_MAX_CONCURRENCY)
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.max_concurrency = max_concurrency
+
+    async def async_run_get_result(
+        self,
+        cmd: str,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        sudo: bool = False,
+        sudo_options: Optional[List[str]] = DEFAULT_SUDO_OPTIONS,
+        path_env: Optional[List[str]] = None,
+        line_callback: Optional[Callable[[str, str], None]] = None,
+    ) -> CmdResult:
+        """
+        Coroutine version of LocalConn.run_get_result(). Logging and error
+        semantics are the same: a command that does not complete within
+        timeout is killed, logged with exit code 124 and raises TimeoutError,
+        even with ignore_status.
+
+        line_callback, if given, is called with (line, "stdout" or "stderr")
+        for every line of output as soon as it is read, like the one of
+        run_stream().
+        """
+        cmd = self._prepare_cmd(cmd, sudo, sudo_options)
+        env = self._get_env(path_env)
+        run_cmd = cmd
+        cwd = None
+        if working_directory:
+            cmd = "cd %s && %s" % (working_directory, cmd)
+            cwd = AutovalUtils._get_cwd(working_directory)
+            if cwd is None:
+                run_cmd = cmd
+        AutovalLog.log_debug(
+            f'Running async cmd: "{cmd}", timeout: {timeout}, working_directory: {working_directory}'
+        )
+        async with self._loop_semaphore():
+            start_time = time.time()
+            stdout, stderr, return_code, timed_out = await self._async_exec(
+                run_cmd, timeout, cwd, env, line_callback
+            )
+            duration = time.time() - start_time
+        result = CmdResult(cmd, stdout, stderr, return_code, duration)
+        output = (
+            OutputCapture.summarize(stdout).rstrip()
+            + OutputCapture.summarize(stderr).rstrip()
+        )
+        self._log_cmd_metrics(cmd, start_time, duration, return_code, output)
+        ConnectionUtils.log_cmdlog(
+            self.hostname, cmd, return_code, output, custom_logfile=custom_logfile
+        )
+        if timed_out:
+            raise TimeoutError(
+                "Command [%s] timed out after [%d] seconds" % (cmd, timeout)
+            )
+        if return_code and not ignore_status:
+            msg = "Command returned non-zero exit status"
+            if "command not found" in output:
+                raise CmdError(cmd, result, msg, error_type=ErrorType.CMD_NOT_FOUND_ERR)
+            raise CmdError(cmd, result, msg)
+        return result
+
+    async def async_run_many(
+        self,
+        cmds: List[str],
+        max_concurrency: Optional[int] = None,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        sudo: bool = False,
+        sudo_options: Optional[List[str]] = DEFAULT_SUDO_OPTIONS,
+        path_env: Optional[List[str]] = None,
+    ) -> List[CmdResult]:
+        """
+        Runs cmds concurrently and returns their CmdResults in input order.
+        max_concurrency further limits how many of them run at once, on top
+        of the max_concurrency of this connection. If a command fails and
+        ignore_status is not set, the first error in input order is raised
+        after all commands have finished.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency or len(cmds) or 1)
+
+        # pyre-fixme[3]: Return type must be annotated.
+        # pyre-fixme[2]: Parameter must be annotated.
+        async def run_one(cmd):
+            async with semaphore:
+                return await self.async_run_get_result(
+                    cmd,
+                    ignore_status=ignore_status,
+                    timeout=timeout,
+                    working_directory=working_directory,
+                    custom_logfile=custom_logfile,
+                    sudo=sudo,
+                    sudo_options=sudo_options,
+                    path_env=path_env,
+                )
+
+        results = await asyncio.gather(
+            *[run_one(cmd) for cmd in cmds], return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def run_many(
+        self,
+        cmds: List[str],
+        max_concurrency: Optional[int] = None,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        get_pty: bool = False,  # Not supported by LocalConn
+        sudo: bool = False,
+        sudo_options: Optional[List[str]] = DEFAULT_SUDO_OPTIONS,
+        connection_timeout: int = 60,  # Not supported by LocalConn
+        path_env: Optional[List[str]] = None,
+    ) -> List[CmdResult]:
+        """
+        Runs cmds from a new event loop in the calling thread instead of a
+        thread pool, see async_run_many(). Called from a coroutine, where an
+        event loop is already running in this thread, the commands run from
+        the thread pool of ConnectionAbstract.run_many() instead.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            return super().run_many(
+                cmds,
+                max_concurrency=max_concurrency or self.max_concurrency,
+                ignore_status=ignore_status,
+                timeout=timeout,
+                working_directory=working_directory,
+                custom_logfile=custom_logfile,
+                sudo=sudo,
+                sudo_options=sudo_options,
+                path_env=path_env,
+            )
+        job = AsyncJob(
+            func=self.async_run_many,
+            args=[cmds, max_concurrency],
+            kwargs={
+                "ignore_status": ignore_status,
+                "timeout": timeout,
+                "working_directory": working_directory,
+                "custom_logfile": custom_logfile,
+                "sudo": sudo,
+                "sudo_options": sudo_options,
+                "path_env": path_env,
+            },
+        )
+        return AsyncUtils.run_async_jobs([job])[0]
+
+    def _loop_semaphore(self) -> asyncio.Semaphore:
+        # Semaphores are bound to the loop they are used from, so keep one
+        # per loop; AsyncUtils.run_async_jobs creates a new loop per call
+        loop = asyncio.get_running_loop()
+        if loop not in self._loop_semaphores:
+            self._loop_semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._loop_semaphores[loop]
+
+    # pyre-fixme[3]: Return type must be annotated.
+    async def _async_exec(
+        self,
+        cmd: str,
+        timeout: int,
+        cwd: Optional[str],
+        env: Optional[Dict[str, str]],
+        line_callback: Optional[Callable[[str, str], None]],
+    ):
+        """
+        Runs cmd in a new session and collects its output without blocking
+        the loop. Returns (stdout, stderr, return_code, timed_out), with
+        return code 124 if the command did not complete within timeout.
+        """
+        kwargs = {
+            "stdout": asyncio.subprocess.PIPE,
+            "stderr": asyncio.subprocess.PIPE,
+            "cwd": cwd or pathlib.Path.home(),
+            "env": dict(os.environ, **env) if env else None,
+            "start_new_session": True,
+        }
+        argv = AutovalUtils._get_argv(cmd) or ["/bin/sh", "-c", cmd]
+        try:
+            process = await asyncio.create_subprocess_exec(*argv, **kwargs)
+        except (FileNotFoundError, PermissionError):
+            # Let the shell report it, e.g. "command not found", exit 127
+            process = await asyncio.create_subprocess_exec(
+                "/bin/sh", "-c", cmd, **kwargs
+            )
+        AutovalUtils._track_process(process)
+        captures = {
+            "stdout": OutputCapture(errors="ignore"),
+            "stderr": OutputCapture(errors="ignore"),
+        }
+        readers = asyncio.gather(
+            self._read_stream(process.stdout, "stdout", captures, line_callback),
+            self._read_stream(process.stderr, "stderr", captures, line_callback),
+            process.wait(),
+        )
+        timed_out = False
+        try:
+            await asyncio.wait_for(readers, timeout)
+            return_code = process.returncode
+        except asyncio.TimeoutError:
+            AutovalUtils.kill_proc_family(process)
+            await process.wait()
+            return_code = 124
+            timed_out = True
+        return (
+            captures["stdout"].finish(),
+            captures["stderr"].finish(),
+            return_code,
+            timed_out,
+        )
+
+    async def _read_stream(
+        self,
+        stream: asyncio.StreamReader,
+        name: str,
+        captures: Dict[str, OutputCapture],
+        line_callback: Optional[Callable[[str, str], None]],
+    ) -> None:
+        partial = b""
+        while True:
+            data = await stream.read(PIPE_READ_SIZE)
+            if not data:
+                break
+            captures[name].write(data)
+            if line_callback:
+                lines = (partial + data).split(b"\n")
+                partial = lines.pop()
+                for line in lines:
+                    line_callback(line.decode("utf-8", "replace"), name)
+        if line_callback and partial:
+            line_callback(partial.decode("utf-8", "replace"), name)
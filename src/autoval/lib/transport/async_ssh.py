@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+asyncio flavour of the SSH transport.
+
+AsyncSSHConn lets a single event loop drive commands on hundreds of hosts
+without a thread per command. Exec channels are serviced with loop.add_reader
+on the paramiko channel fileno, so a coroutine waiting for a long running
+command costs nothing but a registered file descriptor. Only the blocking parts
+of paramiko (key exchange/authentication, channel open, SFTP transfers and
+handing sessions back to the pool, which may close them) are pushed to a
+dedicated thread pool shared by all loops. The loop's default executor is
+capped at a few dozen threads, far below the number of hosts one loop drives.
+
+Every host gets a per-loop semaphore capping the number of concurrent sessions,
+which can be tuned through the "async_ssh" site setting:
+    {
+        "max_sessions_per_host": 8,
+        "max_blocking_threads": 256     # size of the blocking thread pool
+    }
+"""
+import asyncio
+import functools
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from autoval.lib.connection.connection_utils import CmdResult
+from autoval.lib.transport.ssh import (
+    DEFAULT_SUDO_OPTIONS,
+    SSH,
+    SSHChannelCollector,
+    SSHChannelMux,
+    SSHConn,
+    SSHResult,
+)
+from autoval.lib.transport.ssh_pool import SSHConnectionPool
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.site_utils import SiteUtils
+
+DEFAULT_ASYNC_SSH_SETTINGS = {
+    "max_sessions_per_host": 8,
+    "max_blocking_threads": 256,
+}
+
+
+class AsyncSSHConn(SSHConn):
+    """
+    SSHConn with coroutine versions of run_get_result, read_file, get_file and
+    put_file. The blocking methods inherited from SSHConn remain available as
+    the sync facade and share the same SSHConnectionPool, so code that is not
+    async keeps working unchanged with an AsyncSSHConn.
+
+    Coroutines can be awaited directly or scheduled with
+    AsyncUtils.run_async_jobs, e.g.
+        AsyncUtils.run_async_jobs(
+            [AsyncJob(func=conn.async_run_get_result, args=["uptime"]) for conn in conns]
+        )
+    """
+
+    # Event loop -> {hostname: asyncio.Semaphore}
+    # pyre-fixme[4]: Attribute must be annotated.
+    _host_semaphores = weakref.WeakKeyDictionary()
+    # pyre-fixme[4]: Attribute must be annotated.
+    _settings = None
+    _executor: Optional[ThreadPoolExecutor] = None
+    _executor_lock = threading.Lock()
+
+    def __init__(
+        self,
+        # pyre-fixme[2]: Parameter must be annotated.
+        host,
+        skip_health_check: bool = False,
+        # pyre-fixme[2]: Parameter must be annotated.
+        user=None,
+        # pyre-fixme[2]: Parameter must be annotated.
+        password=None,
+        allow_agent: bool = True,
+        sudo: bool = False,
+        max_sessions_per_host: Optional[int] = None,
+        # pyre-fixme[2]: Parameter annotation cannot contain `Any`.
+        transport_options: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        super().__init__(
+            host,
+            skip_health_check,
+            user=user,
+            password=password,
+            allow_agent=allow_agent,
+            sudo=sudo,
+            transport_options=transport_options,
+        )
+        if max_sessions_per_host is None:
+            max_sessions_per_host = self.get_settings()["max_sessions_per_host"]
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.max_sessions_per_host = max_sessions_per_host
+
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    def get_settings(cls):
+        if cls._settings is None:
+            settings = dict(DEFAULT_ASYNC_SSH_SETTINGS)
+            try:
+                settings.update(
+                    SiteUtils.get_site_setting("async_ssh", raise_error=False) or {}
+                )
+            except Exception:
+                pass
+            cls._settings = settings
+        return cls._settings
+
+    @classmethod
+    def _get_executor(cls) -> ThreadPoolExecutor:
+        """
+        Returns the thread pool the blocking paramiko calls of all loops run
+        in. Threads are only started when needed, up to max_blocking_threads.
+        """
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(
+                    max_workers=cls.get_settings()["max_blocking_threads"],
+                    thread_name_prefix="async_ssh",
+                )
+            return cls._executor
+
+    async def async_run_get_result(
+        self,
+        cmd: str,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        get_pty: bool = False,
+        sudo: bool = False,
+        sudo_options: Optional[List[str]] = DEFAULT_SUDO_OPTIONS,
+        connection_timeout: int = 60,
+        path_env: Optional[List[str]] = None,
+    ) -> CmdResult:
+        """
+        Coroutine version of SSHConn.run_get_result(). Logging, timeout (124)
+        and error semantics are the same.
+        """
+        if working_directory:
+            cmd = "cd %s && %s" % (working_directory, cmd)
+        AutovalLog.log_debug(
+            f'Running async cmd: "{cmd}", timeout: {timeout}, working_directory: {working_directory}'
+        )
+        cmd = self._add_sudo(cmd, sudo, sudo_options)
+        if self._is_root is None:
+            # The is_root property collects the host facts with a blocking
+            # command the first time
+            await self._run_blocking(getattr, self, "is_root")
+        path_env = self._get_path_env(path_env)
+        exec_cmd = cmd
+        if path_env:
+            exec_cmd = "export PATH=$PATH:" + ":".join(path_env) + f";{cmd}"
+        async with self._host_semaphore():
+            ssh = await self._async_acquire(connection_timeout)
+            try:
+                start_time = time.time()
+                collector = await self._async_exec(
+                    ssh, exec_cmd, get_pty, timeout, connection_timeout
+                )
+                duration = time.time() - start_time
+            finally:
+                # Not cancelled along with the task, the session must go back
+                await asyncio.shield(
+                    self._run_in_executor(
+                        SSHConnectionPool.release, self._pool_key(), ssh
+                    )
+                )
+        result = SSHResult(
+            collector.return_code,
+            stdout=collector.stdout,
+            stderr=collector.stderr,
+            timed_out=collector.timed_out,
+        )
+        return self._process_result(
+            cmd, result, start_time, duration, timeout, ignore_status, custom_logfile
+        )
+
+    # pyre-fixme[3]: Return type must be annotated.
+    # pyre-fixme[2]: Parameter must be annotated.
+    async def async_read_file(self, file_path, decode_ascii: bool = False, **kwargs):
+        """
+        Coroutine version of SSHConn.read_file(). Paramiko SFTP is blocking,
+        so the transfer itself runs in the blocking thread pool.
+        """
+        return await self._run_blocking(
+            self.read_file, file_path, decode_ascii=decode_ascii, **kwargs
+        )
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    async def async_get_file(self, file_path, target, **kwargs) -> None:
+        """
+        Coroutine version of SSHConn.get_file()
+        """
+        await self._run_blocking(self.get_file, file_path, target, **kwargs)
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    async def async_put_file(self, file_path, target, **kwargs) -> None:
+        """
+        Coroutine version of SSHConn.put_file()
+        """
+        await self._run_blocking(self.put_file, file_path, target, **kwargs)
+
+    def _host_semaphore(self) -> asyncio.Semaphore:
+        # Semaphores are bound to the loop they are used from, so keep one
+        # set per loop; AsyncUtils.run_async_jobs creates a new loop per call
+        loop = asyncio.get_running_loop()
+        semaphores: Dict[str, asyncio.Semaphore] = self._host_semaphores.setdefault(
+            loop, {}
+        )
+        if self.hostname not in semaphores:
+            semaphores[self.hostname] = asyncio.Semaphore(self.max_sessions_per_host)
+        return semaphores[self.hostname]
+
+    async def _async_acquire(self, connection_timeout: int) -> SSH:
+        return await self._run_in_executor(
+            SSHConnectionPool.acquire,
+            self._pool_key(),
+            self._ssh_factory(connection_timeout),
+        )
+
+    async def _async_exec(
+        self,
+        ssh: SSH,
+        cmd: str,
+        get_pty: bool,
+        timeout: int,
+        connection_timeout: int,
+    ) -> SSHChannelCollector:
+        """
+        Runs cmd on a new exec channel of ssh and waits for it without blocking
+        the loop. Returns the finished collector, with return code 124 if the
+        command did not complete within timeout.
+        """
+        loop = asyncio.get_running_loop()
+        channel = await self._run_in_executor(
+            SSHChannelMux.open_exec_channel,
+            ssh.get_transport(),
+            cmd,
+            get_pty=get_pty,
+            timeout=connection_timeout,
+        )
+        collector = SSHChannelCollector(channel, deadline=time.time() + timeout)
+        finished = loop.create_future()
+
+        def on_readable() -> None:
+            collector.read_available()
+            if collector.is_finished() and not finished.done():
+                finished.set_result(None)
+
+        loop.add_reader(channel.fileno(), on_readable)
+        try:
+            await asyncio.wait_for(finished, timeout)
+        except asyncio.TimeoutError:
+            collector.timed_out = True
+        finally:
+            loop.remove_reader(channel.fileno())
+            collector.finish()
+        return collector
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    async def _run_blocking(self, func, *args, **kwargs) -> Any:
+        async with self._host_semaphore():
+            return await self._run_in_executor(func, *args, **kwargs)
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    def _run_in_executor(self, func, *args, **kwargs) -> "asyncio.Future[Any]":
+        return asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), functools.partial(func, *args, **kwargs)
+        )
@@ -1,18 +1,32 @@
 #!/usr/bin/env python3
-from typing import List, Optional
+import os
+import selectors
+import shlex
+import time
+from typing import Callable, Dict, List, Optional
 
 from autoval.lib.connection.connection_abstract import ConnectionAbstract
-from autoval.lib.connection.connection_utils import CmdResult, ConnectionUtils
+from autoval.lib.connection.host_facts import HostFacts
+from autoval.lib.connection.connection_utils import (
+    CmdResult,
+    CmdStream,
+    ConnectionUtils,
+    STREAM_CHUNK_SIZE,
+)
 from autoval.lib.utils.autoval_errors import ErrorType
 from autoval.lib.utils.autoval_exceptions import CmdError
 from autoval.lib.utils.autoval_log import AutovalLog
 from autoval.lib.utils.autoval_utils import AutovalUtils
 from autoval.lib.utils.file_actions import FileActions
+from autoval.lib.utils.output_capture import LazyOutput, OutputCapture
 
 DEFAULT_SUDO_OPTIONS = ["sh", "-lc"]
 
 
 class LocalConn(ConnectionAbstract):
+    # Commands on the controller never depend on it
+    check_sudo_fact = False
+
     # pyre-fixme[2]: Parameter must be annotated.
     def __init__(self, host, sudo: bool = False) -> None:
         self.host = "localhost"
@@ -26,10 +40,14 @@ class LocalConn(ConnectionAbstract):
     # pyre-fixme[3]: Return type must be annotated.
     def is_root(self):
         if self._is_root is None:
+            # Set first, the facts command itself looks up is_root
             self._is_root = False
-            groups = self.run_get_result("groups").stdout
-            self._is_root = "root" in groups
-        return self._is_root
+            facts = self.get_facts()
+            # Looked up again next time if the facts could not be collected
+            self._is_root = (
+                facts["is_root"] == "1" if HostFacts.is_complete(facts) else None
+            )
+        return bool(self._is_root)
 
     def run_get_result(
         self,
@@ -55,14 +73,7 @@ class LocalConn(ConnectionAbstract):
         LocalConn.run_get_result() does not currently support connection_timeout.
         LocalConn.run_get_result() does not currently support keepalive
         """
-        if sudo or self.sudo:
-            options = ""
-            if sudo_options is not None:
-                options = " ".join(sudo_options)
-            cmd = f"sudo {options} {cmd}"
-        if path_env:
-            # Append to existing PATH env
-            cmd = "export PATH=$PATH:" + ":".join(path_env) + f";{cmd}"
+        cmd = self._prepare_cmd(cmd, sudo, sudo_options)
         AutovalLog.log_debug(
             f'Running cmd: "{cmd}", timeout: {timeout}, working_directory: {working_directory}'
         )
@@ -75,23 +86,139 @@ class LocalConn(ConnectionAbstract):
             background=background,
             custom_logfile=custom_logfile,
             hostname=self.hostname,
+            env=self._get_env(path_env),
         )
-        output = f"{result.stdout} {result.stderr}"
         if result.return_code and not ignore_status:
             msg = "Command returned non-zero exit status"
+            output = OutputCapture.summarize(
+                LazyOutput.peek(result, "stderr")
+            ) + OutputCapture.summarize(LazyOutput.peek(result, "stdout"))
             if "command not found" in output:
                 raise CmdError(cmd, result, msg, error_type=ErrorType.CMD_NOT_FOUND_ERR)
             raise CmdError(cmd, result, msg)
 
         return CmdResult(
             cmd,
-            result.stdout,
-            result.stderr,
+            LazyOutput.peek(result, "stdout"),
+            LazyOutput.peek(result, "stderr"),
             result.return_code,
             # pyre-fixme[16]: `CmdResult` has no attribute `duration`.
             result.duration,
         )
 
+    def _exec_script(
+        self,
+        script: str,
+        timeout: int = 600,
+        connection_timeout: int = 60,  # Not supported by LocalConn
+        path_env: Optional[List[str]] = None,
+    ) -> CmdResult:
+        cmd = self._prepare_cmd("sh -c %s" % shlex.quote(script), False, None)
+        start_time = time.time()
+        process = AutovalUtils._popen(cmd, env=self._get_env(path_env))
+        stdout, stderr, return_code = AutovalUtils._communicate(
+            process, timeout, partial_on_timeout=True, cmd=cmd
+        )
+        return CmdResult(cmd, stdout, stderr, return_code, time.time() - start_time)
+
+    def run_stream(
+        self,
+        cmd: str,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        get_pty: bool = False,  # Not supported by LocalConn
+        sudo: bool = False,
+        sudo_options: Optional[List[str]] = DEFAULT_SUDO_OPTIONS,
+        connection_timeout: int = 60,  # Not supported by LocalConn
+        path_env: Optional[List[str]] = None,
+        raw: bool = False,
+        line_callback: Optional[Callable[[str, str], None]] = None,
+    ) -> CmdStream:
+        """
+        LocalConn.run_stream() runs cmd and returns a CmdStream yielding its
+        output while the process is still running. See CmdStream.
+
+        Closing the stream early, or hitting the timeout, kills the process
+        and its children.
+        """
+        cmd = self._prepare_cmd(cmd, sudo, sudo_options)
+        env = self._get_env(path_env)
+        run_cmd = cmd
+        cwd = None
+        if working_directory:
+            cmd = "cd %s && %s" % (working_directory, cmd)
+            cwd = AutovalUtils._get_cwd(working_directory)
+            if cwd is None:
+                run_cmd = cmd
+        AutovalLog.log_debug(
+            f'Streaming cmd: "{cmd}", timeout: {timeout}, working_directory: {working_directory}'
+        )
+        state = {"return_code": -1}
+
+        # pyre-fixme[3]: Return type must be annotated.
+        def source():
+            deadline = time.time() + timeout
+            process = AutovalUtils._popen(run_cmd, cwd=cwd, env=env)
+            sel = selectors.DefaultSelector()
+            sel.register(process.stdout, selectors.EVENT_READ, "stdout")
+            sel.register(process.stderr, selectors.EVENT_READ, "stderr")
+            try:
+                while sel.get_map():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        state["return_code"] = 124
+                        return
+                    for key, _ in sel.select(remaining):
+                        data = os.read(key.fd, STREAM_CHUNK_SIZE)
+                        if data:
+                            yield (key.data, data)
+                        else:
+                            sel.unregister(key.fileobj)
+                state["return_code"] = process.wait()
+            finally:
+                sel.close()
+                if process.poll() is None:
+                    AutovalUtils.kill_proc_family(process)
+                    process.wait()
+                process.stdout.close()
+                process.stderr.close()
+
+        return CmdStream(
+            self,
+            cmd,
+            source(),
+            lambda: state["return_code"],
+            ignore_status=ignore_status,
+            timeout=timeout,
+            custom_logfile=custom_logfile,
+            raw=raw,
+            line_callback=line_callback,
+        )
+
+    def _prepare_cmd(
+        self,
+        cmd: str,
+        sudo: bool,
+        sudo_options: Optional[List[str]],
+    ) -> str:
+        if sudo or self.sudo:
+            options = ""
+            if sudo_options is not None:
+                options = " ".join(sudo_options)
+            cmd = f"sudo {options} {cmd}"
+        return cmd
+
+    def _get_env(self, path_env: Optional[List[str]]) -> Optional[Dict[str, str]]:
+        """
+        Returns the environment overrides of a command: path_env is appended
+        to the existing PATH without wrapping the command in a shell export.
+        """
+        if not path_env:
+            return None
+        return {"PATH": ":".join([os.environ.get("PATH", "")] + path_env)}
+
     def _connect(self) -> None:
         # Nothing to be done here
         return
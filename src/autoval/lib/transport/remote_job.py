@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Detached background jobs on a remote host.
+
+SSHConn.start_background() launches a command in its own session and process
+group on the host, with stdout, stderr and the exit code written to files in a
+job directory, and returns a RemoteJob handle. The launching channel is closed
+right away; every later call on the handle is a short command or SFTP read
+over a pooled session, so a multi-hour workload holds neither a channel nor a
+control-server thread while it runs.
+
+Example:
+    job = host.start_background("stress-ng --cpu 0 --timeout 4h")
+    while job.poll() is None:
+        out, offset = job.tail_output(offset)
+        ...
+    job.kill(signal.SIGTERM)
+"""
+import posixpath
+import shlex
+import signal
+import time
+import uuid
+from typing import Optional, Tuple
+
+from autoval.lib.connection.connection_utils import ConnectionUtils
+from autoval.lib.utils.autoval_exceptions import AutoValException, TimeoutError
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.site_utils import SiteUtils
+
+DEFAULT_JOB_ROOT = "/tmp/autoval"
+# Exit code reported by poll() for a job that ended without writing its exit
+# code, e.g. because its process group was killed
+KILLED_RETURN_CODE = -1
+TAIL_MAX_BYTES = 1024 * 1024
+
+
+class RemoteJob:
+    """
+    Handle of a command started with SSHConn.start_background().
+
+    pid is the pid of the job's wrapper shell. It leads its own session, so
+    pgid == pid and kill() reaches every process the command started.
+    """
+
+    def __init__(
+        self,
+        # pyre-fixme[2]: Parameter must be annotated.
+        conn,
+        cmd: str,
+        job_dir: str,
+        pid: int,
+    ) -> None:
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.conn = conn
+        self.cmd = cmd
+        self.job_dir = job_dir
+        self.pid = pid
+        self.pgid = pid
+        self.stdout_path: str = posixpath.join(job_dir, "stdout")
+        self.stderr_path: str = posixpath.join(job_dir, "stderr")
+        self.rc_path: str = posixpath.join(job_dir, "rc")
+        self.start_time: float = time.time()
+        self.return_code: Optional[int] = None
+
+    def __repr__(self) -> str:
+        return (
+            f"RemoteJob({self.conn.hostname}, pid={self.pid}, cmd={self.cmd!r}, "
+            f"job_dir={self.job_dir})"
+        )
+
+    @classmethod
+    def start(
+        cls,
+        # pyre-fixme[2]: Parameter must be annotated.
+        conn,
+        cmd: str,
+        job_root: Optional[str] = None,
+        working_directory: Optional[str] = None,
+    ) -> "RemoteJob":
+        """
+        Launches cmd detached from the SSH session and returns its handle
+        once the wrapper shell wrote its pid.
+        """
+        if job_root is None:
+            job_root = cls._get_default_job_root(conn.hostname)
+        job_id = "%d_%s" % (time.time(), uuid.uuid4().hex[:8])
+        job_dir = posixpath.join(job_root, "bg_jobs", job_id)
+        if working_directory:
+            cmd = "cd %s && %s" % (working_directory, cmd)
+        wrapper = (
+            f"echo $$ > {job_dir}/pid; ({cmd}) > {job_dir}/stdout 2> {job_dir}/stderr; "
+            f"echo $? > {job_dir}/rc.tmp && mv {job_dir}/rc.tmp {job_dir}/rc"
+        )
+        launch = (
+            f"mkdir -p {job_dir} && "
+            f"(setsid sh -c {shlex.quote(wrapper)} "
+            f"< /dev/null > /dev/null 2>&1 &) && "
+            f"while [ ! -s {job_dir}/pid ]; do sleep 0.1; done; cat {job_dir}/pid"
+        )
+        result = conn._run_script(launch, timeout=60)
+        job = cls(conn, cmd, job_dir, int(result.stdout.strip()))
+        AutovalLog.log_info(f"Started background job {job}")
+        return job
+
+    def poll(self) -> Optional[int]:
+        """
+        Returns the exit code of the job, or None while it is running.
+        A job that is gone without an exit code reports KILLED_RETURN_CODE.
+        """
+        if self.return_code is not None:
+            return self.return_code
+        out = self.conn._run_script(
+            f"cat {self.rc_path} 2>/dev/null || "
+            f"(kill -0 {self.pid} 2>/dev/null && echo running || echo gone)",
+            ignore_status=True,
+        ).stdout.strip()
+        if out == "running":
+            return None
+        if out == "gone":
+            return_code = KILLED_RETURN_CODE
+        else:
+            try:
+                return_code = int(out)
+            except ValueError:
+                raise AutoValException(f"Unexpected state of {self}: {out}")
+        self._finish(return_code)
+        return return_code
+
+    def is_running(self) -> bool:
+        return self.poll() is None
+
+    def tail_output(
+        self, offset: int = 0, stderr: bool = False, max_bytes: int = TAIL_MAX_BYTES
+    ) -> Tuple[str, int]:
+        """
+        Returns the output written since byte offset, at most max_bytes of
+        it, and the offset to pass to the next call.
+        """
+        path = self.stderr_path if stderr else self.stdout_path
+        with self.conn._pooled_ssh() as ssh:
+            try:
+                with ssh.get_sftp().open(path) as remote_file:
+                    remote_file.seek(offset)
+                    data = remote_file.read(max_bytes)
+            except IOError:
+                data = b""
+        return ConnectionUtils.str_encode(data), offset + len(data)
+
+    def wait(self, timeout: Optional[float] = None, poll_interval: float = 10) -> int:
+        """
+        Polls until the job finished and returns its exit code.
+        Raises TimeoutError if it is still running after timeout seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            return_code = self.poll()
+            if return_code is not None:
+                return return_code
+            if deadline is not None and time.time() >= deadline:
+                raise TimeoutError(
+                    f"Background job [{self.cmd}] on {self.conn.hostname} did not "
+                    f"complete within {timeout} seconds"
+                )
+            sleep = poll_interval
+            if deadline is not None:
+                sleep = max(0, min(poll_interval, deadline - time.time()))
+            time.sleep(sleep)
+
+    def kill(self, sig: int = signal.SIGTERM) -> None:
+        """
+        Sends sig to every process of the job's process group
+        """
+        self.conn._run_script(f"kill -{int(sig)} -{self.pgid}", ignore_status=True)
+
+    def cleanup(self) -> None:
+        """
+        Removes the job directory with its logs from the host
+        """
+        self.conn._run_script(f"rm -rf {self.job_dir}", ignore_status=True)
+
+    def _finish(self, return_code: int) -> None:
+        self.return_code = return_code
+        duration = time.time() - self.start_time
+        output = (
+            f"Background job finished, stdout: {self.stdout_path}, "
+            f"stderr: {self.stderr_path}"
+        )
+        self.conn._log_cmd_metrics(
+            self.cmd, self.start_time, duration, return_code, output
+        )
+        ConnectionUtils.log_cmdlog(self.conn.hostname, self.cmd, return_code, output)
+
+    @classmethod
+    def _get_default_job_root(cls, hostname: str) -> str:
+        try:
+            return SiteUtils.get_dut_logdir(hostname) or DEFAULT_JOB_ROOT
+        except Exception:
+            return DEFAULT_JOB_ROOT
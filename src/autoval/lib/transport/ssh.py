@@ -1,26 +1,53 @@
 #!/usr/bin/env python3
 
+import atexit
 import os
-import queue
+import posixpath
 import re
 import selectors
+import shlex
 import socket
+import stat
 import subprocess
+import threading
 import time
-from threading import Timer
-from typing import List, Optional
+from contextlib import contextmanager, ExitStack
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import paramiko
 from autoval.lib.connection.connection_abstract import ConnectionAbstract
-from autoval.lib.connection.connection_utils import CmdResult, ConnectionUtils
+from autoval.lib.connection.host_facts import HostFacts
+from autoval.lib.connection.connection_utils import (
+    CmdResult,
+    CmdStream,
+    ConnectionUtils,
+    STREAM_CHUNK_SIZE,
+)
 from autoval.lib.host.component.component import COMPONENT
+from autoval.lib.transport.chunked_transfer import ChunkedUpload
 from autoval.lib.transport.local import LocalConn
+from autoval.lib.transport.remote_job import RemoteJob
+from autoval.lib.transport.ssh_keys import SSHKeyCache
+from autoval.lib.transport.ssh_pool import FILE_TRANSFER_USER, SSHConnectionPool
+from autoval.lib.transport.ssh_tuning import SSHTransportOptions
 from autoval.lib.utils.autoval_errors import ErrorType
 from autoval.lib.utils.autoval_exceptions import CmdError, HostException, TimeoutError
 
 from autoval.lib.utils.autoval_log import AutovalLog
-from autoval.lib.utils.autoval_utils import AutovalUtils
+from autoval.lib.utils.autoval_utils import MAX_THREADS
 from autoval.lib.utils.decorators import retry
+from autoval.lib.utils.file_digest import FileDigest, HashingReader
+from autoval.lib.utils.output_capture import LazyOutput, OutputCapture
 from autoval.lib.utils.site_utils import SiteUtils
 from paramiko.agent import AgentClientProxy
 from paramiko.channel import Channel
@@ -28,6 +55,12 @@ from paramiko.ssh_exception import SSHException
 
 
 DEFAULT_SUDO_OPTIONS = ["sh", "-lc"]
+# SFTP channel tuning, can be overridden through the "sftp" site setting.
+# A larger window keeps more pipelined requests in flight on high latency links.
+DEFAULT_SFTP_SETTINGS = {
+    "window_size": 16 * 1024 * 1024,
+    "max_packet_size": 32 * 1024,
+}
 
 
 class SSHResult:
@@ -35,6 +68,9 @@ class SSHResult:
     Result object for all ssh commands
     """
 
+    stdout = LazyOutput()
+    stderr = LazyOutput()
+
     def __init__(
         self,
         # pyre-fixme[2]: Parameter must be annotated.
@@ -58,6 +94,10 @@ class SSHResult:
 
 class SSH:
     paramiko_logger_initialized = False
+    # pyre-fixme[4]: Attribute must be annotated.
+    _sftp_settings = None
+    # host -> address family (AF_INET6/AF_INET) of the last successful connect
+    _address_families: Dict[str, int] = {}
 
     def __init__(
         self,
@@ -71,7 +111,17 @@ class SSH:
         connection_timeout: int = 60,
         allow_agent: bool = True,
         keepalive: int = 0,
+        # pyre-fixme[2]: Parameter annotation cannot contain `Any`.
+        transport_options: Optional[Dict[str, Any]] = None,
+        use_keys: bool = True,
+        gateway: Optional[Callable[[], ContextManager[Channel]]] = None,
     ) -> None:
+        """
+        use_keys: authenticate with the ssh_key_path keys, besides password
+        gateway: returns a context manager entering into a channel to tunnel
+            the session through, e.g. a direct-tcpip channel of a session to
+            another host. It is exited when this session disconnects.
+        """
         if not user:
             user = "root"
         if not SSH.paramiko_logger_initialized:
@@ -84,38 +134,79 @@ class SSH:
         # pyre-fixme[4]: Attribute must be annotated.
         self._password = password
         self._port = port
-        # pyre-fixme[4]: Attribute must be annotated.
-        self._ssh_key_path = SiteUtils().get_ssh_key_path()
+        # Only the paths that exist, resolved once per process
+        self._ssh_key_path: List[str] = SSHKeyCache.get_key_paths()
         self._connection_timeout = connection_timeout
         self._allow_agent = allow_agent
         self.keepalive = keepalive
-        # Remove the file from the list if it does not exist.
-        if self._ssh_key_path:
-            for ssh_cert_file in self._ssh_key_path:
-                if not os.path.exists(ssh_cert_file):
-                    self._ssh_key_path.remove(ssh_cert_file)
+        # pyre-fixme[4]: Attribute annotation cannot contain `Any`.
+        self._transport_options = SSHTransportOptions.resolve(transport_options)
+        self._use_keys = use_keys
+        self._gateway = gateway
+        self._gateway_stack = ExitStack()
+        # pyre-fixme[4]: Attribute must be annotated.
+        self._ssh = None
+        self._sftp: Optional[paramiko.SFTPClient] = None
 
     @retry(tries=3, sleep_seconds=30)
     # pyre-fixme[3]: Return type must be annotated.
     def _connect_to_host(self):
+        self._connect_once()
+
+    def _connect_once(self, banner_timeout: float = 120) -> None:
+        """
+        Single attempt of _connect_to_host(), for callers that retry on
+        their own, e.g. within a deadline
+        """
+        connected = False
         try:
             # pyre-fixme[16]: `SSH` has no attribute `_ssh`.
             self._ssh = paramiko.SSHClient()
-            self._ssh.load_system_host_keys()
+            if self._gateway is None:
+                # Shared, parsed once per change of known_hosts instead of
+                # load_system_host_keys() re-reading the file for every session
+                # pyre-fixme[16]: `SSHClient` has no attribute `_system_host_keys`.
+                self._ssh._system_host_keys = SSHKeyCache.get_host_keys()
             self._ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            self._ssh.connect(
-                self._host,
-                username=self._user,
-                password=self._password,
-                timeout=self._connection_timeout,
-                banner_timeout=120,
-                port=self._port,
-                key_filename=self._ssh_key_path,
-                allow_agent=self._allow_agent,
+            pkeys = SSHKeyCache.get_pkeys(self._password) if self._use_keys else []
+            # connect() takes a single pre-loaded key. With more keys the
+            # others, the ssh-agent and the password are tried afterwards on
+            # the same transport, in the order connect() would try them.
+            more_keys = pkeys[1:]
+            sock, rtt = self._open_socket()
+            try:
+                self._ssh.connect(
+                    self._host,
+                    username=self._user,
+                    password=None if more_keys else self._password,
+                    timeout=self._connection_timeout,
+                    banner_timeout=banner_timeout,
+                    port=self._port,
+                    sock=sock,
+                    pkey=pkeys[0] if pkeys else None,
+                    look_for_keys=False,
+                    allow_agent=self._allow_agent and not more_keys,
+                    **SSHTransportOptions.get_connect_kwargs(
+                        self._transport_options, rtt
+                    ),
+                )
+            except paramiko.ssh_exception.AuthenticationException:
+                if not more_keys or self._ssh.get_transport() is None:
+                    raise
+                SSHKeyCache.authenticate(
+                    self._ssh.get_transport(),
+                    self._user,
+                    more_keys,
+                    self._allow_agent,
+                    self._password,
+                )
+            SSHTransportOptions.apply(
+                self._ssh.get_transport(), self._transport_options
             )
             if self.keepalive != 0:
                 # pyre-fixme[16]: `SSHClient` has no attribute `_transport`.
                 self._ssh._transport.set_keepalive(self.keepalive)
+            connected = True
 
         except paramiko.ssh_exception.AuthenticationException:
             raise HostException(
@@ -128,18 +219,121 @@ class SSH:
         except paramiko.BadHostKeyException:
             # removing old host key and retry
             LocalConn(self._host).run("ssh-keygen -R %s" % self._host)
+            SSHKeyCache.invalidate()
             raise
         except Exception as e:
             raise HostException(
                 "Failed to connect to {}: {}".format(self._host, str(e))
             )
-        return
+        finally:
+            if not connected:
+                self._gateway_stack.close()
+
+    def _open_socket(self) -> Tuple[Union[socket.socket, Channel], float]:
+        """
+        Opens the connection the SSH session runs over and returns it with the
+        time the TCP connect took.
+
+        The address family that worked last time for this host is tried
+        first, so a host only reachable over IPv4 does not wait for the IPv6
+        connect to time out on every new session.
+        """
+        start_time = time.time()
+        if self._gateway is not None:
+            self._gateway_stack.close()
+            channel = self._gateway_stack.enter_context(self._gateway())
+            return channel, time.time() - start_time
+        addresses = socket.getaddrinfo(self._host, self._port, 0, socket.SOCK_STREAM)
+        preferred = SSH._address_families.get(self._host)
+        addresses.sort(key=lambda address: address[0] != preferred)
+        error = None
+        for family, socktype, proto, _, sockaddr in addresses:
+            sock = socket.socket(family, socktype, proto)
+            sock.settimeout(self._connection_timeout)
+            start_time = time.time()
+            try:
+                sock.connect(sockaddr)
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            SSH._address_families[self._host] = family
+            return sock, time.time() - start_time
+        raise error or OSError(f"No address found for {self._host}")
+
+    # pyre-fixme[3]: Return type must be annotated.
+    def get_transport(self):
+        if self._ssh is None:
+            return None
+        return self._ssh.get_transport()
+
+    def is_alive(self, probe: bool = False, probe_timeout: int = 5) -> bool:
+        """
+        Checks whether the session can still be used.
+
+        A transport can look active long after the remote side went away (e.g.
+        the host was power cycled), so with probe=True a session channel is
+        opened and closed again to make sure the peer still answers.
+        """
+        transport = self.get_transport()
+        if (
+            transport is None
+            or not transport.is_active()
+            or not transport.is_authenticated()
+        ):
+            return False
+        if probe:
+            try:
+                transport.open_session(timeout=probe_timeout).close()
+            except Exception:
+                return False
+        return True
+
+    def get_sftp(self) -> paramiko.SFTPClient:
+        """
+        Returns the SFTP client of this session, opening it on first use.
+
+        The client is kept for the lifetime of the session, so pooled sessions
+        do not pay for a new SFTP subsystem for every file operation.
+        """
+        if self._sftp is None or self._sftp.sock.closed:
+            settings = self.get_sftp_settings()
+            self._sftp = paramiko.SFTPClient.from_transport(
+                self.get_transport(),
+                window_size=settings["window_size"],
+                max_packet_size=settings["max_packet_size"],
+            )
+        # pyre-fixme[7]: Expected `SFTPClient` but got `Optional[SFTPClient]`.
+        return self._sftp
+
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    def get_sftp_settings(cls):
+        if cls._sftp_settings is None:
+            settings = dict(DEFAULT_SFTP_SETTINGS)
+            try:
+                settings.update(
+                    SiteUtils.get_site_setting("sftp", raise_error=False) or {}
+                )
+            except Exception:
+                pass
+            cls._sftp_settings = settings
+        return cls._sftp_settings
+
+    def set_keepalive(self, keepalive: int) -> None:
+        transport = self.get_transport()
+        if transport is not None:
+            transport.set_keepalive(keepalive)
+        self.keepalive = keepalive
 
     def _disconnect(self) -> None:
-        # pyre-fixme[16]: `SSH` has no attribute `_ssh`.
+        if self._sftp is not None:
+            self._sftp.close()
+            self._sftp = None
         if self._ssh:
             self._ssh.close()
             self._ssh = None
+        self._gateway_stack.close()
 
     def __enter__(self) -> "SSH":
         # Used for "with"-style connections
@@ -151,11 +345,6 @@ class SSH:
         # Used for "with"-style connections
         self._disconnect()
 
-    # pyre-fixme[2]: Parameter must be annotated.
-    def raise_timeout(self, cmd, timeout, queue) -> None:
-        queue.put("SSH command [%s] timed out after [%d] seconds" % (cmd, timeout))
-        self._disconnect()
-
 
 class SSHCommand:
     """
@@ -181,31 +370,12 @@ class SSHCommand:
         self.path_env = path_env
 
     def __enter__(self) -> SSHResult:
-
-        return_code = -1
-        thread_queue = queue.Queue()
-        # Using a timer to disconnect the SSH session once timeout is reached.
-        timer = Timer(
-            self._timeout,
-            self.ssh.raise_timeout,
-            [self._cmd, self._timeout, thread_queue],
-        )
-        try:
-            timer.start()
-            if self.path_env:
-                # Append to existing PATH env
-                self._cmd = (
-                    "export PATH=$PATH:" + ":".join(self.path_env) + f";{self._cmd}"
-                )
-            (stdin, stdout, stderr, return_code) = self._exec()
-        finally:
-            timer.cancel()
-            try:
-                error = thread_queue.get(block=False)  # noqa
-                return_code = 124
-            except queue.Empty:
-                pass
-
+        if self.path_env:
+            # Append to existing PATH env
+            self._cmd = "export PATH=$PATH:" + ":".join(self.path_env) + f";{self._cmd}"
+        # The timeout is enforced by the channel selector in _exec, which
+        # closes the channel and reports 124 once the deadline is reached.
+        (stdin, stdout, stderr, return_code) = self._exec()
         return SSHResult(return_code, stdout=stdout, stderr=stderr)
 
     # pyre-fixme[2]: Parameter must be annotated.
@@ -214,69 +384,204 @@ class SSHCommand:
 
     # pyre-fixme[3]: Return type must be annotated.
     def _exec(self):
-        (stdin, stdout, stderr) = self.ssh._ssh.exec_command(
-            self._cmd,
-            get_pty=self.get_pty,
+        channel = SSHChannelMux.open_exec_channel(
+            self.ssh.get_transport(), self._cmd, get_pty=self.get_pty
         )
+        deadline = None
+        if self._timeout is not None:
+            deadline = time.time() + self._timeout
+        collector = SSHChannelCollector(channel, deadline=deadline)
+        mux = SSHChannelMux()
+        try:
+            mux.add(collector)
+            while mux.active:
+                mux.poll()
+        finally:
+            mux.close()
 
-        # channel is shared for stdin, stdout and stderr
-        channel = stdout.channel
-        stdout_chunks = []
-        stderr_chunks = []
+        return (
+            None,
+            collector.stdout,
+            collector.stderr,
+            collector.return_code,
+        )
 
-        # since we're not using stdin and nor do we write
-        stdin.close()
-        channel.shutdown_write()
 
-        # read stdout/stderr in order to prevent read block hangs
-        stdout_chunks.append(channel.recv(len(channel.in_buffer)))
+class SSHChannelCollector:
+    """
+    Collects stdout/stderr chunks of a single exec channel until it exits
+    """
 
-        # read chunk-by-chunk to prevent stalls
-        # 'channel.closed' checks if channel was closed prematurely,
-        # and there is no data in the buffers.
+    def __init__(
+        self,
+        channel: Channel,
+        deadline: Optional[float] = None,
+        # pyre-fixme[2]: Parameter must be annotated.
+        tag=None,
+    ) -> None:
+        self.channel = channel
+        self.deadline = deadline
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.tag = tag
+        self.timed_out = False
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.return_code = -1
+        self._stdout = OutputCapture()
+        self._stderr = OutputCapture()
+
+    def read_available(self) -> bool:
+        # read stdout/stderr chunk-by-chunk to prevent stalls
+        got_chunk = False
+        if self.channel.recv_ready():
+            self._stdout.write(self.channel.recv(len(self.channel.in_buffer)))
+            got_chunk = True
+        if self.channel.recv_stderr_ready():
+            # make sure to read stderr to prevent stall
+            self._stderr.write(
+                self.channel.recv_stderr(len(self.channel.in_stderr_buffer))
+            )
+            got_chunk = True
+        return got_chunk
+
+    def iter_chunks(
+        self, chunk_size: int = STREAM_CHUNK_SIZE
+    ) -> Iterator[Tuple[str, bytes]]:
+        """
+        Yields ("stdout"|"stderr", bytes) chunks as they arrive instead of
+        collecting them. At most chunk_size bytes are taken off the channel per
+        read, so paramiko only reopens the window as fast as the caller consumes.
+        """
         sel = selectors.DefaultSelector()
-        sel.register(channel, selectors.EVENT_READ)
-        while not channel.closed or channel.recv_ready() or channel.recv_stderr_ready():
-            got_chunk = False
-            sel_res = sel.select()
-            readq = [v[0].fileobj for v in sel_res if v]
-            for c in readq:
-                # pyre-fixme[16]: Item `HasFileno` of `Union[HasFileno, int]` has no
-                #  attribute `recv_ready`.
-                if c.recv_ready():
-                    # pyre-fixme[16]: Item `HasFileno` of `Union[HasFileno, int]`
-                    #  has no attribute `in_buffer`.
-                    stdout_chunks.append(channel.recv(len(c.in_buffer)))
+        sel.register(self.channel, selectors.EVENT_READ)
+        try:
+            while True:
+                timeout = None
+                if self.deadline is not None:
+                    timeout = self.deadline - time.time()
+                    if timeout <= 0:
+                        self.timed_out = True
+                        break
+                sel.select(timeout)
+                got_chunk = False
+                if self.channel.recv_ready():
+                    yield ("stdout", self.channel.recv(chunk_size))
                     got_chunk = True
-                # pyre-fixme[16]: Item `HasFileno` of `Union[HasFileno, int]` has no
-                #  attribute `recv_stderr_ready`.
-                if c.recv_stderr_ready():
-                    # make sure to read stderr to prevent stall
-                    # pyre-fixme[16]: Item `HasFileno` of `Union[HasFileno, int]`
-                    #  has no attribute `in_stderr_buffer`.
-                    stderr_chunks.append(channel.recv_stderr(len(c.in_stderr_buffer)))
+                if self.channel.recv_stderr_ready():
+                    yield ("stderr", self.channel.recv_stderr(chunk_size))
                     got_chunk = True
+                if got_chunk:
+                    continue
+                if self.is_finished():
+                    break
+                if self.channel.eof_received:
+                    # The channel stays readable after EOF, so block until the
+                    # exit status or close arrives instead of spinning
+                    self.channel.status_event.wait(timeout)
+        finally:
+            sel.close()
+            self.finish()
+
+    def is_finished(self) -> bool:
+        # 'channel.closed' checks if channel was closed prematurely,
+        # and there is no data in the buffers.
+        if self.channel.recv_ready() or self.channel.recv_stderr_ready():
+            return False
+        return self.channel.closed or self.channel.exit_status_ready()
+
+    def finish(self) -> None:
+        if not self.channel.closed:
+            self.channel.shutdown_read()
+        if self.timed_out:
+            self.return_code = 124
+        elif self.channel.closed or self.channel.exit_status_ready():
+            self.return_code = self.channel.recv_exit_status()
+        # else the reader gave up on a running command, keep return_code -1
+        self.channel.close()
+
+    @property
+    def stdout(self) -> Union[str, OutputCapture]:
+        return self._stdout.finish()
+
+    @property
+    def stderr(self) -> Union[str, OutputCapture]:
+        return self._stderr.finish()
+
+
+class SSHChannelMux:
+    """
+    Services any number of exec channels from a single selector loop.
+
+    Paramiko channels expose a fileno() that becomes readable whenever data,
+    EOF or close arrives, so many commands running over one transport can be
+    drained without a thread per command. Collectors with a deadline are
+    closed and marked timed out once it passes.
+    """
+
+    def __init__(self) -> None:
+        self._sel = selectors.DefaultSelector()
+        self._collectors: List[SSHChannelCollector] = []
+
+    @staticmethod
+    def open_exec_channel(
+        # pyre-fixme[2]: Parameter must be annotated.
+        transport,
+        cmd: str,
+        get_pty: bool = False,
+        # pyre-fixme[2]: Parameter must be annotated.
+        timeout=None,
+    ) -> Channel:
+        if transport is None:
+            raise SSHException("SSH session not active")
+        channel = transport.open_session(timeout=timeout)
+        if get_pty:
+            channel.get_pty()
+        channel.exec_command(cmd)
+        # since we're not using stdin and nor do we write
+        channel.shutdown_write()
+        return channel
+
+    @property
+    def active(self) -> int:
+        return len(self._collectors)
+
+    def add(self, collector: SSHChannelCollector) -> None:
+        self._sel.register(collector.channel, selectors.EVENT_READ, collector)
+        self._collectors.append(collector)
+
+    def poll(self) -> List[SSHChannelCollector]:
+        """
+        Waits until at least one channel has news or a deadline passes.
+        Returns the collectors that finished during this call.
+        """
+        finished = []
+        deadlines = [c.deadline for c in self._collectors if c.deadline is not None]
+        timeout = None
+        if deadlines:
+            timeout = max(0, min(deadlines) - time.time())
+        for key, _ in self._sel.select(timeout):
+            collector = key.data
+            if not collector.read_available() and collector.is_finished():
+                finished.append(collector)
+        now = time.time()
+        for collector in self._collectors:
             if (
-                not got_chunk
-                and channel.exit_status_ready()
-                and not channel.recv_stderr_ready()
-                and not channel.recv_ready()
+                collector not in finished
+                and collector.deadline is not None
+                and now >= collector.deadline
             ):
-                channel.shutdown_read()
-                sel.unregister(channel)
-                sel.close()
-                channel.close()
-                break
+                collector.timed_out = True
+                finished.append(collector)
+        for collector in finished:
+            self._sel.unregister(collector.channel)
+            self._collectors.remove(collector)
+            collector.finish()
+        return finished
 
-        stderr.close()
-        stdout.close()
-
-        return (
-            stdin,
-            b"".join(stdout_chunks),
-            b"".join(stderr_chunks),
-            channel.recv_exit_status(),
-        )
+    def close(self) -> None:
+        for collector in self._collectors:
+            collector.channel.close()
+        self._collectors = []
+        self._sel.close()
 
 
 class SSHConn(ConnectionAbstract):
@@ -296,6 +601,8 @@ class SSHConn(ConnectionAbstract):
         password=None,
         allow_agent: bool = True,
         sudo: bool = False,
+        # pyre-fixme[2]: Parameter annotation cannot contain `Any`.
+        transport_options: Optional[Dict[str, Any]] = None,
     ) -> None:
         # pyre-fixme[4]: Attribute must be annotated.
         self.hostname = host
@@ -306,6 +613,8 @@ class SSHConn(ConnectionAbstract):
         self.password = password
         self.allow_agent = allow_agent
         self.sudo = sudo
+        # pyre-fixme[4]: Attribute annotation cannot contain `Any`.
+        self.transport_options = SSHTransportOptions.resolve(transport_options)
         self._connect(skip_health_check)
         # pyre-fixme[4]: Attribute must be annotated.
         self._is_root = None
@@ -317,10 +626,38 @@ class SSHConn(ConnectionAbstract):
             if self.user == "root":
                 self._is_root = True
             else:
+                # Set first, the facts command itself looks up is_root
                 self._is_root = False
-                groups = self.run_get_result("groups").stdout
-                self._is_root = "root" in groups
-        return self._is_root
+                facts = self.get_facts()
+                # Looked up again next time if the facts could not be collected
+                self._is_root = (
+                    facts["is_root"] == "1" if HostFacts.is_complete(facts) else None
+                )
+        return bool(self._is_root)
+
+    def _get_probe_target(self) -> Optional[Tuple[str, int]]:
+        return (self.hostname, self.port)
+
+    def _try_reconnect(self, timeout: float) -> None:
+        """
+        Opens one new session without the retries of _connect_to_host(),
+        with connect, banner and command timeouts capped at timeout, and
+        hands it to the pool in place of the sessions from before.
+        """
+        timeout = max(1, int(timeout))
+        ssh = self._ssh_factory(connection_timeout=min(60, timeout))()
+        try:
+            ssh._connect_once(banner_timeout=min(120, timeout))
+            with SSHCommand(ssh, ["/bin/true"], min(10, timeout)) as result:
+                if result.return_code != 0:
+                    raise HostException(
+                        f"/bin/true returned {result.return_code} on {self.hostname}"
+                    )
+        except Exception:
+            ssh._disconnect()
+            raise
+        SSHConnectionPool.discard_host(self.hostname)
+        SSHConnectionPool.release(self._pool_key(), ssh)
 
     def _connect(self, skip_health_check: bool = False) -> None:
         # @@@ TODO: ??? What to put here?
@@ -349,7 +686,8 @@ class SSHConn(ConnectionAbstract):
         SSH.run_get_result() implements the ConnectionAbstract.run abstract base function
         for a common interface between different connection types (Thrift, SSH, ...)
 
-        SSH.run_get_result() does not currently support background.
+        SSH.run_get_result() does not support background, use
+        SSHConn.start_background() for long running commands.
         """
         #
         if working_directory:
@@ -357,61 +695,330 @@ class SSHConn(ConnectionAbstract):
         AutovalLog.log_debug(
             f'Running cmd: "{cmd}", timeout: {timeout}, working_directory: {working_directory}'
         )
-        key_args = {
-            "host": self.hostname,
-            "user": self.user,
-            "password": self.password,
-            "port": self.port,
-            "allow_agent": self.allow_agent,
-            "connection_timeout": connection_timeout,
-            "keepalive": keepalive,
-        }
-        with SSH(**key_args) as ssh, SSHAgent(
+        with self._pooled_ssh(connection_timeout, keepalive) as ssh, SSHAgent(
             ssh, forward_ssh_agent=forward_ssh_agent
         ) as ssh_agent:  # noqa
-            if sudo or self.sudo:
-                options = ""
-                if sudo_options is not None:
-                    options = " ".join(sudo_options)
-                cmd = f"sudo {options} {cmd}"
-            if not self.is_root:
-                if not path_env:
-                    path_env = []
-                path_env.extend(["/usr/sbin", "/usr/bin", "/sbin"])
+            cmd = self._add_sudo(cmd, sudo, sudo_options)
+            path_env = self._get_path_env(path_env)
             _cmd = [cmd]
             start_time = time.time()
             with SSHCommand(ssh, _cmd, timeout, get_pty, path_env) as result:
-
                 duration = time.time() - start_time
-                _out = result.stdout + result.stderr
-                self._log_cmd_metrics(
-                    cmd, start_time, duration, result.return_code, _out
-                )
-                _out = ConnectionUtils.str_encode(_out)
-                ConnectionUtils.log_cmdlog(
-                    self.hostname, cmd, result.return_code, _out, custom_logfile
+                return self._process_result(
+                    cmd,
+                    result,
+                    start_time,
+                    duration,
+                    timeout,
+                    ignore_status,
+                    custom_logfile,
                 )
-                if result.return_code == 124:
-                    raise TimeoutError(
-                        f"[{cmd}] timed out. Failed to complete within {timeout} seconds on {self.hostname}"
-                    )
-                if result.return_code != 0 and not ignore_status:
-                    msg = "Command returned non-zero exit status on %s" % (
-                        self.hostname
-                    )
-                    if "command not found" in _out:
-                        raise CmdError(
-                            cmd, result, msg, error_type=ErrorType.CMD_NOT_FOUND_ERR
-                        )
-                    raise CmdError(cmd, result, msg)
+
+    def _exec_script(
+        self,
+        script: str,
+        timeout: int = 600,
+        connection_timeout: int = 60,
+        path_env: Optional[List[str]] = None,
+    ) -> CmdResult:
+        cmd = self._add_sudo("sh -c %s" % shlex.quote(script), False, None)
+        with self._pooled_ssh(connection_timeout) as ssh:
+            path_env = self._get_path_env(path_env)
+            start_time = time.time()
+            with SSHCommand(ssh, [cmd], timeout, False, path_env) as result:
                 return CmdResult(
                     cmd,
                     result.stdout,
                     result.stderr,
                     result.return_code,
-                    duration,
+                    time.time() - start_time,
                 )
 
+    def start_background(
+        self,
+        cmd: str,
+        working_directory: Optional[str] = None,
+        job_root: Optional[str] = None,
+    ) -> RemoteJob:
+        """
+        Starts cmd detached from the SSH session, in its own process group,
+        and returns a RemoteJob handle to poll, tail, wait for or kill it.
+        No channel stays open while the job runs; stdout, stderr and the exit
+        code go to files in a job directory under job_root, the DUT log
+        directory by default.
+        """
+        return RemoteJob.start(
+            self, cmd, job_root=job_root, working_directory=working_directory
+        )
+
+    def run_many(
+        self,
+        cmds: List[str],
+        max_concurrency: int = MAX_THREADS,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        get_pty: bool = False,
+        sudo: bool = False,
+        sudo_options: Optional[List[str]] = DEFAULT_SUDO_OPTIONS,
+        connection_timeout: int = 60,
+        path_env: Optional[List[str]] = None,
+    ) -> List[CmdResult]:
+        """
+        SSHConn.run_many() runs all cmds over a single pooled SSH transport.
+
+        Up to max_concurrency exec channels are kept open at the same time and
+        all of them are serviced from one selector loop, so probing many
+        devices costs roughly one round trip instead of one connection and one
+        thread per command. Keep max_concurrency below the sshd MaxSessions
+        limit (10 by default on OpenSSH).
+
+        Results are returned in input order. Every command is logged to cmdlog
+        and cmd_metrics on its own; errors are raised once all commands are done.
+        """
+        path_env = self._get_path_env(path_env)
+        prefix = ""
+        if path_env:
+            prefix = "export PATH=$PATH:" + ":".join(path_env) + ";"
+        prepared = []
+        for cmd in cmds:
+            if working_directory:
+                cmd = "cd %s && %s" % (working_directory, cmd)
+            prepared.append(self._add_sudo(cmd, sudo, sudo_options))
+        AutovalLog.log_debug(
+            f"Running {len(prepared)} cmds over one transport, "
+            f"max_concurrency: {max_concurrency}, timeout: {timeout}"
+        )
+        results: List[Optional[CmdResult]] = [None] * len(prepared)
+        errors: List[Optional[Exception]] = [None] * len(prepared)
+        start_times = {}
+        with self._pooled_ssh(connection_timeout) as ssh:
+            transport = ssh.get_transport()
+            pending = list(enumerate(prepared))
+            mux = SSHChannelMux()
+            try:
+                while pending or mux.active:
+                    while pending and mux.active < max_concurrency:
+                        index, cmd = pending.pop(0)
+                        start_times[index] = time.time()
+                        channel = SSHChannelMux.open_exec_channel(
+                            transport,
+                            prefix + cmd,
+                            get_pty=get_pty,
+                            timeout=connection_timeout,
+                        )
+                        mux.add(
+                            SSHChannelCollector(
+                                channel,
+                                deadline=start_times[index] + timeout,
+                                tag=index,
+                            )
+                        )
+                    for collector in mux.poll():
+                        index = collector.tag
+                        result = SSHResult(
+                            collector.return_code,
+                            stdout=collector.stdout,
+                            stderr=collector.stderr,
+                            timed_out=collector.timed_out,
+                        )
+                        try:
+                            results[index] = self._process_result(
+                                prepared[index],
+                                result,
+                                start_times[index],
+                                time.time() - start_times[index],
+                                timeout,
+                                ignore_status,
+                                custom_logfile,
+                            )
+                        except Exception as e:
+                            errors[index] = e
+            finally:
+                mux.close()
+        for error in errors:
+            if error is not None:
+                raise error
+        # pyre-fixme[7]: Expected `List[CmdResult]`.
+        return results
+
+    def run_stream(
+        self,
+        cmd: str,
+        ignore_status: bool = False,
+        timeout: int = 600,
+        working_directory: Optional[str] = None,
+        custom_logfile: Optional[str] = None,
+        get_pty: bool = False,
+        sudo: bool = False,
+        sudo_options: Optional[List[str]] = DEFAULT_SUDO_OPTIONS,
+        connection_timeout: int = 60,
+        path_env: Optional[List[str]] = None,
+        raw: bool = False,
+        line_callback: Optional[Callable[[str, str], None]] = None,
+    ) -> CmdStream:
+        """
+        SSHConn.run_stream() runs cmd and returns a CmdStream yielding its
+        output while the command is still running. See CmdStream.
+
+        The pooled SSH session is held until the stream is exhausted or closed.
+        Closing the stream early closes the exec channel.
+        """
+        if working_directory:
+            cmd = "cd %s && %s" % (working_directory, cmd)
+        AutovalLog.log_debug(
+            f'Streaming cmd: "{cmd}", timeout: {timeout}, working_directory: {working_directory}'
+        )
+        cmd = self._add_sudo(cmd, sudo, sudo_options)
+        path_env = self._get_path_env(path_env)
+        exec_cmd = cmd
+        if path_env:
+            exec_cmd = "export PATH=$PATH:" + ":".join(path_env) + f";{cmd}"
+        state = {"return_code": -1}
+
+        # pyre-fixme[3]: Return type must be annotated.
+        def source():
+            with self._pooled_ssh(connection_timeout) as ssh:
+                channel = SSHChannelMux.open_exec_channel(
+                    ssh.get_transport(),
+                    exec_cmd,
+                    get_pty=get_pty,
+                    timeout=connection_timeout,
+                )
+                collector = SSHChannelCollector(
+                    channel, deadline=time.time() + timeout
+                )
+                try:
+                    yield from collector.iter_chunks()
+                finally:
+                    state["return_code"] = collector.return_code
+
+        return CmdStream(
+            self,
+            cmd,
+            source(),
+            lambda: state["return_code"],
+            ignore_status=ignore_status,
+            timeout=timeout,
+            custom_logfile=custom_logfile,
+            raw=raw,
+            line_callback=line_callback,
+        )
+
+    def _add_sudo(
+        self, cmd: str, sudo: bool, sudo_options: Optional[List[str]]
+    ) -> str:
+        if sudo or self.sudo:
+            options = ""
+            if sudo_options is not None:
+                options = " ".join(sudo_options)
+            cmd = f"sudo {options} {cmd}"
+        return cmd
+
+    def _get_path_env(self, path_env: Optional[List[str]]) -> Optional[List[str]]:
+        if not self.is_root:
+            path_env = list(path_env or [])
+            path_env.extend(["/usr/sbin", "/usr/bin", "/sbin"])
+        return path_env
+
+    def _process_result(
+        self,
+        cmd: str,
+        result: SSHResult,
+        start_time: float,
+        duration: float,
+        timeout: int,
+        ignore_status: bool,
+        custom_logfile: Optional[str],
+    ) -> CmdResult:
+        """
+        Logs a finished command to cmd_metrics and cmdlog and raises on
+        timeout or non-zero exit status unless ignore_status is set.
+        """
+        # Spilled outputs are only logged as head and tail
+        stdout = LazyOutput.peek(result, "stdout")
+        stderr = LazyOutput.peek(result, "stderr")
+        _out = OutputCapture.summarize(stdout) + OutputCapture.summarize(stderr)
+        self._log_cmd_metrics(cmd, start_time, duration, result.return_code, _out)
+        ConnectionUtils.log_cmdlog(
+            self.hostname, cmd, result.return_code, _out, custom_logfile
+        )
+        if result.return_code == 124:
+            raise TimeoutError(
+                f"[{cmd}] timed out. Failed to complete within {timeout} seconds on {self.hostname}"
+            )
+        if result.return_code != 0 and not ignore_status:
+            msg = "Command returned non-zero exit status on %s" % (self.hostname)
+            if "command not found" in _out:
+                raise CmdError(cmd, result, msg, error_type=ErrorType.CMD_NOT_FOUND_ERR)
+            raise CmdError(cmd, result, msg)
+        return CmdResult(cmd, stdout, stderr, result.return_code, duration)
+
+    def _pool_key(self, user: Optional[str] = None) -> tuple:
+        return (
+            self.hostname,
+            self.port,
+            user or self.user or "root",
+            self.password,
+            self.allow_agent,
+            SSHTransportOptions.freeze(self.transport_options),
+        )
+
+    @contextmanager
+    def _pooled_ssh(
+        self,
+        connection_timeout: int = 60,
+        keepalive: int = 0,
+        user: Optional[str] = None,
+    ) -> Iterator[SSH]:
+        """
+        Checks out an authenticated SSH session to this host from the
+        process-wide SSHConnectionPool and returns it once the block exits.
+        user overrides the user of the connection, see FILE_TRANSFER_USER.
+        """
+        with SSHConnectionPool.connection(
+            self._pool_key(user),
+            self._ssh_factory(connection_timeout, keepalive, user),
+        ) as ssh:
+            if keepalive and keepalive != ssh.keepalive:
+                ssh.set_keepalive(keepalive)
+            yield ssh
+
+    def _ssh_factory(
+        self,
+        connection_timeout: int = 60,
+        keepalive: int = 0,
+        user: Optional[str] = None,
+    ) -> Callable[[], SSH]:
+        """
+        Returns a callable building a new, not yet connected SSH object to
+        this host, used by SSHConnectionPool on a pool miss.
+        """
+        key_args = {
+            "host": self.hostname,
+            "user": user or self.user,
+            "password": self.password,
+            "port": self.port,
+            "allow_agent": self.allow_agent,
+            "connection_timeout": connection_timeout,
+            "keepalive": keepalive,
+            "transport_options": self.transport_options,
+        }
+        return lambda: SSH(**key_args)
+
+    def _log_transfer_metrics(
+        self, operation: str, path: str, size: int, start_time: float
+    ) -> None:
+        """
+        Records an SFTP transfer in cmd_metrics along with its throughput
+        """
+        duration = time.time() - start_time
+        throughput = size / duration / (1024 * 1024) if duration > 0 else 0.0
+        msg = f"{size} bytes in {duration:.3f}s ({throughput:.2f} MiB/s)"
+        AutovalLog.log_debug(f"SFTP {operation} {path}: {msg}")
+        self._log_cmd_metrics(f"sftp {operation} {path}", start_time, duration, 0, msg)
+
     # pyre-fixme[3]: Return type must be annotated.
     def ssh_connect(self):
         # Establishes connection to the host
@@ -425,13 +1032,19 @@ class SSHConn(ConnectionAbstract):
     def read_file(self, file_path, decode_ascii: bool = False, **kwargs):
         # Reads file_path and returns its contents as string
 
-        with SSH(self.hostname, port=self.port, password=self.password) as ssh:
+        with self._pooled_ssh(user=FILE_TRANSFER_USER) as ssh:
             try:
-                # pyre-fixme[16]: `SSH` has no attribute `_ssh`.
-                sftp = ssh._ssh.open_sftp()
-                remote_file = sftp.open(file_path)
-                content = remote_file.read().rstrip()
-                remote_file.close()
+                start_time = time.time()
+                with ssh.get_sftp().open(file_path) as remote_file:
+                    # Small files fit in a single request. Only when the first
+                    # request comes back full are the remaining reads of the
+                    # file pipelined, sized by a stat of the remote file.
+                    content = remote_file.read(remote_file.MAX_REQUEST_SIZE)
+                    if len(content) == remote_file.MAX_REQUEST_SIZE:
+                        remote_file.prefetch()
+                        content += remote_file.read()
+                self._log_transfer_metrics("read", file_path, len(content), start_time)
+                content = content.rstrip()
                 if decode_ascii:
                     content = ConnectionUtils.str_encode(content)
             except Exception as e:
@@ -442,20 +1055,45 @@ class SSHConn(ConnectionAbstract):
     def get_file(self, file_path, target, **kwargs) -> None:
         # Copies file_path from remote system to target on local system
 
-        with SSH(self.hostname, port=self.port, password=self.password) as ssh:
+        with self._pooled_ssh(user=FILE_TRANSFER_USER) as ssh:
             try:
-                # pyre-fixme[16]: `SSH` has no attribute `_ssh`.
-                sftp = ssh._ssh.open_sftp()
-                sftp.get(file_path, target)
+                start_time = time.time()
+                # SFTPClient.get() prefetches, i.e. pipelines the reads
+                ssh.get_sftp().get(file_path, target)
+                self._log_transfer_metrics(
+                    "get", file_path, os.path.getsize(target), start_time
+                )
             except Exception as e:
                 raise Exception("Failed to get file %s: %s" % (file_path, str(e)))
 
-    # pyre-fixme[2]: Parameter must be annotated.
-    def put_file(self, file_path, target, **kwargs) -> None:
+    def put_file(
+        self,
+        # pyre-fixme[2]: Parameter must be annotated.
+        file_path,
+        # pyre-fixme[2]: Parameter must be annotated.
+        target,
+        hash_algo: Optional[str] = None,
+        chunked: Optional[bool] = None,
+        # pyre-fixme[2]: Parameter must be annotated.
+        **kwargs,
+    ) -> None:
         """Transfers local file to remote host over ssh.
+
+        The transfer is skipped when target already has the same size and
+        checksum. Otherwise the source checksum is computed while the file is
+        uploaded and compared with the checksum of target afterwards.
+
+        Files above the chunked_transfer threshold are uploaded in parallel
+        ranges over several sessions and verified range by range, see
+        ChunkedUpload.
+
         Args:
             file_path: Source file path
             target: target file path
+            hash_algo: "sha256", "md5" or "xxh64". Defaults to the
+                file_transfer_hash_algo site setting, or sha256.
+            chunked: force (True) or disable (False) the chunked transfer.
+                Defaults to chunking files above the size threshold.
         Returns:
             None
 
@@ -468,76 +1106,87 @@ class SSHConn(ConnectionAbstract):
         AutovalLog.log_debug(
             f"Transferring {file_path} to remote host {self.hostname} at {target}"
         )
-        md5sum_cmd_output = AutovalUtils.run_get_output(f"md5sum {file_path}")
-        source_file_md5sum = md5sum_cmd_output.split()[0]
-        AutovalLog.log_debug(f"Source file md5sum : {source_file_md5sum}")
-        with SSH(self.hostname, port=self.port, password=self.password) as ssh:
+        hash_algo = FileDigest.get_algo(hash_algo)
+        source_stat = os.stat(file_path)
+        with self._pooled_ssh(user=FILE_TRANSFER_USER) as ssh:
+            try:
+                target_size = ssh.get_sftp().stat(target).st_size
+            except IOError:
+                target_size = None
+        if target_size == source_stat.st_size:
+            source_digest = FileDigest.compute(file_path, hash_algo)
+            if self._get_remote_digest(target, hash_algo) == source_digest:
+                AutovalLog.log_as_cmd(
+                    f"{target} on {self.hostname} is up to date ({hash_algo} {source_digest}), skipping transfer"
+                )
+                return
+        if chunked is None:
+            chunked = ChunkedUpload.should_chunk(source_stat.st_size)
+        if chunked:
+            start_time = time.time()
+            try:
+                ChunkedUpload(
+                    self, file_path, target, source_stat.st_size, hash_algo
+                ).run()
+            except Exception as e:
+                raise Exception(
+                    f"Failed to transfer source file {file_path} to remote host {self.hostname} at {target}. Reason : {e}"
+                )
+            self._log_transfer_metrics("put", target, source_stat.st_size, start_time)
+            return
+        with self._pooled_ssh(user=FILE_TRANSFER_USER) as ssh:
             try:
-                # pyre-fixme[16]: `SSH` has no attribute `_ssh`.
-                sftp = ssh._ssh.open_sftp()
-                sftp.put(file_path, target)
+                start_time = time.time()
+                hasher = FileDigest.new(hash_algo)
+                with open(file_path, "rb") as source_file:
+                    # SFTPClient.putfo() pipelines the writes
+                    attrs = ssh.get_sftp().putfo(
+                        HashingReader(source_file, hasher), target
+                    )
+                self._log_transfer_metrics("put", target, attrs.st_size, start_time)
             except Exception as e:
                 raise Exception(
                     f"Failed to transfer source file {file_path} to remote host {self.hostname} at {target}. Reason : {e}"
                 )
-        md5sum_cmd_result = self.run_get_result(cmd=f"md5sum {target}")
-        target_file_md5sum = md5sum_cmd_result.stdout.split()[0]
-        AutovalLog.log_debug(f"target file md5sum : {target_file_md5sum}")
-        if source_file_md5sum != target_file_md5sum:
+        source_digest = hasher.hexdigest()
+        FileDigest.store(file_path, hash_algo, source_digest, source_stat)
+        AutovalLog.log_debug(f"Source file {hash_algo} : {source_digest}")
+        target_digest = self._get_remote_digest(target, hash_algo)
+        AutovalLog.log_debug(f"target file {hash_algo} : {target_digest}")
+        if source_digest != target_digest:
             raise Exception(
-                "Failed to transfer source file {file_path} to remote host {self.hostname} at {target}. Reason : Source file checksum {source_file_md5sum} and target file checksum {target_file_md5sum} do not match"
+                f"Failed to transfer source file {file_path} to remote host {self.hostname} at {target}. Reason : Source file checksum {source_digest} and target file checksum {target_digest} do not match"
             )
 
+    def _get_remote_digest(self, path: str, hash_algo: str) -> Optional[str]:
+        """
+        Returns the hash_algo checksum of path on the remote host, or None if
+        it could not be computed.
+        """
+        result = self.run_get_result(
+            FileDigest.remote_command(hash_algo, path), ignore_status=True
+        )
+        if result.return_code != 0 or not result.stdout.strip():
+            return None
+        return result.stdout.split()[0]
+
     def scp_file(
         self, source_location: str, file_tocopy: str, destination_location: str
     ) -> str:
         # Prefer put_file method to transfer file
 
-        # calculates and validates the checksum of the file
-        # and then copies the file from source to destination using scp
-
-        target = self.hostname
-        password = self.password
+        # calculates and validates the checksum of the file and then copies
+        # it from source to destination over an exec channel of a pooled
+        # session, which also works with SSH servers without SFTP (dropbear)
         AutovalLog.log_as_cmd("Copying the required version to the OpenBMC")
+        source = os.path.join(source_location, file_tocopy)
+        target = posixpath.join(destination_location, file_tocopy)
         try:
-            output = AutovalUtils.run_get_output(
-                " md5sum %s/%s" % (source_location, file_tocopy)
-            )
-            md5sum_before_copy = output.split()[0]
-            try:
-                cmd = (
-                    "sshpass -p '%s' scp -6 -o StrictHostKeyChecking=no"
-                    " -o UserKnownHostsFile=/dev/null %s/%s"
-                    % (password, source_location, file_tocopy)
-                )
-
-                output = AutovalUtils.run_get_output(
-                    r"%s root@[\%s\]:%s" % (cmd, target, destination_location)
-                )
-                append_string = "-6"
-            except Exception:
-                cmd = (
-                    "sshpass -p '%s' scp -o StrictHostKeyChecking=no"
-                    " -o UserKnownHostsFile=/dev/null %s/%s"
-                    % (password, source_location, file_tocopy)
-                )
-
-                output = AutovalUtils.run_get_output(
-                    "%s root@%s:%s" % (cmd, target, destination_location)
-                )
-                append_string = ""
+            md5sum_before_copy = FileDigest.compute(source, "md5")
+            self._put_file_exec(source, target)
             # after copy check md5sum on the system
-            cmd = (
-                "sshpass -p '%s' ssh %s -o StrictHostKeyChecking=no"
-                " -o UserKnownHostsFile=/dev/null" % (password, append_string)
-            )
-            output = AutovalUtils.run_get_output(
-                '%s root@%s "md5sum %s/%s"'
-                % (cmd, target, destination_location, file_tocopy)
-            )
-            md5sum_after_copy = output.split()[0]
-
-            if str(md5sum_before_copy) not in str(md5sum_after_copy):
+            md5sum_after_copy = self._get_remote_digest(target, "md5")
+            if md5sum_before_copy != md5sum_after_copy:
                 raise Exception("checksum doesnt match, its not safe to proceed")
 
             AutovalLog.log_as_cmd("checksum matches")
@@ -545,25 +1194,111 @@ class SSHConn(ConnectionAbstract):
         except Exception as e:
             raise Exception("Failed to scp file %s: %s" % (file_tocopy, str(e)))
 
+    def _put_file_exec(self, file_path: str, target: str) -> None:
+        """
+        Streams file_path into `cat > target` on the remote host
+        """
+        with self._pooled_ssh(user=FILE_TRANSFER_USER) as ssh:
+            start_time = time.time()
+            channel = ssh.get_transport().open_session(timeout=60)
+            try:
+                channel.exec_command(f"cat > {target}")
+                with open(file_path, "rb") as source_file:
+                    for chunk in iter(
+                        lambda: source_file.read(STREAM_CHUNK_SIZE), b""
+                    ):
+                        channel.sendall(chunk)
+                channel.shutdown_write()
+                return_code = channel.recv_exit_status()
+            finally:
+                channel.close()
+            if return_code != 0:
+                raise Exception(f"Writing {target} exited with {return_code}")
+            self._log_transfer_metrics(
+                "scp", target, os.path.getsize(file_path), start_time
+            )
+
     # pyre-fixme[2]: Parameter must be annotated.
     def rsync_file(self, src, dst, quick=None) -> None:
-        target = self.hostname
-        cmd0 = ""
-        cmd1 = ""
-
-        if quick:
-            cmd1 += "--ignore-existing "
-        cmd1 += "%s root@[%s]:%s" % (src, target, dst)
+        """
+        Recursively copies the local file or directory src to dst on the
+        remote host over the pooled SFTP session, following rsync rules:
+        "dir" lands in dst/dir, "dir/" copies the content of dir into dst.
 
+        Files whose size and modification time match the remote copy are
+        skipped. With quick, existing remote files are never overwritten
+        (rsync --ignore-existing).
+        """
+        target = self.hostname
         try:
-            cmd0 = "sshpass -p %s rsync -rzq " % self.password
-            AutovalUtils.run_get_output(cmd0 + cmd1)
+            with self._pooled_ssh(user=FILE_TRANSFER_USER) as ssh:
+                sftp = ssh.get_sftp()
+                dst = self._rsync_target(sftp, src, dst)
+                if os.path.isdir(src):
+                    for root, _, files in os.walk(src):
+                        remote_root = posixpath.join(
+                            dst, os.path.relpath(root, src).replace(os.sep, "/")
+                        )
+                        self._sftp_makedirs(sftp, posixpath.normpath(remote_root))
+                        for name in files:
+                            self._rsync_one(
+                                sftp,
+                                os.path.join(root, name),
+                                posixpath.join(remote_root, name),
+                                quick,
+                            )
+                else:
+                    self._rsync_one(sftp, src, dst, quick)
         except BaseException as e:
             raise Exception("rsync failed %s %s %s : %s" % (src, target, dst, str(e)))
 
+    def _rsync_target(self, sftp: paramiko.SFTPClient, src: str, dst: str) -> str:
+        # Like rsync, copy into dst if it is an existing directory
+        if os.path.isdir(src) and src.endswith("/"):
+            return dst
+        try:
+            if stat.S_ISDIR(sftp.stat(dst).st_mode):
+                return posixpath.join(dst, os.path.basename(src.rstrip("/")))
+        except IOError:
+            pass
+        return dst
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    def _rsync_one(self, sftp: paramiko.SFTPClient, src: str, dst: str, quick) -> None:
+        local_stat = os.stat(src)
+        try:
+            remote_stat = sftp.stat(dst)
+        except IOError:
+            remote_stat = None
+        if remote_stat is not None and (
+            quick
+            or (
+                remote_stat.st_size == local_stat.st_size
+                and remote_stat.st_mtime == int(local_stat.st_mtime)
+            )
+        ):
+            return
+        start_time = time.time()
+        sftp.put(src, dst)
+        # Keep the mtime, so an unchanged file is skipped next time
+        sftp.utime(dst, (local_stat.st_atime, local_stat.st_mtime))
+        sftp.chmod(dst, stat.S_IMODE(local_stat.st_mode))
+        self._log_transfer_metrics("rsync", dst, local_stat.st_size, start_time)
+
+    def _sftp_makedirs(self, sftp: paramiko.SFTPClient, path: str) -> None:
+        try:
+            sftp.stat(path)
+            return
+        except IOError:
+            pass
+        parent = posixpath.dirname(path)
+        if parent and parent != path:
+            self._sftp_makedirs(sftp, parent)
+        sftp.mkdir(path)
+
     """
     Purpose:
-    Helper function to run commands within the host to the remote machine using sshpass command line utility. This helps to address use cases to detect usb0 access from the DUT
+    Helper function to run commands on a third host reached through the remote machine. This helps to address use cases to detect usb0 access from the DUT
     Params:
     cmd: str Command to run the remote host
     hostname: str hostname/ip address to connect
@@ -585,39 +1320,124 @@ class SSHConn(ConnectionAbstract):
         pubkey_auth: bool = False,
         timeout: int = 600,
     ):
-        pubkey_auth_value = "yes" if pubkey_auth else "no"
-        out = self.run_get_result(
-            f"timeout {timeout} sudo sshpass -p {password} "
-            "ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no "
-            f"-o PubkeyAuthentication={pubkey_auth_value} "
-            f"{user}@{hostname} {cmd}"
-        )
+        # The session to hostname is tunneled through a direct-tcpip channel
+        # of a session to this host, and pooled like any other session.
+        key = (hostname, 22, user or "root", password, pubkey_auth, self._pool_key())
+
+        @contextmanager
+        def open_tunnel() -> Iterator[Channel]:
+            # The session to this host stays checked out for as long as the
+            # session to hostname runs over it, idle in the pool or not
+            with self._pooled_ssh() as ssh:
+                yield ssh.get_transport().open_channel(
+                    "direct-tcpip", (hostname, 22), ("127.0.0.1", 0), timeout=60
+                )
+
+        def factory() -> SSH:
+            return SSH(
+                hostname,
+                user=user,
+                password=password,
+                allow_agent=False,
+                use_keys=pubkey_auth,
+                gateway=open_tunnel,
+            )
+
+        hop_cmd = f"{cmd} (on {user}@{hostname} via {self.hostname})"
+        with SSHConnectionPool.connection(key, factory) as hop:
+            start_time = time.time()
+            with SSHCommand(hop, [cmd], timeout) as result:
+                out = self._process_result(
+                    hop_cmd,
+                    result,
+                    start_time,
+                    time.time() - start_time,
+                    timeout,
+                    False,
+                    None,
+                )
         return out.stdout
 
 
 class SSHAgent:
     """
-    Class to invoke ssh agent locally, record SSH_AUTH_SOCK
-    and SSH_AGENT_PID. Kill the PID at the end of the session.
+    Forwards a local ssh agent holding the ssh_key_path keys to the session.
+
+    The agent is started and loaded with the keys once per process and shared
+    by every forwarded command on every host; it is killed at exit.
     Call SSHAgentForwardRequest to forward the agent to the provided channel session
     """
 
+    _lock = threading.Lock()
+    _ssh_agent_pid: str = ""
+    _ssh_auth_sock: str = ""
+    _atexit_registered = False
+
     # pyre-fixme[3]: Return type must be annotated.
     # pyre-fixme[2]: Parameter must be annotated.
     def __init__(self, ssh, forward_ssh_agent: bool = False):
         self.forward_ssh_agent = forward_ssh_agent
         # pyre-fixme[4]: Attribute must be annotated.
         self.ssh = ssh
-        self._ssh_agent_pid: str = ""
-        # pyre-fixme[24]: Generic type `list` expects 1 type parameter, use
-        #  `typing.List[<element type>]` to avoid runtime subscripting errors.
-        self.id_rsa_path: list = SiteUtils().get_ssh_key_path()
-        self._ssh_auth_sock: str = ""
         self.agent_forward_req: Optional[SSHAgentForwardRequest] = None
 
     def __enter__(self) -> "SSHAgent":
         if not self.forward_ssh_agent:
             return self
+        auth_sock = SSHAgent.get_auth_sock()
+        # Forward ssh agent on the open channel
+        transport = self.ssh._ssh.get_transport()
+        if transport is not None:
+            self.agent_forward_req = SSHAgentForwardRequest(
+                transport.open_session(), auth_sock
+            )
+            AutovalLog.log_debug("SSH Agent cert forwarded")
+        return self
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if not self.forward_ssh_agent:
+            return
+        # Closing all connections and threads, the agent itself is shared
+        if self.agent_forward_req:
+            self.agent_forward_req.close()
+
+    @classmethod
+    def get_auth_sock(cls) -> str:
+        """
+        Returns the SSH_AUTH_SOCK of the shared agent, starting it and adding
+        the keys on first use or if it died.
+        """
+        with cls._lock:
+            if not cls._is_agent_alive():
+                cls._start_agent()
+            return cls._ssh_auth_sock
+
+    @classmethod
+    def stop_agent(cls) -> None:
+        with cls._lock:
+            if cls._ssh_agent_pid:
+                subprocess.run(
+                    ["kill", "-9", cls._ssh_agent_pid],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+            cls._ssh_agent_pid = ""
+            cls._ssh_auth_sock = ""
+
+    @classmethod
+    def _is_agent_alive(cls) -> bool:
+        if not cls._ssh_agent_pid or not os.path.exists(cls._ssh_auth_sock):
+            return False
+        try:
+            os.kill(int(cls._ssh_agent_pid), 0)
+        except OSError:
+            return False
+        return True
+
+    @classmethod
+    def _start_agent(cls) -> None:
+        # Must be called with cls._lock held
         # Run the ssh agent and get the PID and path
         completed_process = subprocess.run(
             ["ssh-agent"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True
@@ -630,15 +1450,17 @@ class SSHAgent:
             r"SSH_AUTH_SOCK=(.*);\s+export\s+SSH_AUTH_SOCK", completed_process.stdout
         )
         ssh_agent = re.search(r"SSH_AGENT_PID=(\d+);", completed_process.stdout)
-        if ssh_auth and ssh_agent:
-            self._ssh_auth_sock = ssh_auth.group(1)
-            self._ssh_agent_pid = ssh_agent.group(1)
-        else:
+        if not ssh_auth or not ssh_agent:
             raise SSHException("Failed to find SSH_AUTH_SOCK or SSH_AGENT_PID")
+        if not cls._atexit_registered:
+            cls._atexit_registered = True
+            atexit.register(cls.stop_agent)
+        cls._ssh_auth_sock = ssh_auth.group(1)
+        cls._ssh_agent_pid = ssh_agent.group(1)
         # Add certs to the running agent
         env = os.environ.copy()
-        env["SSH_AUTH_SOCK"] = self._ssh_auth_sock
-        for path in self.id_rsa_path:
+        env["SSH_AUTH_SOCK"] = cls._ssh_auth_sock
+        for path in SSHKeyCache.get_key_paths():
             completed_process = subprocess.run(
                 ["ssh-add", path],
                 stdout=subprocess.PIPE,
@@ -650,25 +1472,7 @@ class SSHAgent:
                 raise SSHException(
                     f"Failed to add certs to ssh agent. {completed_process.stdout}"
                 )
-        # Forward ssh agent on the open channel
-        transport = self.ssh._ssh.get_transport()
-        if transport is not None:
-            self.agent_forward_req = SSHAgentForwardRequest(
-                transport.open_session(), self._ssh_auth_sock
-            )
-            AutovalLog.log_info("SSH Agent invoked and cert forwarded")
-        return self
-
-    # pyre-fixme[2]: Parameter must be annotated.
-    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        if not self.forward_ssh_agent:
-            return
-        # Closing all connections and threads
-        if self.agent_forward_req:
-            self.agent_forward_req.close()
-        # Killing the agent to make sure socket connection with the ssh-agent closes and
-        # all the threads invoked in AgentProxyThread are terminated.
-        subprocess.run(["kill", "-9", self._ssh_agent_pid])
+        AutovalLog.log_info("SSH Agent invoked")
 
 
 class AgentConnectionHandler(AgentClientProxy):
@@ -739,3 +1543,5 @@ class SSHAgentForwardRequest:
     def close(self):
         for p in self.__clientProxys:
             p.close()
+        # The transport is pooled, so do not leave the forwarding session open
+        self.__chanC.close()
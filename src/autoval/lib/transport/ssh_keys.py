@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Process-wide cache of SSH credentials.
+
+Every new SSH session used to resolve the ssh_key_path site setting, stat each
+key file, re-read ~/.ssh/known_hosts and let paramiko parse the private keys
+from disk again. SSHKeyCache does that work once per process. Cached entries
+are keyed by file modification time, so a key or known_hosts file that changes
+on disk is picked up on the next connect.
+"""
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import paramiko
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.site_utils import SiteUtils
+
+KNOWN_HOSTS_PATH = "~/.ssh/known_hosts"
+# Key types tried, in order, when parsing a private key file
+KEY_CLASSES = [
+    cls_name
+    for cls_name in ("Ed25519Key", "ECDSAKey", "RSAKey", "DSSKey")
+    if hasattr(paramiko, cls_name)
+]
+# Suffix of the certificate paramiko loads along with a private key file
+CERT_SUFFIX = "-cert.pub"
+
+
+class SSHKeyCache:
+    _lock = threading.Lock()
+    _key_paths: Optional[List[str]] = None
+    # (path, passphrase) -> ((key mtime_ns, certificate mtime_ns), parsed key
+    # or None if it could not be parsed)
+    _pkeys: Dict[
+        Tuple[str, Optional[str]],
+        Tuple[Tuple[int, Optional[int]], Optional[paramiko.PKey]],
+    ] = {}
+    # pyre-fixme[4]: Attribute must be annotated.
+    _host_keys = None
+    _host_keys_mtime: Optional[int] = None
+
+    @classmethod
+    def get_key_paths(cls) -> List[str]:
+        """
+        Returns the existing files of the ssh_key_path site setting.
+        """
+        with cls._lock:
+            if cls._key_paths is None:
+                key_paths = SiteUtils.get_ssh_key_path() or []
+                cls._key_paths = [path for path in key_paths if os.path.exists(path)]
+            return list(cls._key_paths)
+
+    @classmethod
+    def get_pkeys(cls, password: Optional[str] = None) -> List[paramiko.PKey]:
+        """
+        Returns the parsed keys of all key paths, in order. password is the
+        passphrase of encrypted keys, as with key_filename of
+        SSHClient.connect(). Keys that could not be loaded are left out.
+        """
+        pkeys = [cls._get_pkey(path, password) for path in cls.get_key_paths()]
+        return [pkey for pkey in pkeys if pkey is not None]
+
+    @classmethod
+    def authenticate(
+        cls,
+        transport: paramiko.Transport,
+        username: str,
+        pkeys: List[paramiko.PKey],
+        allow_agent: bool,
+        password: Optional[str],
+    ) -> None:
+        """
+        Authenticates the connected transport with pkeys, then with the keys
+        of the ssh-agent if allow_agent is set, then with password. That is
+        the order in which SSHClient.connect() tries key files, for the keys
+        it cannot be passed pre-loaded. Raises the last
+        AuthenticationException if nothing was accepted.
+        """
+        errors: List[Exception] = []
+        if cls._auth_publickeys(transport, username, pkeys, password, errors):
+            return
+        if allow_agent:
+            # Only contacts the ssh-agent once the cached keys were refused
+            agent = paramiko.Agent()
+            try:
+                if cls._auth_publickeys(
+                    transport, username, agent.get_keys(), password, errors
+                ):
+                    return
+            finally:
+                agent.close()
+        if password is not None:
+            transport.auth_password(username, password)
+            return
+        raise (
+            errors[-1]
+            if errors
+            else paramiko.AuthenticationException("No authentication methods available")
+        )
+
+    @classmethod
+    def _auth_publickeys(
+        cls,
+        transport: paramiko.Transport,
+        username: str,
+        # pyre-fixme[2]: Parameter annotation cannot contain `Any`.
+        pkeys: Iterable[Any],
+        password: Optional[str],
+        errors: List[Exception],
+    ) -> bool:
+        """
+        Tries pkeys in order until one is accepted. Errors of the refused
+        keys are appended to errors.
+        """
+        for pkey in pkeys:
+            try:
+                allowed_types = transport.auth_publickey(username, pkey)
+            except paramiko.SSHException as e:
+                errors.append(e)
+                continue
+            # Partial success, the server asks for a password as well
+            if allowed_types and "password" in allowed_types and password is not None:
+                transport.auth_password(username, password)
+            return True
+        return False
+
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    def get_host_keys(cls):
+        """
+        Returns the parsed known_hosts file of the current user, reloading it
+        only when the file changed. The object is shared, callers must treat
+        it as read-only.
+        """
+        path = os.path.expanduser(KNOWN_HOSTS_PATH)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            mtime = None
+        with cls._lock:
+            if cls._host_keys is None or mtime != cls._host_keys_mtime:
+                host_keys = paramiko.HostKeys()
+                if mtime is not None:
+                    try:
+                        host_keys.load(path)
+                    except IOError as e:
+                        AutovalLog.log_debug(f"Failed to load {path}: {e}")
+                cls._host_keys = host_keys
+                cls._host_keys_mtime = mtime
+            return cls._host_keys
+
+    @classmethod
+    def invalidate(cls) -> None:
+        """
+        Drops all cached keys, e.g. after the site settings or known_hosts
+        were changed by the test itself.
+        """
+        with cls._lock:
+            cls._key_paths = None
+            cls._pkeys = {}
+            cls._host_keys = None
+            cls._host_keys_mtime = None
+
+    @classmethod
+    def _get_pkey(
+        cls, path: str, password: Optional[str] = None
+    ) -> Optional[paramiko.PKey]:
+        """
+        Loads the private key at path like SSHClient.connect() loads
+        key_filename: encrypted keys are decrypted with password and a
+        <path>-cert.pub certificate next to the key is attached to it.
+        """
+        if path.endswith(CERT_SUFFIX):
+            key_path, cert_path = path[: -len(CERT_SUFFIX)], path
+        else:
+            key_path, cert_path = path, path + CERT_SUFFIX
+        try:
+            mtime = os.stat(key_path).st_mtime_ns
+        except OSError:
+            return None
+        try:
+            cert_mtime: Optional[int] = os.stat(cert_path).st_mtime_ns
+        except OSError:
+            cert_mtime = None
+        cache_key = (path, password)
+        with cls._lock:
+            cached = cls._pkeys.get(cache_key)
+            if cached is not None and cached[0] == (mtime, cert_mtime):
+                return cached[1]
+        key = None
+        for cls_name in KEY_CLASSES:
+            key_class = getattr(paramiko, cls_name)
+            try:
+                key = key_class.from_private_key_file(key_path)
+                break
+            except paramiko.PasswordRequiredException:
+                if password is None:
+                    continue
+                try:
+                    key = key_class.from_private_key_file(key_path, password=password)
+                    break
+                except Exception:
+                    continue
+            except Exception:
+                continue
+        if key is None:
+            AutovalLog.log_info(f"Could not load ssh key {key_path}, skipping it")
+        elif cert_mtime is not None:
+            try:
+                key.load_certificate(cert_path)
+            except Exception as e:
+                AutovalLog.log_info(f"Could not load ssh certificate {cert_path}: {e}")
+        with cls._lock:
+            cls._pkeys[cache_key] = ((mtime, cert_mtime), key)
+        return key
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Process-wide pool of authenticated SSH sessions.
+
+SSHConn used to build a brand new SSH object for every single command, which
+costs a TCP connect, a key exchange and an authentication round trip each time.
+SSHConnectionPool keeps idle sessions around, keyed by (host, port, user, auth),
+so the next command to the same target can skip the handshake entirely.
+
+Pool behaviour can be tuned through the "ssh_connection_pool" site setting:
+    {
+        "enabled": true,            # false restores one session per command
+        "idle_timeout": 300,        # idle sessions older than this are closed
+        "max_idle_per_host": 8,     # idle sessions kept per key
+        "health_check_idle": 10     # probe sessions idle for longer than this
+    }
+"""
+import atexit
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Hashable, Iterator
+
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.site_utils import SiteUtils
+
+DEFAULT_POOL_SETTINGS = {
+    "enabled": True,
+    "idle_timeout": 300,
+    "max_idle_per_host": 8,
+    "health_check_idle": 10,
+}
+# File transfers (read_file, get_file, put_file, ...) always went through
+# sessions of this user, whatever user the connection runs commands as
+FILE_TRANSFER_USER = "root"
+
+
+class SSHConnectionPool:
+    """
+    Thread-safe pool of live SSH sessions shared by every SSHConn in the process.
+
+    Sessions are checked out exclusively: a caller gets a connected SSH object
+    from acquire() (or the connection() context manager) and hands it back with
+    release(). Idle sessions are health checked on checkout, so a session that
+    died underneath us, e.g. because the host rebooted, is transparently
+    replaced by a fresh handshake.
+
+    Pooled objects only need to provide:
+        is_alive(probe: bool) -> bool
+        _disconnect() -> None
+    """
+
+    _lock = threading.Lock()
+    # pyre-fixme[4]: Attribute must be annotated.
+    _idle = defaultdict(deque)
+    # pyre-fixme[4]: Attribute must be annotated.
+    _stats = {
+        "hits": 0,
+        "misses": 0,
+        "handshakes": 0,
+        "evictions": 0,
+        "discards": 0,
+    }
+    # pyre-fixme[4]: Attribute must be annotated.
+    _settings = None
+    _atexit_registered = False
+
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    def get_settings(cls):
+        if cls._settings is None:
+            settings = dict(DEFAULT_POOL_SETTINGS)
+            try:
+                settings.update(
+                    SiteUtils.get_site_setting("ssh_connection_pool", raise_error=False)
+                    or {}
+                )
+            except Exception:
+                pass
+            cls._settings = settings
+        return cls._settings
+
+    @classmethod
+    def acquire(cls, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Check out a connected session for key.
+
+        Idle sessions are reused (most recently used first) if they pass the
+        health check, otherwise factory() is called to build a new SSH object
+        which is then connected.
+        """
+        settings = cls.get_settings()
+        if settings["enabled"]:
+            while True:
+                now = time.time()
+                with cls._lock:
+                    cls._evict_idle(now)
+                    idle = cls._idle.get(key)
+                    entry = idle.pop() if idle else None
+                if entry is None:
+                    break
+                ssh, last_used = entry
+                probe = now - last_used > settings["health_check_idle"]
+                if ssh.is_alive(probe=probe):
+                    cls._count("hits")
+                    return ssh
+                AutovalLog.log_debug(f"Discarding dead pooled SSH session {key[0]}")
+                cls._count("discards")
+                cls._close(ssh)
+        cls._count("misses")
+        ssh = factory()
+        ssh._connect_to_host()
+        cls._count("handshakes")
+        cls._register_atexit()
+        return ssh
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def release(cls, key: Hashable, ssh) -> None:
+        """
+        Return a session to the pool. Dead sessions are closed instead.
+        """
+        settings = cls.get_settings()
+        if not settings["enabled"] or not ssh.is_alive(probe=False):
+            cls._close(ssh)
+            return
+        evicted = None
+        with cls._lock:
+            idle = cls._idle[key]
+            idle.append((ssh, time.time()))
+            if len(idle) > settings["max_idle_per_host"]:
+                evicted, _ = idle.popleft()
+                cls._stats["evictions"] += 1
+        if evicted is not None:
+            cls._close(evicted)
+
+    @classmethod
+    @contextmanager
+    # pyre-fixme[2]: Parameter must be annotated.
+    def connection(cls, key: Hashable, factory: Callable[[], Any]) -> Iterator[Any]:
+        """
+        Context manager wrapping acquire() and release().
+        """
+        ssh = cls.acquire(key, factory)
+        try:
+            yield ssh
+        finally:
+            cls.release(key, ssh)
+
+    @classmethod
+    def discard_host(cls, host: str) -> None:
+        """
+        Close all idle sessions to host, e.g. after it was power cycled.
+        """
+        with cls._lock:
+            keys = [key for key in cls._idle if key[0] == host]
+            entries = [entry for key in keys for entry in cls._idle.pop(key)]
+        for ssh, _ in entries:
+            cls._close(ssh)
+
+    @classmethod
+    def close_all(cls) -> None:
+        with cls._lock:
+            entries = [entry for idle in cls._idle.values() for entry in idle]
+            cls._idle.clear()
+        for ssh, _ in entries:
+            cls._close(ssh)
+
+    @classmethod
+    def get_stats(cls) -> Dict[str, int]:
+        """
+        Returns hit/miss/handshake counters and the number of idle sessions.
+        """
+        with cls._lock:
+            stats = dict(cls._stats)
+            stats["idle"] = sum(len(idle) for idle in cls._idle.values())
+        return stats
+
+    @classmethod
+    def reset_stats(cls) -> None:
+        with cls._lock:
+            for name in cls._stats:
+                cls._stats[name] = 0
+
+    @classmethod
+    def _evict_idle(cls, now: float) -> None:
+        # Must be called with cls._lock held
+        idle_timeout = cls.get_settings()["idle_timeout"]
+        for key in list(cls._idle.keys()):
+            idle = cls._idle[key]
+            while idle and now - idle[0][1] > idle_timeout:
+                ssh, _ = idle.popleft()
+                cls._stats["evictions"] += 1
+                # Closing only tears down the local socket, it does not block
+                cls._close(ssh)
+            if not idle:
+                del cls._idle[key]
+
+    @classmethod
+    def _count(cls, name: str) -> None:
+        with cls._lock:
+            cls._stats[name] += 1
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def _close(cls, ssh) -> None:
+        try:
+            ssh._disconnect()
+        except Exception as e:
+            AutovalLog.log_debug(f"Failed to close pooled SSH session: {e}")
+
+    @classmethod
+    def _register_atexit(cls) -> None:
+        if not cls._atexit_registered:
+            cls._atexit_registered = True
+            atexit.register(cls.close_all)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+Per-host tuning of the SSH transport: compression, ciphers and window sizes.
+
+Defaults come from the "ssh_transport" site setting and can be overridden per
+host with the "ssh_transport" key of a TEST_HOSTS entry ("oob_ssh_transport"
+for its BMCs):
+    {
+        "compress": "auto",          # true, false or "auto"
+        "auto_compress_rtt": 0.05,   # "auto" compresses above this TCP RTT (s)
+        "ciphers": ["aes128-gcm@openssh.com", "aes128-ctr"],
+        "window_size": 16777216,     # channel window, paramiko default 2 MiB
+        "max_packet_size": 32768
+    }
+
+With "auto", the TCP connect to the host is timed before the SSH handshake and
+compression is only turned on for slow links, where the CPU spent on zlib is
+cheaper than the bytes saved.
+"""
+from typing import Any, Dict, Optional, Tuple
+
+import paramiko
+from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.site_utils import SiteUtils
+
+DEFAULT_TRANSPORT_SETTINGS = {
+    "compress": False,
+    "auto_compress_rtt": 0.05,
+    "ciphers": None,
+    "window_size": None,
+    "max_packet_size": None,
+}
+
+
+class SSHTransportOptions:
+    # pyre-fixme[4]: Attribute must be annotated.
+    _site_settings = None
+
+    @classmethod
+    # pyre-fixme[2]: Parameter annotation cannot contain `Any`.
+    def resolve(cls, overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Returns the site settings updated with the per-host overrides
+        """
+        if cls._site_settings is None:
+            settings = dict(DEFAULT_TRANSPORT_SETTINGS)
+            try:
+                settings.update(
+                    SiteUtils.get_site_setting("ssh_transport", raise_error=False)
+                    or {}
+                )
+            except Exception:
+                pass
+            cls._site_settings = settings
+        options = dict(cls._site_settings)
+        options.update(overrides or {})
+        return options
+
+    @classmethod
+    # pyre-fixme[2]: Parameter annotation cannot contain `Any`.
+    def freeze(cls, options: Dict[str, Any]) -> Tuple:
+        """
+        Hashable form of options, part of the SSHConnectionPool key so that
+        sessions with different tuning are never mixed up.
+        """
+        return tuple(
+            (key, tuple(value) if isinstance(value, list) else value)
+            for key, value in sorted(options.items())
+        )
+
+    @classmethod
+    def get_connect_kwargs(
+        cls,
+        # pyre-fixme[2]: Parameter annotation cannot contain `Any`.
+        options: Dict[str, Any],
+        rtt: float,
+    ) -> Dict[str, Any]:
+        """
+        Returns the extra arguments of SSHClient.connect for options, rtt is
+        the duration of the TCP connect to the host.
+
+        paramiko offers its ciphers in a fixed order, so "ciphers" restricts
+        the offer to the listed ones by disabling all the others.
+        """
+        kwargs = {}
+        ciphers = options.get("ciphers")
+        if ciphers:
+            # pyre-fixme[16]: `Transport` has no attribute `_preferred_ciphers`.
+            supported = paramiko.Transport._preferred_ciphers
+            disabled = [cipher for cipher in supported if cipher not in ciphers]
+            if len(disabled) < len(supported):
+                kwargs["disabled_algorithms"] = {"ciphers": disabled}
+            else:
+                AutovalLog.log_debug(
+                    f"None of the ciphers {ciphers} is supported, using defaults"
+                )
+        compress = options.get("compress")
+        if compress == "auto":
+            compress = rtt > options["auto_compress_rtt"]
+            AutovalLog.log_debug(
+                f"TCP connect took {rtt * 1000:.1f}ms, "
+                f"compression {'on' if compress else 'off'}"
+            )
+        kwargs["compress"] = bool(compress)
+        return kwargs
+
+    @classmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def apply(cls, transport, options: Dict[str, Any]) -> None:
+        """
+        Sets the window and packet size used by channels opened on transport
+        """
+        if options.get("window_size"):
+            transport.default_window_size = options["window_size"]
+        if options.get("max_packet_size"):
+            transport.default_max_packet_size = options["max_packet_size"]
@@ -12,25 +12,22 @@ import logging
 import os
 import pathlib
 import re
+import selectors
 import shlex
 
 from autoval.lib.utils.autoval_output import AutovalOutput as autoval_output
 
-
-try:
-    import queue
-except Exception:
-    import Queue as queue  # pyre-fixme
 import concurrent
 import inspect
 import signal
 import subprocess
 import sys
+import threading
 import time
 import traceback
+import weakref
 from itertools import zip_longest
-from threading import Timer
-from typing import List, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from autoval.lib.host.component.component import COMPONENT
 from autoval.lib.utils.autoval_errors import ErrorType
@@ -43,6 +40,7 @@ from autoval.lib.utils.autoval_exceptions import (
     TimeoutError,
 )
 from autoval.lib.utils.autoval_log import AutovalLog
+from autoval.lib.utils.output_capture import LazyOutput, OutputCapture
 from autoval.lib.utils.result_handler import ResultHandler
 from autoval.plugins.plugin_manager import PluginManager
 
@@ -52,9 +50,24 @@ MAX_STEP_LINES = 10
 MAX_STEP_CHARS = 250
 # Maximum number of threads for pool executions
 MAX_THREADS = 8
+# Bytes read from a local subprocess pipe at a time
+PIPE_READ_SIZE = 65536
+# Local commands containing any of these need /bin/sh, all others are split
+# with shlex and executed directly
+SHELL_METACHARS = re.compile(r"[|&;<>()$`\\*?\[\]{}#~!\n]")
+# First words that only exist inside the shell
+SHELL_BUILTINS = set(
+    ". : [ alias break case cd command continue eval exec exit export for if "
+    "read readonly return set shift source test times trap type ulimit umask "
+    "unalias unset until wait while".split()
+)
 
 
 class CmdResult:
+    # Spilled outputs are only loaded from disk when accessed
+    stdout = LazyOutput()
+    stderr = LazyOutput()
+
     def __init__(
         self,
         command: str = "",
@@ -204,37 +217,121 @@ class AutovalUtils:
             msg = "Message: {}. ".format(msg) if msg else ""
             raise TestError(f"JSON load failed of '{_str}', msg: {msg}. Error: {e}")
 
+    # Processes started by _popen and AsyncLocalConn, for _forward_sigint
+    # pyre-fixme[4]: Attribute must be annotated.
+    _live_processes = weakref.WeakSet()
+    _sigint_forwarding = False
+
     @classmethod
     # pyre-fixme[2]: Parameter must be annotated.
-    def raise_process_timeout(cls, process, cmd, timeout, queue) -> None:
-        queue.put("Command [%s] timed out after [%d] seconds" % (cmd, timeout))
-        cls.kill_proc_family(process)
+    def _track_process(cls, process) -> None:
+        """
+        Commands lead their own process group, so a Ctrl-C in the terminal
+        only reaches this process. The first command started from the main
+        thread installs a SIGINT handler that forwards the signal to the
+        groups of all running commands, then calls the previous handler.
+        """
+        cls._live_processes.add(process)
+        if cls._sigint_forwarding or (
+            threading.current_thread() is not threading.main_thread()
+        ):
+            return
+        previous = signal.getsignal(signal.SIGINT)
+        if not callable(previous):
+            # SIGINT is ignored, or not handled from Python
+            return
+
+        # pyre-fixme[2]: Parameter must be annotated.
+        def forward(signum, frame) -> None:
+            cls._forward_sigint()
+            previous(signum, frame)
+
+        try:
+            signal.signal(signal.SIGINT, forward)
+        except ValueError:
+            # Not the main interpreter
+            return
+        cls._sigint_forwarding = True
+
+    @classmethod
+    def _forward_sigint(cls) -> None:
+        processes = []
+        for _ in range(3):
+            try:
+                processes = list(cls._live_processes)
+                break
+            except RuntimeError:
+                # Another thread started a command meanwhile
+                continue
+        for process in processes:
+            # Not reaped yet, so the pid still names its group
+            if process.returncode is None:
+                try:
+                    os.killpg(process.pid, signal.SIGINT)
+                except OSError:
+                    pass
 
     @classmethod
     # pyre-fixme[2]: Parameter must be annotated.
     def kill_proc_family(cls, process) -> None:
-        # Kill process and all child processes
+        """
+        Kills process and all its descendants.
+
+        Commands started by _popen lead their own process group, which is
+        killed with a single killpg. Descendants that moved to another group
+        (setsid, daemons) are found with one scan of /proc taken before the
+        kill, while they are still linked to their parents.
+        """
         sig = signal.SIGKILL
-        pids = [process.pid]
-        while pids:
-            tmp_pid = pids.pop()
+        descendants = cls._get_descendant_procs(process.pid)
+        try:
+            group_leader = os.getpgid(process.pid) == process.pid
+        except OSError:
+            group_leader = False
+        if group_leader:
             try:
-                pids.extend(cls._get_child_procs(tmp_pid))
-            except Exception:
+                os.killpg(process.pid, sig)
+            except OSError:
                 pass
+        for pid in [process.pid] + descendants:
             try:
-                os.kill(tmp_pid, sig)
-            except Exception:
+                if group_leader and os.getpgid(pid) == process.pid:
+                    continue
+                os.kill(pid, sig)
+            except OSError:
                 pass
 
     @classmethod
-    # pyre-fixme[3]: Return type must be annotated.
-    # pyre-fixme[2]: Parameter must be annotated.
-    def _get_child_procs(cls, pid):
-        cmd = "ps -o pid --ppid %d --noheaders" % (pid)
-        out = cls.run_get_output(cmd, timeout=None)
-        children = [int(s.strip()) for s in out.split("\n")]
-        return children
+    def _get_descendant_procs(cls, pid: int) -> List[int]:
+        """
+        Returns the pids of all descendants of pid from a single pass over
+        /proc, without forking any helper process.
+        """
+        children = {}
+        try:
+            entries = os.listdir("/proc")
+        except OSError:
+            return []
+        for entry in entries:
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat", "rb") as stat_file:
+                    stat = stat_file.read()
+            except OSError:
+                continue
+            # The command name may contain spaces and parens, the fields
+            # after the last ")" are "<state> <ppid> ..."
+            fields = stat[stat.rfind(b")") + 2 :].split()
+            if len(fields) > 1:
+                children.setdefault(int(fields[1]), []).append(int(entry))
+        descendants = []
+        pending = [pid]
+        while pending:
+            for child in children.get(pending.pop(), []):
+                descendants.append(child)
+                pending.append(child)
+        return descendants
 
     @classmethod
     def _run_subprocess(
@@ -243,55 +340,177 @@ class AutovalUtils:
         # pyre-fixme[2]: Parameter must be annotated.
         timeout=None,
         background: bool = False,
+        cwd: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
     ) -> CmdResult:
-        cmd = shlex.quote(cmd)
-        # pyre-fixme[9]: cmd has type `str`; used as `List[str]`.
-        cmd = shlex.split(cmd)
-        process = subprocess.Popen(  # noqa
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            cwd=pathlib.Path.home(),
-        )
+        process = cls._popen(cmd, cwd=cwd, env=env)
         proc_stdout = ""
         proc_stderr = ""
 
         if background:
             return CmdResult(command=cmd, stdout="", stderr="", return_code=0)
 
-        if timeout is None:
-            (proc_stdout, proc_stderr, ret_code) = cls._communicate(process)
-        else:
-            thread_queue = queue.Queue()
-            timer = Timer(
-                timeout,
-                cls.raise_process_timeout,
-                [process, cmd, timeout, thread_queue],
-            )
-            try:
-                timer.start()
-                (proc_stdout, proc_stderr, ret_code) = cls._communicate(process)
-            finally:
-                timer.cancel()
-                try:
-                    error = thread_queue.get(block=False)
-                    raise TimeoutError(error)
-                except queue.Empty:
-                    pass
+        (proc_stdout, proc_stderr, ret_code) = cls._communicate(
+            process, timeout, cmd=cmd
+        )
 
         return CmdResult(
             command=cmd, stdout=proc_stdout, stderr=proc_stderr, return_code=ret_code
         )
 
+    @classmethod
+    def _popen(
+        cls,
+        cmd: str,
+        cwd: Optional[str] = None,
+        env: Optional[Dict[str, str]] = None,
+    ) -> subprocess.Popen:
+        """
+        Starts cmd from cwd, the home directory by default, with stdout and
+        stderr piped back to the caller and env added to the environment.
+        The process leads a new session and process group so
+        kill_proc_family can kill the whole tree at once. Ctrl-C is passed
+        on to the group, see _track_process.
+
+        Plain commands ("md5sum /tmp/file", "ping6 -c 1 host") are executed
+        directly from their argv, saving the fork and exec of /bin/sh. Commands
+        using any shell syntax, builtins or not found in PATH go through the
+        shell as before.
+        """
+        kwargs = {
+            "stdout": subprocess.PIPE,
+            "stderr": subprocess.PIPE,
+            "cwd": cwd or pathlib.Path.home(),
+            "env": dict(os.environ, **env) if env else None,
+            "close_fds": True,
+            "start_new_session": True,
+        }
+        argv = cls._get_argv(cmd)
+        process = None
+        if argv:
+            try:
+                process = subprocess.Popen(argv, **kwargs)  # noqa
+            except (FileNotFoundError, PermissionError):
+                # Let the shell report it, e.g. "command not found", exit 127
+                pass
+        if process is None:
+            process = subprocess.Popen(cmd, shell=True, **kwargs)  # noqa
+        cls._track_process(process)
+        return process
+
+    @classmethod
+    def _open_pidfd(cls, pid: int) -> Optional[int]:
+        """
+        Returns a pidfd of pid, or None where they are not supported
+        (Python < 3.9, Linux < 5.3)
+        """
+        pidfd_open = getattr(os, "pidfd_open", None)
+        if pidfd_open is None:
+            return None
+        try:
+            return pidfd_open(pid)
+        except OSError:
+            return None
+
+    @classmethod
+    def _get_cwd(cls, working_directory: str) -> Optional[str]:
+        """
+        Returns the absolute path of working_directory to pass as cwd, or
+        None if it is not an existing directory. Like the "cd" of a shell
+        started by _popen, relative paths start from the home directory.
+        """
+        path = pathlib.Path.home() / os.path.expanduser(working_directory)
+        return str(path) if path.is_dir() else None
+
+    @classmethod
+    def _get_argv(cls, cmd: str) -> Optional[List[str]]:
+        """
+        Returns the argv of cmd if it can be executed without a shell
+        """
+        if SHELL_METACHARS.search(cmd):
+            return None
+        try:
+            argv = shlex.split(cmd)
+        except ValueError:
+            return None
+        if not argv or argv[0] in SHELL_BUILTINS or "=" in argv[0]:
+            return None
+        return argv
+
     @classmethod
     # pyre-fixme[3]: Return type must be annotated.
-    # pyre-fixme[2]: Parameter must be annotated.
-    def _communicate(cls, process):
-        proc_stdout, proc_stderr = process.communicate()
-        proc_stdout = proc_stdout.decode("utf-8", "ignore")
-        proc_stderr = proc_stderr.decode("utf-8", "ignore")
-        return (proc_stdout, proc_stderr, process.returncode)
+    def _communicate(
+        cls,
+        # pyre-fixme[2]: Parameter must be annotated.
+        process,
+        # pyre-fixme[2]: Parameter must be annotated.
+        timeout=None,
+        partial_on_timeout: bool = False,
+        cmd: Optional[str] = None,
+    ):
+        """
+        Reads stdout and stderr of process until both are closed. Outputs
+        above the capture threshold are spilled to disk, see OutputCapture.
+
+        The timeout is enforced by the read loop itself: once it expires the
+        process family is killed and TimeoutError is raised, or with
+        partial_on_timeout the output read so far is returned with exit
+        status 124. Where pidfds are available, the exit of the process is
+        waited for in the same loop, as a command may close both pipes and
+        keep running. cmd is the command string shown in the TimeoutError,
+        process.args by default.
+        """
+        timed_out = False
+        deadline = None if timeout is None else time.time() + timeout
+        captures = {
+            process.stdout: OutputCapture(errors="ignore"),
+            process.stderr: OutputCapture(errors="ignore"),
+        }
+        sel = selectors.DefaultSelector()
+        for pipe in captures:
+            sel.register(pipe, selectors.EVENT_READ)
+        pidfd = cls._open_pidfd(process.pid)
+        if pidfd is not None:
+            sel.register(pidfd, selectors.EVENT_READ)
+        try:
+            while sel.get_map():
+                wait = None
+                if deadline is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        raise subprocess.TimeoutExpired(process.args, timeout)
+                for key, _ in sel.select(wait):
+                    if key.fileobj is pidfd:
+                        # Readable once the process exited
+                        sel.unregister(pidfd)
+                        continue
+                    data = os.read(key.fd, PIPE_READ_SIZE)
+                    if data:
+                        captures[key.fileobj].write(data)
+                    else:
+                        sel.unregister(key.fileobj)
+                        key.fileobj.close()
+            process.wait(
+                timeout=None if deadline is None else max(0, deadline - time.time())
+            )
+        except subprocess.TimeoutExpired:
+            cls.kill_proc_family(process)
+            process.wait()
+            if not partial_on_timeout:
+                raise TimeoutError(
+                    "Command [%s] timed out after [%d] seconds"
+                    % (cmd or process.args, timeout)
+                )
+            timed_out = True
+        finally:
+            sel.close()
+            for pipe in captures:
+                pipe.close()
+            if pidfd is not None:
+                os.close(pidfd)
+        proc_stdout = captures[process.stdout].finish()
+        proc_stderr = captures[process.stderr].finish()
+        return (proc_stdout, proc_stderr, 124 if timed_out else process.returncode)
 
     @classmethod
     # pyre-fixme[3]: Return type must be annotated.
@@ -366,22 +585,38 @@ class AutovalUtils:
         # pyre-fixme[2]: Parameter must be annotated.
         custom_logfile=None,
         hostname: str = "localhost",
+        env: Optional[Dict[str, str]] = None,
     ) -> CmdResult:
         """
-        Private method that runs cmd and logs output
+        Private method that runs cmd and logs output, env is added to the
+        environment of the command
         """
+        run_cmd = cmd
+        cwd = None
         if working_directory:
+            # Logged as before; an existing directory is passed as cwd so
+            # plain commands still run without a shell
             cmd = "cd %s && %s" % (working_directory, cmd)
+            cwd = cls._get_cwd(working_directory)
+            if cwd is None:
+                run_cmd = cmd
 
         start_time = time.time()
         out = ""
         ret_code = -1
         try:
-            result = cls._run_subprocess(cmd, timeout=timeout, background=background)
+            result = cls._run_subprocess(
+                run_cmd, timeout=timeout, background=background, cwd=cwd, env=env
+            )
+            result.command = cmd
             duration = time.time() - start_time
             # pyre-fixme[16]: `CmdResult` has no attribute `duration`.
             result.duration = duration
-            out = result.stdout.rstrip() + result.stderr.rstrip()
+            # Only the summary of spilled outputs goes to cmd_metrics and cmdlog
+            out = (
+                OutputCapture.summarize(LazyOutput.peek(result, "stdout")).rstrip()
+                + OutputCapture.summarize(LazyOutput.peek(result, "stderr")).rstrip()
+            )
             ret_code = result.return_code
         except TimeoutError:
             ret_code = 124
@@ -64,6 +64,8 @@ class BgRunner:
         self.interval = runner.get("interval", 60)
         # pyre-fixme[4]: Attribute must be annotated.
         self.runner_obj = None
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.host = None
 
     def start_bg_runner(self) -> None:
         """Start Bg Runner.
@@ -107,12 +109,17 @@ class BgRunner:
             self._run_test()
             time.sleep(self.interval)
         self.runner_obj.test_cleanup()
+        self.runner_obj.host.connection_obj.release()
+        self.host.connection_obj.release()
 
     def setup_test(self) -> None:
         from autoval.lib.host.host import Host
 
-        host = Host(self.host_dict)
-        self.runner_obj = TestUtilsRunner(host, self.runner_name, self.runner_args)
+        # Connections are shared with the test through ConnectionRegistry
+        self.host = Host(self.host_dict)
+        self.runner_obj = TestUtilsRunner(
+            self.host, self.runner_name, self.runner_args
+        )
         self.runner_obj.test_setup()
 
     def _run_test(self) -> None:
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Checksums of local files for transfers to remote hosts.
+
+Digests are cached per (path, size, mtime, algorithm), so deploying the same
+file to many hosts, or to the same host in every test, only reads it once.
+"""
+import hashlib
+import os
+import threading
+from typing import Any, BinaryIO, Dict, Optional, Tuple
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Remote command printing "<digest>  <path>" for each supported algorithm
+HASH_COMMANDS = {
+    "sha256": "sha256sum",
+    "md5": "md5sum",
+    "xxh64": "xxh64sum",
+}
+DEFAULT_HASH_ALGO = "sha256"
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+class FileDigest:
+    _lock = threading.Lock()
+    _cache: Dict[Tuple[str, int, int, str], str] = {}
+
+    @classmethod
+    def get_algo(cls, algo: Optional[str] = None) -> str:
+        """
+        Returns algo, or the "file_transfer_hash_algo" site setting if not
+        set, falling back to sha256.
+        """
+        if algo is None:
+            from autoval.lib.utils.site_utils import SiteUtils
+
+            algo = (
+                SiteUtils.get_site_setting("file_transfer_hash_algo", raise_error=False)
+                or DEFAULT_HASH_ALGO
+            )
+        if algo not in HASH_COMMANDS:
+            raise Exception(
+                f"Unsupported hash algorithm {algo}, use one of {list(HASH_COMMANDS)}"
+            )
+        if algo == "xxh64" and xxhash is None:
+            raise Exception("xxh64 checksums need the xxhash python module")
+        return algo
+
+    @classmethod
+    # pyre-fixme[3]: Return type must be annotated.
+    def new(cls, algo: str):
+        if algo == "xxh64":
+            # pyre-fixme[16]: Optional type has no attribute `xxh64`.
+            return xxhash.xxh64()
+        return hashlib.new(algo)
+
+    @classmethod
+    def remote_command(cls, algo: str, path: str) -> str:
+        return f"{HASH_COMMANDS[algo]} {path}"
+
+    @classmethod
+    def get_cached(cls, path: str, algo: str) -> Optional[str]:
+        key = cls._cache_key(path, algo)
+        with cls._lock:
+            return cls._cache.get(key)
+
+    @classmethod
+    def store(cls, path: str, algo: str, digest: str, stat: os.stat_result) -> None:
+        """
+        Caches digest for path if the file did not change since stat was taken.
+        """
+        if cls._cache_key(path, algo) != cls._cache_key(path, algo, stat):
+            return
+        with cls._lock:
+            cls._cache[cls._cache_key(path, algo, stat)] = digest
+
+    @classmethod
+    def compute(cls, path: str, algo: str) -> str:
+        """
+        Returns the digest of path, reading the file only on a cache miss.
+        """
+        digest = cls.get_cached(path, algo)
+        if digest is not None:
+            return digest
+        stat = os.stat(path)
+        hasher = cls.new(algo)
+        with open(path, "rb") as local_file:
+            for chunk in iter(lambda: local_file.read(READ_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        digest = hasher.hexdigest()
+        cls.store(path, algo, digest, stat)
+        return digest
+
+    @classmethod
+    def _cache_key(
+        cls, path: str, algo: str, stat: Optional[os.stat_result] = None
+    ) -> Tuple[str, int, int, str]:
+        path = os.path.realpath(path)
+        if stat is None:
+            stat = os.stat(path)
+        return (path, stat.st_size, stat.st_mtime_ns, algo)
+
+
+class HashingReader:
+    """
+    Read-only file wrapper that hashes every byte read through it, so a file
+    can be checksummed while it is being uploaded.
+    """
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    def __init__(self, fileobj: BinaryIO, hasher) -> None:
+        self.fileobj = fileobj
+        # pyre-fixme[4]: Attribute must be annotated.
+        self.hasher = hasher
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.fileobj, name)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Bounded-memory capture of command output.
+
+Commands like journalctl, dmesg or lspci -vvv can print tens of MB. Instead of
+keeping all of it in memory (and copying it again into cmd_metrics and cmdlog),
+OutputCapture keeps the output in memory only up to a threshold. Past that the
+full stream is spilled to a temp file in control_server_tmpdir and only a head
+and a tail are kept in memory. CmdResult.stdout/stderr load the spilled content
+lazily, the first time they are accessed.
+
+Thresholds can be tuned through the "cmd_output_capture" site setting:
+    {
+        "spill_threshold": 8388608,  # bytes kept in memory before spilling
+        "head_size": 65536,          # bytes of the head kept once spilled
+        "tail_size": 65536           # bytes of the tail kept once spilled
+    }
+"""
+import os
+import tempfile
+import weakref
+from typing import Any, Dict, List, Optional, Union
+
+DEFAULT_CAPTURE_SETTINGS = {
+    "spill_threshold": 8 * 1024 * 1024,
+    "head_size": 64 * 1024,
+    "tail_size": 64 * 1024,
+}
+
+
+def _remove_spill_file(path: str) -> None:
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+class OutputCapture:
+    """
+    Write-only buffer for one output stream of a command.
+
+    Call write() with every chunk read from the command and finish() once the
+    command exited. finish() returns the decoded output as a str if it stayed
+    below the spill threshold, or the OutputCapture itself otherwise, which
+    CmdResult knows how to load lazily (see LazyOutput).
+    """
+
+    # pyre-fixme[4]: Attribute must be annotated.
+    _settings = None
+
+    def __init__(
+        self,
+        errors: str = "replace",
+        spill_threshold: Optional[int] = None,
+        head_size: Optional[int] = None,
+        tail_size: Optional[int] = None,
+    ) -> None:
+        settings = self.get_settings()
+        self.errors = errors
+        self.spill_threshold: int = (
+            spill_threshold
+            if spill_threshold is not None
+            else settings["spill_threshold"]
+        )
+        self.head_size: int = head_size if head_size is not None else settings["head_size"]
+        self.tail_size: int = tail_size if tail_size is not None else settings["tail_size"]
+        self.size = 0
+        self.spill_path: Optional[str] = None
+        self._chunks: List[bytes] = []
+        self._head = b""
+        self._tail = bytearray()
+        # pyre-fixme[4]: Attribute must be annotated.
+        self._file = None
+
+    @classmethod
+    def get_settings(cls) -> Dict[str, int]:
+        if cls._settings is None:
+            from autoval.lib.utils.site_utils import SiteUtils
+
+            settings = dict(DEFAULT_CAPTURE_SETTINGS)
+            try:
+                settings.update(
+                    SiteUtils.get_site_setting("cmd_output_capture", raise_error=False)
+                    or {}
+                )
+            except Exception:
+                pass
+            cls._settings = settings
+        return cls._settings
+
+    @property
+    def spilled(self) -> bool:
+        return self.spill_path is not None
+
+    def write(self, data: bytes) -> None:
+        if not data:
+            return
+        self.size += len(data)
+        if self._file is None:
+            self._chunks.append(data)
+            if self.size > self.spill_threshold:
+                self._spill()
+            return
+        self._file.write(data)
+        self._tail += data
+        # Trim lazily so that small writes do not copy the tail every time
+        if len(self._tail) > 2 * self.tail_size:
+            del self._tail[: -self.tail_size]
+
+    def finish(self) -> Union[str, "OutputCapture"]:
+        """
+        Closes the spill file, if any, and returns the output as a str when
+        it was kept in memory or this OutputCapture when it was spilled.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not self.spilled:
+            return self.decode()
+        return self
+
+    def getvalue(self) -> bytes:
+        if not self.spilled:
+            return b"".join(self._chunks)
+        if self._file is not None:
+            self._file.flush()
+        # pyre-fixme[6]: For 1st argument expected `str` but got `Optional[str]`.
+        with open(self.spill_path, "rb") as spill_file:
+            return spill_file.read()
+
+    def decode(self) -> str:
+        return self.getvalue().decode("utf-8", self.errors)
+
+    def summary(self) -> str:
+        """
+        Returns the head and the tail of a spilled output with a marker for the
+        omitted bytes, or the full output if it was not spilled. Used for
+        cmd_metrics and cmdlog so large outputs are not copied there.
+        """
+        if not self.spilled:
+            return self.decode()
+        tail = bytes(self._tail[-self.tail_size :])
+        omitted = self.size - len(self._head) - len(tail)
+        return (
+            self._head.decode("utf-8", "replace")
+            + f"\n[... {omitted} bytes of output omitted ...]\n"
+            + tail.decode("utf-8", "replace")
+        )
+
+    @staticmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def summarize(value) -> str:
+        """
+        Returns value as is, or its summary if value is an OutputCapture.
+        """
+        if isinstance(value, OutputCapture):
+            return value.summary()
+        return value
+
+    def _spill(self) -> None:
+        from autoval.lib.utils.site_utils import SiteUtils
+
+        try:
+            spill_dir = SiteUtils.get_control_server_tmpdir()
+        except Exception:
+            spill_dir = tempfile.gettempdir()
+        data = b"".join(self._chunks)
+        self._chunks = []
+        fd, path = tempfile.mkstemp(prefix="cmd_output_", suffix=".log", dir=spill_dir)
+        self._file = os.fdopen(fd, "wb")
+        self.spill_path = path
+        # The spill file lives as long as the result referencing it
+        weakref.finalize(self, _remove_spill_file, path)
+        self._file.write(data)
+        self._head = data[: self.head_size]
+        self._tail = bytearray(data[-self.tail_size :])
+
+
+class LazyOutput:
+    """
+    Descriptor used for the stdout/stderr attributes of result objects.
+
+    Plain strings are stored and returned as is. An OutputCapture holding a
+    spilled output is only read back from disk and decoded the first time the
+    attribute is accessed.
+    """
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    def __set_name__(self, owner, name: str) -> None:
+        self.attr = "_" + name
+
+    # pyre-fixme[3]: Return type must be annotated.
+    # pyre-fixme[2]: Parameter must be annotated.
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        value = obj.__dict__.get(self.attr, "")
+        if isinstance(value, OutputCapture):
+            value = value.decode()
+            obj.__dict__[self.attr] = value
+        return value
+
+    # pyre-fixme[2]: Parameter must be annotated.
+    def __set__(self, obj, value) -> None:
+        obj.__dict__[self.attr] = value
+
+    @staticmethod
+    # pyre-fixme[2]: Parameter must be annotated.
+    def peek(obj, name: str) -> Any:
+        """
+        Returns the stored value of attribute name without loading it.
+        """
+        return obj.__dict__.get("_" + name, "")